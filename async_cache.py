@@ -0,0 +1,303 @@
+"""
+asyncio flavour of MyCache for services running on an event loop.
+
+AsyncMyCache mirrors the MyCache surface with coroutines running on redis-py's
+asyncio client (redis >= 4.2, Python 3 only). All instances pointing at the same
+server share one blocking async connection pool per event loop, so thousands of
+concurrent lookups in a worker are multiplexed over a handful of sockets.
+Connections belong to the loop which opened them, so every loop (ex. every
+asyncio.run() call) gets pools of its own.
+
+Values are read like MyCache reads them, large values split in chunks included,
+but always written whole: the chunks of a large value overwritten from here are
+left to expire through their TTL. The options of cache_it which need locks or
+background work (single_flight, stale_ttl, early_refresh, tags) are not
+supported on coroutine functions.
+"""
+from functools import wraps
+import asyncio
+import json
+import logging
+import pickle
+import weakref
+import redis
+import redis.asyncio
+from redis.exceptions import ConnectionError
+from connection_pool import pool_key
+from client import DoNotCache
+from generic_cache import DEFAULT_EXPIRY, to_unicode
+from key_builder import KeyBuilder
+from large_values import is_manifest, decode_manifest, chunk_keys, join_chunks
+from local_cache import MISSING
+from metrics import get_metrics, clock
+from prefork import register_after_fork
+from serializers import get_serializer, DEFAULT_CODEC, DEFAULT_COMPRESSION, DEFAULT_COMPRESS_THRESHOLD
+from settings import get_settings
+
+_pools = weakref.WeakKeyDictionary()  # event loop -> {pool_key: pool}
+
+
+def get_async_pool(host=None, port=None, db=None, password=None, max_connections=None, timeout=None):
+    """
+    Returns the asyncio pool for the given server shared on the running event loop, creating it on
+    first use. Must be called from a coroutine.
+    :return: redis.asyncio.BlockingConnectionPool
+    """
+    loop = asyncio.get_running_loop()
+    pools = _pools.get(loop)
+    if pools is None:
+        # Connections keep their loop alive, so pools of closed loops are dropped here.
+        for closed in [other for other in list(_pools.keys()) if other.is_closed()]:
+            del _pools[closed]
+        pools = _pools[loop] = {}
+    key = pool_key(host, port, db, password)
+    pool = pools.get(key)
+    if pool is None:
+        env_settings = get_settings()
+        pool = redis.asyncio.BlockingConnectionPool(host=key[0], port=key[1], db=key[2], password=key[3],
+                                                    max_connections=max_connections or env_settings.REDIS_MAX_CONNECTIONS,
+                                                    timeout=env_settings.REDIS_POOL_TIMEOUT if timeout is None else timeout)
+        pools[key] = pool
+    return pool
+
+
+@register_after_fork
+def forget_async_pools():
+    _pools.clear()
+
+
+class AsyncMyCache(object):
+    """
+    Coroutine based counterpart of generic_cache.MyCache.
+    :param hashkeys: False puts the readable argument encoding in cache_it keys instead of its digest
+    """
+    def __init__(self, host=None, port=None, db=None, password=None, prefix=None, log=None,
+                 max_connections=None, pool_timeout=None, codec=DEFAULT_CODEC,
+                 compression=DEFAULT_COMPRESSION, compress_threshold=DEFAULT_COMPRESS_THRESHOLD, metrics=None,
+                 hashkeys=True):
+        env_settings = get_settings()
+        self.host = host or env_settings.REDIS_HOST
+        self.port = port or env_settings.REDIS_PORT
+        self.db = db or env_settings.REDIS_DB
+        self.password = password or env_settings.REDIS_PASSWORD
+        self.prefix = prefix
+        self._log = log or logging.getLogger(env_settings.LOG_NAME)
+        self.serializer = get_serializer(codec, compression, compress_threshold)
+        self.metrics_registry = metrics or get_metrics()
+        self.metrics = self.metrics_registry.series(prefix)
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
+        self.hashkeys = hashkeys
+        self._loop = None
+        self._connection = None
+
+    @property
+    def connection(self):
+        """
+        redis.asyncio client on the pool of the running event loop, to be used from coroutines only.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._connection = redis.asyncio.StrictRedis(
+                connection_pool=get_async_pool(self.host, self.port, self.db, self.password,
+                                               max_connections=self.max_connections, timeout=self.pool_timeout))
+            self._loop = loop
+        return self._connection
+
+    def make_key(self, key):
+        if self.prefix:
+            return "{0}:{1}".format(self.prefix, key)
+
+        return key
+
+    def namespace_key(self, namespace):
+        return namespace + ':*'
+
+    async def ping(self):
+        """
+        :return boolean value True if redis connection is alive else False
+        """
+        try:
+            return await self.connection.ping()
+        except ConnectionError as e:
+            self._log.info("Unable to ping Redis Server: %s" % e)
+            return False
+
+    async def get(self, key):
+        """
+        :param key: key to look up in Redis
+        :return: Value of the given key if it exists in cache else None
+        """
+        key = to_unicode(key)
+        if key:
+            try:
+                value = await self.connection.get(self.make_key(key))
+                if value is None:
+                    return
+                return self.serializer.loads(value)
+            except ConnectionError as e:
+                self._log.error('Error while getting key - {} \nERROR: {}'.format(key, str(e)))
+
+    async def mget(self, keys):
+        """
+        :param keys: List of keys to look up in Redis
+        :return: dict of found key/values
+        """
+        if keys:
+            cache_keys = [self.make_key(to_unicode(key)) for key in keys]
+            try:
+                values = await self.connection.mget(cache_keys)
+                return {k: self.serializer.loads(v) for (k, v) in zip(keys, values) if v is not None}
+            except ConnectionError as e:
+                self._log.error('Error while getting multiple keys. \nERROR: {}'.format(str(e)))
+
+    async def set(self, key, value, expire=DEFAULT_EXPIRY):
+        """
+        :param key: key by which to reference datum being stored in Redis
+        :param value: actual value being stored under this key
+        :param expire: time-to-live (ttl) for this datum
+        """
+        key = to_unicode(key)
+        try:
+            await self.connection.set(self.make_key(key), self.serializer.dumps(value), expire)
+        except ConnectionError as e:
+            self._log.error('Error While setting key, values \nERROR: {}'.format(str(e)))
+
+    async def delete(self, key):
+        key = to_unicode(key)
+        try:
+            await self.connection.delete(self.make_key(key))
+        except ConnectionError as e:
+            self._log.error('Error while deleting key -{} \nERROR: {}'.format(key, str(e)))
+
+    async def delete_namespace(self, space):
+        """
+        Removes all items in a given namespace, walking the keyspace with SCAN.
+        """
+        namespace = self.namespace_key(space)
+        try:
+            batch = []
+            async for key in self.connection.scan_iter(match=namespace, count=1000):
+                batch.append(key)
+                if len(batch) >= 1000:
+                    await self.connection.delete(*batch)
+                    batch = []
+            if batch:
+                await self.connection.delete(*batch)
+        except ConnectionError as e:
+            self._log.error('Error while deleting namespace. \nERROR: {}'.format(str(e)))
+
+    def serializer_for(self, codec=None):
+        if codec is None or codec == self.serializer.codec:
+            return self.serializer
+        return get_serializer(codec, self.serializer.compression, self.serializer.compress_threshold)
+
+    async def store_value(self, key, value, expire=None, codec=None, metrics=None):
+        metrics = metrics or self.metrics
+        try:
+            start = clock()
+            value = self.serializer_for(codec).dumps(value)
+            encoded = clock()
+            await self.connection.set(key, value, expire)
+            metrics.write(clock() - encoded, encoded - start, len(value))
+        except ConnectionError as e:
+            metrics.error()
+            self._log.error('Error while storing value with codec {}. \nERROR: {}'.format(codec, str(e)))
+
+    async def get_value(self, key, legacy=pickle.loads, metrics=None):
+        """
+        :return: the value whatever codec it was written with, or MISSING if the key does not exist
+        """
+        metrics = metrics or self.metrics
+        try:
+            start = clock()
+            value = await self.connection.get(key)
+            fetched = clock()
+            if value is None:
+                metrics.read(0, 1, fetched - start)
+                return MISSING
+            if is_manifest(value):
+                result = await self.load_chunks(key, value)
+                metrics.read(1, 0, fetched - start, clock() - fetched, len(value))
+                return result
+            result = self.serializer.loads(value, legacy=legacy)
+            metrics.read(1, 0, fetched - start, clock() - fetched, len(value))
+            return result
+        except ConnectionError as e:
+            metrics.error()
+            self._log.error('Error while getting value of key - {} \nERROR: {}'.format(key, str(e)))
+            return MISSING
+
+    async def load_chunks(self, key, data):
+        """
+        Reads a value written in chunks by MyCache, see large_values.load_chunks.
+        :return: the value, or MISSING if a chunk expired or was replaced meanwhile
+        """
+        manifest = decode_manifest(data)
+        pipe = self.connection.pipeline(transaction=False)
+        for chunk_key in chunk_keys(key, manifest):
+            pipe.get(chunk_key)
+        return join_chunks(manifest, await pipe.execute())
+
+    async def store_json(self, key, value, expire=None):
+        await self.store_value(key, value, expire, codec='json')
+
+    async def store_pickle(self, key, value, expire=None):
+        await self.store_value(key, value, expire, codec='pickle')
+
+    async def get_json(self, key):
+        value = await self.get_value(key, legacy=json.loads)
+        if value is not MISSING:
+            return value
+
+    async def get_pickle(self, key):
+        value = await self.get_value(key)
+        if value is not MISSING:
+            return value
+
+    async def close(self):
+        await self.connection.close()
+
+
+_default_cache = None
+
+
+def default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = AsyncMyCache()
+    return _default_cache
+
+
+def async_cache_it(function, namespace=None, expire=DEFAULT_EXPIRY, cache=None, ignore_args=False, use_json=False,
+                   codec=None, version=None):
+    """
+    Wraps a coroutine function the way generic_cache.cache_it wraps plain functions.
+    Used by cache_it when it is applied to an `async def`.
+    :param cache: AsyncMyCache to use, the default one if None
+    """
+    if cache is None:
+        cache = default_cache()
+    elif not isinstance(cache, AsyncMyCache):
+        raise TypeError("cache_it on a coroutine function needs an AsyncMyCache, not {0}".format(
+            type(cache).__name__))
+    codec = codec or ('json' if use_json else 'pickle')
+    legacy = json.loads if use_json else pickle.loads
+    keys = KeyBuilder(namespace, function.__name__, ignore_args, version, hashed=cache.hashkeys)
+    metrics = cache.metrics_registry.series(namespace, function.__name__)
+
+    @wraps(function)
+    async def func(*args, **kwargs):
+        cache_key = keys.key(args, kwargs)
+
+        result = await cache.get_value(cache_key, legacy=legacy, metrics=metrics)
+        if result is not MISSING:
+            return result
+
+        try:
+            result = await function(*args, **kwargs)
+        except DoNotCache as e:
+            return e.result
+        await cache.store_value(cache_key, result, expire, codec=codec, metrics=metrics)
+        return result
+    return func
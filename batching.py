@@ -0,0 +1,101 @@
+"""
+Automatic micro-batching of single-key reads into MGET.
+
+Threads calling GetBatcher.get within `window` seconds of each other are served
+by one MGET. The first caller of a batch becomes its leader: it waits until the
+window elapses or `max_batch` keys have joined, sends the MGET and hands every
+waiting caller its own value. No background thread is involved, so an idle
+batcher costs nothing and survives forking.
+"""
+import threading
+
+
+class _Pending(object):
+    __slots__ = ('key', 'value', 'error', 'event')
+
+    def __init__(self, key):
+        self.key = key
+        self.value = None
+        self.error = None
+        self.event = threading.Event()
+
+
+class _Batch(object):
+    __slots__ = ('items', 'full')
+
+    def __init__(self):
+        self.items = []
+        self.full = threading.Event()
+
+
+class GetBatcher(object):
+    """
+    :param mget: callable taking a list of keys and returning their raw values in order
+    :param window: max seconds the first key of a batch waits for others to join
+    :param max_batch: number of keys which flushes a batch immediately
+    """
+    def __init__(self, mget, window=0.0002, max_batch=64):
+        self.mget = mget
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._batch = None
+        self.batches = 0
+        self.keys = 0
+
+    def get(self, key):
+        """
+        :return: raw value of key or None, as GET would
+        """
+        pending = _Pending(key)
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            batch.items.append(pending)
+            if len(batch.items) >= self.max_batch:
+                # Close the batch, the next caller starts a new one.
+                self._batch = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+            self._flush(batch.items)
+        else:
+            pending.event.wait()
+
+        if pending.error is not None:
+            raise pending.error
+        return pending.value
+
+    def _flush(self, items):
+        keys = list(set(item.key for item in items))
+        self.batches += 1
+        self.keys += len(items)
+        try:
+            values = dict(zip(keys, self.mget(keys)))
+        except Exception as e:
+            for item in items:
+                item.error = e
+                item.event.set()
+            return
+        for item in items:
+            item.value = values[item.key]
+            item.event.set()
+
+    def after_fork(self):
+        # A batch collected in the parent is answered there.
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def stats(self):
+        """
+        :return: dict with the number of MGETs sent and keys served through them
+        """
+        return {'batches': self.batches,
+                'keys': self.keys,
+                'avg_batch': float(self.keys) / self.batches if self.batches else 0.0}
@@ -0,0 +1,425 @@
+"""
+Benchmarks for the cache layer.
+
+Runs against a redis-server spawned for the run (--redis-server, or the first
+redis-server found on PATH), an already running server (--host/--port), or the
+in-process fake of fake_redis.py when no binary is available. Absolute numbers
+against the fake are only comparable with other runs against the fake.
+
+Results are written as JSON, one entry per benchmark with count, mean, p50, p95
+and p99 in microseconds and ops/sec. Given --compare, the run is checked against
+an earlier result file and exits with status 1 when a benchmark present in both
+got slower than --threshold allows.
+
+    python benchmarks/bench_cache.py --output before.json
+    python benchmarks/bench_cache.py --compare before.json --output after.json
+"""
+from __future__ import print_function
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import redis
+from fake_redis import FakeRedisServer
+from generic_cache import MyCache, cache_it, cache_create_key
+from keyspace import iter_batches
+from large_values import chunking_supported
+from serializers import get_serializer, available_codecs, available_compressors
+
+try:
+    from client import MIOCache
+except (SyntaxError, ImportError):  # client.py is Python 2 only
+    MIOCache = None
+
+try:
+    from shutil import which
+except ImportError:  # Python 2
+    from distutils.spawn import find_executable as which
+
+DEFAULT_SIZES = '100,1000,10000,100000'
+DEFAULT_BULK_SIZES = '10000,100000,1000000'
+DEFAULT_LARGE_SIZE = 64 * 1024 * 1024
+ALL_GROUPS = ('get', 'mget', 'set', 'cache_it', 'create_key', 'serializer', 'mio', 'delete_namespace',
+              'large_values')
+
+log = logging.getLogger('cache-benchmark')
+log.addHandler(logging.NullHandler())
+log.propagate = False
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def summarize(samples, count=None):
+    """
+    :param samples: per operation durations in seconds
+    :param count: operations covered by each sample, for batched measurements
+    :return: dict of latency percentiles in microseconds and throughput
+    """
+    samples = sorted(samples)
+    n = len(samples)
+    total = sum(samples)
+
+    def percentile(p):
+        return samples[min(n - 1, int(round(p / 100.0 * (n - 1))))] * 1e6
+
+    ops = n * (count or 1)
+    return {'count': n,
+            'mean_us': total / n * 1e6,
+            'p50_us': percentile(50),
+            'p95_us': percentile(95),
+            'p99_us': percentile(99),
+            'ops_per_sec': ops / total if total else 0.0}
+
+
+def measure(fn, iterations, warmup=None):
+    for _ in range(iterations // 10 if warmup is None else warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        start = _clock()
+        fn()
+        samples.append(_clock() - start)
+    return samples
+
+
+def payload(size):
+    """
+    A dict of strings roughly size bytes long once pickled, the typical shape of a cached result.
+    """
+    rnd = random.Random(size)
+    fields = max(1, size // 64)
+    chunk = max(1, size // fields - 16)
+    return dict(('field%d' % i, ''.join(rnd.choice(string.ascii_letters) for _ in range(chunk)))
+                for i in range(fields))
+
+
+class Target(object):
+    """
+    The server the benchmarks talk to, started and stopped by the runner.
+    """
+    def __init__(self, host=None, port=None, redis_server=None, fake=False):
+        self.host = host or '127.0.0.1'
+        self.port = port
+        self.redis_server = redis_server
+        self.fake = fake
+        self.kind = None
+        self._process = None
+        self._fake = None
+        self._dir = None
+
+    def start(self):
+        if self.port:
+            self.kind = 'external'
+            return self
+        binary = None if self.fake else (self.redis_server or which('redis-server'))
+        if binary:
+            self.port = free_port()
+            self._dir = tempfile.mkdtemp(prefix='cache-bench-')
+            self._process = subprocess.Popen([binary, '--port', str(self.port), '--bind', self.host,
+                                              '--save', '', '--appendonly', 'no', '--dir', self._dir],
+                                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            self.kind = 'redis-server'
+            self.wait()
+        else:
+            self._fake = FakeRedisServer(self.host).start()
+            self.port = self._fake.port
+            self.kind = 'fake'
+        return self
+
+    def wait(self, timeout=10):
+        client = redis.StrictRedis(self.host, self.port)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return client.ping()
+            except redis.ConnectionError:
+                if time.time() > deadline or self._process.poll() is not None:
+                    raise
+                time.sleep(0.05)
+
+    def client(self):
+        return redis.StrictRedis(self.host, self.port)
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait()
+        if self._fake is not None:
+            self._fake.stop()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class Runner(object):
+    def __init__(self, target, args):
+        self.target = target
+        self.args = args
+        self.results = {}
+        self.cache = MyCache(host=target.host, port=target.port, db=0, log=log)
+
+    def record(self, name, samples, count=None, **extra):
+        result = summarize(samples, count)
+        result.update(extra)
+        self.results[name] = result
+        print('{0:<45} p50 {1:>10.1f}us  p99 {2:>10.1f}us  {3:>12.0f} ops/s'.format(
+            name, result['p50_us'], result['p99_us'], result['ops_per_sec']))
+
+    def bench_get(self):
+        cache, n = self.cache, self.args.iterations
+        for size in self.args.sizes:
+            cache.set('bench:get:%d' % size, payload(size), 600)
+            self.record('get.%dB' % size, measure(lambda: cache.get('bench:get:%d' % size), n), size=size)
+        self.record('get.miss', measure(lambda: cache.get('bench:get:missing'), n))
+
+    def bench_mget(self):
+        cache, n, width = self.cache, self.args.iterations, self.args.mget_keys
+        for size in self.args.sizes:
+            keys = ['bench:mget:%d:%d' % (size, i) for i in range(width)]
+            value = payload(size)
+            for key in keys:
+                cache.set(key, value, 600)
+            self.record('mget.%dx%dB' % (width, size), measure(lambda: cache.mget(keys), max(1, n // 10)),
+                        count=width, size=size, keys=width)
+
+    def bench_set(self):
+        cache, n = self.cache, self.args.iterations
+        for size in self.args.sizes:
+            value = payload(size)
+            self.record('set.%dB' % size, measure(lambda: cache.set('bench:set:%d' % size, value, 600), n),
+                        size=size)
+
+    def bench_cache_it(self):
+        cache, n = self.cache, self.args.iterations
+        value = payload(1000)
+
+        @cache_it(namespace='bench:cache_it', expire=600, cache=cache)
+        def hit(x):
+            return value
+
+        hit(1)
+        self.record('cache_it.hit', measure(lambda: hit(1), n))
+
+        counter = [0]
+
+        @cache_it(namespace='bench:cache_it', expire=600, cache=cache)
+        def miss(x):
+            return value
+
+        def call_miss():
+            counter[0] += 1
+            miss(counter[0])
+
+        self.record('cache_it.miss', measure(call_miss, n, warmup=0))
+        self.record('cache_it.baseline', measure(lambda: dict(value), n))
+
+    def bench_create_key(self):
+        n = self.args.iterations * 10
+        args = (12345, 'some-user@example.com', [1, 2, 3])
+        kwargs = {'limit': 50, 'offset': 100, 'order': 'desc'}
+        self.record('create_key.positional', measure(lambda: cache_create_key('ns', False, 'f', 1, 'a'), n))
+        self.record('create_key.mixed', measure(lambda: cache_create_key('ns', False, 'f', *args, **kwargs), n))
+
+    def bench_serializer(self):
+        n = self.args.iterations
+        for codec in available_codecs():
+            for compression in [None] + available_compressors():
+                serializer = get_serializer(codec, compression, 0 if compression else None)
+                for size in self.args.sizes:
+                    value = payload(size)
+                    try:
+                        data = serializer.dumps(value)
+                    except Exception as e:
+                        print('skipping serializer %s/%s: %s' % (codec, compression, e))
+                        break
+                    name = 'serializer.%s.%s.%dB' % (codec, compression or 'raw', size)
+                    self.record(name + '.dumps', measure(lambda: serializer.dumps(value), n),
+                                size=size, encoded_size=len(data))
+                    self.record(name + '.loads', measure(lambda: serializer.loads(data), n),
+                                size=size, encoded_size=len(data))
+
+    def bench_mio(self):
+        if MIOCache is None:
+            print('skipping MIOCache benchmarks: client.py does not import on this Python')
+            return
+        n = self.args.iterations
+        # The LRU mode runs a Lua script, which the fake does not support.
+        for lru in (False,) if self.target.kind == 'fake' else (False, True):
+            mode = 'lru' if lru else 'set'
+            cache = MIOCache(limit=n * 2, host=self.target.host, port=self.target.port, db=0,
+                             namespace='bench:mio:%s' % mode, lru=lru)
+            value = payload(1000)
+            self.record('mio.%s.set' % mode, measure(lambda: cache.set('k', value), n))
+            self.record('mio.%s.get' % mode, measure(lambda: cache.get('k'), n))
+            cache.delete_all()
+
+    def bench_delete_namespace(self):
+        client = self.target.client()
+        for count in self.args.bulk_sizes:
+            space = 'bench:bulk:%d' % count
+            populate(client, space, count)
+            start = _clock()
+            deleted = self.cache.delete_namespace(space)
+            elapsed = _clock() - start
+            result = {'count': 1, 'keys': count, 'deleted': deleted, 'seconds': elapsed,
+                      'keys_per_sec': count / elapsed if elapsed else 0.0}
+            self.results['delete_namespace.%d' % count] = result
+            print('{0:<45} {1:>10.3f}s  {2:>12.0f} keys/s'.format('delete_namespace.%d' % count,
+                                                                   elapsed, result['keys_per_sec']))
+
+    def bench_large_values(self):
+        if not chunking_supported():
+            print('skipping large value benchmarks: pickle protocol 5 is not available')
+            return
+        size = self.args.large_size
+        # A bytearray is pickled out-of-band like a NumPy array's data; compression is off on both
+        # sides since it would dominate the numbers.
+        value = bytearray(os.urandom(1024)) * (size // 1024)
+        caches = [('pickle', MyCache(host=self.target.host, port=self.target.port, db=0, log=log,
+                                     compression=None)),
+                  ('chunked', MyCache(host=self.target.host, port=self.target.port, db=0, log=log,
+                                      compression=None, large_value_threshold=1024 * 1024))]
+        for mode, cache in caches:
+            key = 'bench:large:%s' % mode
+            for op, call in (('store', lambda: cache.store_pickle(key, value, 600)),
+                             ('get', lambda: cache.get_pickle(key))):
+                tracemalloc.start()
+                start = _clock()
+                call()
+                elapsed = _clock() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                name = 'large_values.%s.%s.%dMB' % (mode, op, size // (1024 * 1024))
+                self.results[name] = {'count': 1, 'bytes': size, 'seconds': elapsed, 'peak_bytes': peak}
+                print('{0:<45} {1:>10.3f}s  {2:>9.1f}MB peak'.format(name, elapsed, peak / 1048576.0))
+
+    def run(self, groups):
+        self.target.client().flushdb()
+        for group in groups:
+            getattr(self, 'bench_' + group)()
+        self.target.client().flushdb()
+        return self.results
+
+
+def populate(client, space, count, batch=1000):
+    for keys in iter_batches(range(count), batch):
+        pipe = client.pipeline(transaction=False)
+        for i in keys:
+            pipe.set('%s:%d' % (space, i), b'x', ex=3600)
+        pipe.execute()
+    # Keys outside of the namespace, which deletion has to skip over.
+    pipe = client.pipeline(transaction=False)
+    for i in range(min(count, batch)):
+        pipe.set('bench:other:%d' % i, b'x', ex=3600)
+    pipe.execute()
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: list of (name, metric, baseline value, current value) for benchmarks which got slower
+    """
+    regressions = []
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        metric = 'seconds' if 'seconds' in current else 'p50_us'
+        if metric in previous and current[metric] > previous[metric] * (1 + threshold):
+            regressions.append((name, metric, previous[metric], current[metric]))
+    return regressions
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the redis cache layer.')
+    parser.add_argument('--redis-server', help='redis-server binary to spawn, found on PATH by default')
+    parser.add_argument('--fake', action='store_true', help='use the in-process fake even if redis-server exists')
+    parser.add_argument('--host', help='benchmark an already running server instead of spawning one')
+    parser.add_argument('--port', type=int, help='port of the already running server')
+    parser.add_argument('--iterations', type=int, default=2000, help='operations per latency benchmark')
+    parser.add_argument('--sizes', type=int_list, default=int_list(DEFAULT_SIZES),
+                        help='comma separated value sizes in bytes (default %s)' % DEFAULT_SIZES)
+    parser.add_argument('--mget-keys', type=int, default=50, help='keys per MGET')
+    parser.add_argument('--bulk-sizes', type=int_list, default=int_list(DEFAULT_BULK_SIZES),
+                        help='comma separated namespace sizes to delete (default %s)' % DEFAULT_BULK_SIZES)
+    parser.add_argument('--large-size', type=int, default=DEFAULT_LARGE_SIZE,
+                        help='bytes of the value stored by the large_values benchmarks (default %d)'
+                             % DEFAULT_LARGE_SIZE)
+    parser.add_argument('--only', help='comma separated subset of: %s' % ', '.join(ALL_GROUPS))
+    parser.add_argument('--output', help='file to write the JSON results to, stdout if omitted')
+    parser.add_argument('--compare', help='earlier JSON results to check this run against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown against --compare, 0.2 means 20%% (default)')
+    args = parser.parse_args(argv)
+    if args.host and not args.port:
+        parser.error('--host requires --port')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    groups = args.only.split(',') if args.only else list(ALL_GROUPS)
+    unknown = set(groups) - set(ALL_GROUPS)
+    if unknown:
+        print('unknown benchmarks: %s' % ', '.join(sorted(unknown)), file=sys.stderr)
+        return 2
+
+    target = Target(args.host, args.port, args.redis_server, args.fake).start()
+    try:
+        results = Runner(target, args).run(groups)
+    finally:
+        target.stop()
+
+    report = {'meta': {'target': target.kind,
+                       'python': platform.python_version(),
+                       'redis_py': redis.__version__,
+                       'platform': platform.platform(),
+                       'iterations': args.iterations,
+                       'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')},
+              'results': results}
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('meta', {}).get('target') != target.kind:
+            print('warning: baseline ran against %s, this run against %s'
+                  % (baseline.get('meta', {}).get('target'), target.kind), file=sys.stderr)
+        regressions = compare(results, baseline.get('results', {}), args.threshold)
+        for name, metric, before, after in regressions:
+            print('REGRESSION %s: %s %.1f -> %.1f (%+.0f%%)'
+                  % (name, metric, before, after, (after / before - 1) * 100), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
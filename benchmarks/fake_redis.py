@@ -0,0 +1,400 @@
+"""
+Minimal in-process RESP2/RESP3 server used by the benchmarks when no redis-server binary
+is available.
+
+It implements the string, key, set and transaction commands the cache layer
+uses, with lazy key expiry, behind one global lock. SCAN is safe against keys
+being deleted while iterating, which matters for the namespace deletion
+benchmarks. It is not a Redis replacement: no persistence, no Lua, no pub/sub,
+and a single database.
+"""
+from __future__ import print_function
+import fnmatch
+import random
+import threading
+import time
+try:
+    import socketserver
+except ImportError:  # Python 2
+    import SocketServer as socketserver
+
+
+class CommandError(Exception):
+    pass
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+class Store(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush()
+
+    def flush(self):
+        self.data = {}
+        self.expires = {}
+        # Keys in creation order, only reset by FLUSHDB, so SCAN cursors (indexes
+        # into it) stay valid when keys are deleted.
+        self.order = []
+        self.client_ids = 0
+
+    def _alive(self, key):
+        expire_at = self.expires.get(key)
+        if expire_at is not None and expire_at <= _now_ms():
+            self._delete(key)
+            return False
+        return key in self.data
+
+    def _delete(self, key):
+        self.expires.pop(key, None)
+        return self.data.pop(key, None) is not None
+
+    def _put(self, key, value):
+        if key not in self.data:
+            self.order.append(key)
+        self.data[key] = value
+        self.expires.pop(key, None)
+
+    def get(self, key):
+        if not self._alive(key):
+            return None
+        value = self.data[key]
+        if not isinstance(value, bytes):
+            raise CommandError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def get_set(self, key, create=False):
+        if not self._alive(key):
+            if not create:
+                return set()
+            self._put(key, set())
+        value = self.data[key]
+        if not isinstance(value, set):
+            raise CommandError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+
+def _int(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise CommandError('ERR value is not an integer or out of range')
+
+
+class Commands(object):
+    """
+    One method per supported command, named cmd_<name>. Arguments are bytes.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def cmd_ping(self, *args):
+        return args[0] if args else Status('PONG')
+
+    def cmd_echo(self, value):
+        return value
+
+    def cmd_select(self, db):
+        return OK
+
+    def cmd_client(self, sub, *args):
+        sub = sub.lower()
+        if sub == b'id':
+            self.store.client_ids += 1
+            return self.store.client_ids
+        return OK
+
+    def cmd_info(self, *args):
+        return b'# Server\r\nredis_version:0.0.0-fake\r\n'
+
+    def cmd_flushdb(self, *args):
+        self.store.flush()
+        return OK
+
+    cmd_flushall = cmd_flushdb
+
+    def cmd_dbsize(self):
+        return len(self.store.data)
+
+    def cmd_get(self, key):
+        return self.store.get(key)
+
+    def cmd_getrange(self, key, start, end):
+        value = self.store.get(key) or b''
+        start, end = _int(start), _int(end)
+        if start < 0:
+            start = max(len(value) + start, 0)
+        if end < 0:
+            end = len(value) + end
+        return value[start:end + 1]
+
+    def cmd_mget(self, *keys):
+        return [self.store.get(key) if self.store._alive(key) and isinstance(self.store.data[key], bytes)
+                else None for key in keys]
+
+    def cmd_set(self, key, value, *options):
+        expire_ms = None
+        nx = xx = False
+        options = list(options)
+        while options:
+            option = options.pop(0).lower()
+            if option == b'ex':
+                expire_ms = _int(options.pop(0)) * 1000
+            elif option == b'px':
+                expire_ms = _int(options.pop(0))
+            elif option == b'nx':
+                nx = True
+            elif option == b'xx':
+                xx = True
+            else:
+                raise CommandError('ERR syntax error')
+        exists = self.store._alive(key)
+        if (nx and exists) or (xx and not exists):
+            return None
+        self.store._put(key, value)
+        if expire_ms is not None:
+            if expire_ms <= 0:
+                raise CommandError('ERR invalid expire time in set')
+            self.store.expires[key] = _now_ms() + expire_ms
+        return OK
+
+    def cmd_setex(self, key, seconds, value):
+        return self.cmd_set(key, value, b'EX', seconds)
+
+    def cmd_psetex(self, key, millis, value):
+        return self.cmd_set(key, value, b'PX', millis)
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, b'1')
+
+    def cmd_incrby(self, key, amount):
+        value = _int(self.store.get(key) or b'0') + _int(amount)
+        expire_at = self.store.expires.get(key)
+        self.store._put(key, str(value).encode('ascii'))
+        if expire_at is not None:
+            self.store.expires[key] = expire_at
+        return value
+
+    def cmd_del(self, *keys):
+        return sum(1 for key in keys if self.store._alive(key) and self.store._delete(key))
+
+    cmd_unlink = cmd_del
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self.store._alive(key))
+
+    def cmd_pexpire(self, key, millis):
+        if not self.store._alive(key):
+            return 0
+        self.store.expires[key] = _now_ms() + _int(millis)
+        return 1
+
+    def cmd_expire(self, key, seconds):
+        return self.cmd_pexpire(key, _int(seconds) * 1000)
+
+    def cmd_pttl(self, key):
+        if not self.store._alive(key):
+            return -2
+        expire_at = self.store.expires.get(key)
+        return -1 if expire_at is None else max(expire_at - _now_ms(), 0)
+
+    def cmd_ttl(self, key):
+        ttl = self.cmd_pttl(key)
+        return ttl if ttl < 0 else (ttl + 500) // 1000
+
+    def cmd_keys(self, pattern):
+        pattern = pattern.decode('utf-8', 'replace')
+        return [key for key in list(self.store.data)
+                if self.store._alive(key) and fnmatch.fnmatchcase(key.decode('utf-8', 'replace'), pattern)]
+
+    def cmd_scan(self, cursor, *options):
+        cursor = _int(cursor)
+        pattern, count = None, 10
+        options = list(options)
+        while options:
+            option = options.pop(0).lower()
+            if option == b'match':
+                pattern = options.pop(0).decode('utf-8', 'replace')
+            elif option == b'count':
+                count = _int(options.pop(0))
+            else:
+                options.pop(0)
+        order = self.store.order
+        end = min(cursor + count, len(order))
+        keys = []
+        for key in order[cursor:end]:
+            if key in self.store.data and self.store._alive(key):
+                if pattern is None or fnmatch.fnmatchcase(key.decode('utf-8', 'replace'), pattern):
+                    keys.append(key)
+        if end >= len(order):
+            end = 0
+        return [str(end).encode('ascii'), keys]
+
+    def cmd_sadd(self, key, *members):
+        members_ = self.store.get_set(key, create=True)
+        before = len(members_)
+        members_.update(members)
+        return len(members_) - before
+
+    def cmd_srem(self, key, *members):
+        members_ = self.store.get_set(key)
+        removed = len(members_.intersection(members))
+        members_.difference_update(members)
+        if not members_ and key in self.store.data:
+            self.store._delete(key)
+        return removed
+
+    def cmd_scard(self, key):
+        return len(self.store.get_set(key))
+
+    def cmd_smembers(self, key):
+        return list(self.store.get_set(key))
+
+    def cmd_sismember(self, key, member):
+        return int(member in self.store.get_set(key))
+
+    def cmd_spop(self, key, count=None):
+        members = self.store.get_set(key)
+        if count is not None:
+            popped = random.sample(list(members), min(_int(count), len(members)))
+            if popped:
+                self.cmd_srem(key, *popped)
+            return popped
+        if not members:
+            return None
+        member = random.choice(list(members))
+        self.cmd_srem(key, member)
+        return member
+
+
+class Status(str):
+    pass
+
+
+class Map(dict):
+    """
+    RESP3 map reply, only sent to clients which switched protocol with HELLO 3.
+    """
+
+
+OK = Status('OK')
+
+
+def encode(value, resp3=False):
+    if value is None:
+        return b'_\r\n' if resp3 else b'$-1\r\n'
+    if isinstance(value, Status):
+        return ('+%s\r\n' % value).encode('ascii')
+    if isinstance(value, CommandError):
+        return ('-%s\r\n' % value).encode('utf-8')
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return (':%d\r\n' % value).encode('ascii')
+    if isinstance(value, Map):
+        return ('%%%d\r\n' % len(value)).encode('ascii') + \
+            b''.join(encode(k, resp3) + encode(v, resp3) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return ('*%d\r\n' % len(value)).encode('ascii') + b''.join(encode(v, resp3) for v in value)
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return ('$%d\r\n' % len(value)).encode('ascii') + value + b'\r\n'
+
+
+class Handler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if line[:1] != b'*':
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def handle(self):
+        commands = self.server.commands
+        queued = None
+        resp3 = False
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            if not args:
+                continue
+            name = args[0].decode('ascii', 'replace').lower()
+            if name == 'hello':
+                # Newer clients negotiate RESP3, which only changes how nulls and maps are sent here.
+                proto = int(args[1]) if len(args) > 1 else 2
+                resp3 = proto == 3
+                info = [b'server', b'redis', b'version', b'0.0.0-fake', b'proto', proto]
+                reply = Map(zip(info[::2], info[1::2])) if proto == 3 else info
+            elif name == 'multi':
+                queued = []
+                reply = OK
+            elif name == 'exec':
+                with commands.store.lock:
+                    reply = [self.call(commands, cmd) for cmd in (queued or [])]
+                queued = None
+            elif name == 'discard':
+                queued = None
+                reply = OK
+            elif queued is not None:
+                queued.append(args)
+                reply = Status('QUEUED')
+            else:
+                with commands.store.lock:
+                    reply = self.call(commands, args)
+            self.wfile.write(encode(reply, resp3))
+
+    def call(self, commands, args):
+        name = args[0].decode('ascii', 'replace').lower()
+        method = getattr(commands, 'cmd_' + name, None)
+        if method is None:
+            return CommandError("ERR unknown command '%s'" % name)
+        try:
+            return method(*args[1:])
+        except CommandError as e:
+            return e
+        except (TypeError, IndexError):
+            return CommandError("ERR wrong number of arguments for '%s' command" % name)
+
+
+class FakeRedisServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        socketserver.TCPServer.__init__(self, (host, port), Handler)
+        self.commands = Commands(Store())
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-redis')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    server = FakeRedisServer(port=6399).start()
+    print('fake redis listening on 127.0.0.1:%d' % server.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
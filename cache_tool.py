@@ -0,0 +1,351 @@
+"""
+Bulk dump, restore and warm-up of the cache, for cold starts after a Redis
+restart or failover.
+
+    python cache_tool.py dump users --output users.dump.gz
+    python cache_tool.py restore users.dump.gz --workers 4 --rate 20000
+    python cache_tool.py warm calls.jsonl --function reports:load_report --rate 200
+
+dump walks a namespace with SCAN and reads every key with pipelined DUMP and
+PTTL, writing (key, ttl, raw value) records to a compact file, gzipped when its
+name ends with .gz. restore sends the records back with pipelined RESTORE
+REPLACE in batches, on parallel workers; DUMP payloads can only be restored on
+a server of the same or a newer version. warm replays calls of cache_it
+functions from a JSONL file, one {"function": "module:name", "args": [...],
+"kwargs": {...}} object per line, so their results are computed and cached
+before traffic arrives. --rate caps keys (or calls) per second over all workers
+so that warming up does not starve live traffic.
+"""
+from __future__ import print_function
+import argparse
+import gzip
+import importlib
+import itertools
+import json
+import logging
+import struct
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import redis
+from generations import generation_key
+from generic_cache import MyCache
+from keyspace import iter_batches, DEFAULT_SCAN_COUNT
+
+MAGIC = b'RCDUMP1\n'
+# Key length, ttl in milliseconds (0 for none) and value length of every record.
+RECORD = struct.Struct('>IqI')
+
+DEFAULT_BATCH = 500
+DEFAULT_WORKERS = 4
+
+log = logging.getLogger('cache-tool')
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by the workers of a run.
+    :param rate: units per second, None or 0 for no limit
+    """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._allowance = float(rate or 0)
+        self._last = time.time()
+
+    def wait(self, units=1):
+        """
+        Blocks until units may be spent.
+        """
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.time()
+                self._allowance = min(float(self.rate), self._allowance + (now - self._last) * self.rate)
+                self._last = now
+                # A batch larger than one second worth of units goes through once the bucket is
+                # full, leaving it in debt so the rate still holds over time.
+                needed = min(units, self.rate)
+                if self._allowance >= needed:
+                    self._allowance -= units
+                    return
+                delay = (needed - self._allowance) / self.rate
+            time.sleep(delay)
+
+
+def open_dump(path, mode):
+    """
+    :param path: dump file, gzipped when ending with .gz, - for stdin/stdout
+    """
+    if path == '-':
+        stream = sys.stdout if 'w' in mode else sys.stdin
+        return getattr(stream, 'buffer', stream)
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def write_record(out, key, ttl, value):
+    out.write(RECORD.pack(len(key), ttl, len(value)))
+    out.write(key)
+    out.write(value)
+
+
+def read_records(stream):
+    """
+    Generator of (key, ttl, value) records of a dump file.
+    """
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a cache dump file")
+    while True:
+        header = stream.read(RECORD.size)
+        if not header:
+            return
+        if len(header) < RECORD.size:
+            raise ValueError("Truncated cache dump file")
+        key_size, ttl, value_size = RECORD.unpack(header)
+        key = stream.read(key_size)
+        value = stream.read(value_size)
+        if len(key) < key_size or len(value) < value_size:
+            raise ValueError("Truncated cache dump file")
+        yield key, ttl, value
+
+
+def dump(cache, namespace, out, batch=DEFAULT_BATCH, limiter=None, progress=None):
+    """
+    Writes every key of namespace (all keys when None) with its ttl and DUMP payload to out.
+    :return: number of keys written
+    """
+    limiter = limiter or RateLimiter()
+    pattern = cache.namespace_key(namespace) if namespace else None
+    keys = cache.iter_keys(pattern)
+    if namespace:
+        # The generation counter of a versioned namespace lives outside of it.
+        keys = itertools.chain([generation_key(cache.tag(namespace))], keys)
+    out.write(MAGIC)
+    written = 0
+    for keys in iter_batches(keys, batch):
+        limiter.wait(len(keys))
+        pipe = cache.connection.pipeline(transaction=False)
+        for key in keys:
+            pipe.dump(key)
+            pipe.pttl(key)
+        replies = pipe.execute()
+        for key, value, ttl in zip(keys, replies[::2], replies[1::2]):
+            if value is None or ttl == -2:  # expired or deleted meanwhile
+                continue
+            write_record(out, key.encode('utf-8') if not isinstance(key, bytes) else key, max(ttl, 0), value)
+            written += 1
+        if progress is not None:
+            progress(written)
+    return written
+
+
+def restore(cache, records, batch=DEFAULT_BATCH, workers=DEFAULT_WORKERS, limiter=None, progress=None):
+    """
+    Restores records from read_records() with pipelined RESTORE REPLACE, batch keys per round trip
+    on parallel workers. At most two batches per worker are held in memory.
+    :return: (keys restored, keys which failed)
+    """
+    limiter = limiter or RateLimiter()
+    counts = {'restored': 0, 'failed': 0}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers * 2)
+    connection = cache.connection
+
+    def send(records):
+        try:
+            limiter.wait(len(records))
+            pipe = connection.pipeline(transaction=False)
+            for key, ttl, value in records:
+                pipe.restore(key, ttl, value, replace=True)
+            replies = pipe.execute(raise_on_error=False)
+            failed = sum(1 for reply in replies if isinstance(reply, Exception))
+            for reply in replies:
+                if isinstance(reply, Exception):
+                    log.error('RESTORE failed: {}'.format(reply))
+                    break
+        except redis.RedisError as e:
+            log.error('Restoring a batch of {} keys failed. \nERROR: {}'.format(len(records), e))
+            failed = len(records)
+        finally:
+            slots.release()
+        with lock:
+            counts['restored'] += len(records) - failed
+            counts['failed'] += failed
+            if progress is not None:
+                progress(counts['restored'])
+
+    pool = ThreadPool(workers)
+    try:
+        for records in iter_batches(records, batch):
+            slots.acquire()
+            pool.apply_async(send, (records,))
+    finally:
+        pool.close()
+        pool.join()
+    return counts['restored'], counts['failed']
+
+
+def load_function(name):
+    """
+    :param name: 'package.module:function', or 'module:Class.method'
+    :return: the function
+    """
+    module_name, _, path = name.partition(':')
+    if not path:
+        raise ValueError("Expected module:function, got %r" % name)
+    target = importlib.import_module(module_name)
+    for attr in path.split('.'):
+        target = getattr(target, attr)
+    return target
+
+
+def read_calls(stream, function=None):
+    """
+    Generator of (function name, args, kwargs) of the JSON lines of stream; blank lines are skipped.
+    :param function: name used for lines without a "function" field
+    """
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        call = json.loads(line)
+        if isinstance(call, list):
+            call = {'args': call}
+        name = call.get('function', function)
+        if not name:
+            raise ValueError("Line %d names no function and no --function was given" % number)
+        yield name, call.get('args', []), call.get('kwargs', {})
+
+
+def warm(calls, workers=DEFAULT_WORKERS, limiter=None, progress=None):
+    """
+    Calls the cache_it functions of calls from read_calls(), filling the cache with their results.
+    :return: (calls made, calls which raised)
+    """
+    limiter = limiter or RateLimiter()
+    functions = {}
+    counts = {'called': 0, 'failed': 0}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    def call(name, args, kwargs):
+        try:
+            limiter.wait()
+            functions[name](*args, **kwargs)
+            failed = 0
+        except Exception as e:
+            log.error('Warming {}({}) failed. \nERROR: {}'.format(name, args, e))
+            failed = 1
+        finally:
+            slots.release()
+        with lock:
+            counts['called'] += 1
+            counts['failed'] += failed
+            if progress is not None:
+                progress(counts['called'])
+
+    pool = ThreadPool(workers)
+    try:
+        for name, args, kwargs in calls:
+            if name not in functions:
+                functions[name] = load_function(name)
+            slots.acquire()
+            pool.apply_async(call, (name, args, kwargs))
+    finally:
+        pool.close()
+        pool.join()
+    return counts['called'], counts['failed']
+
+
+def make_cache(args):
+    options = dict((name, getattr(args, name)) for name in ('host', 'port', 'db', 'password')
+                   if getattr(args, name) is not None)
+    return MyCache(scan_count=args.scan_count, health_check_interval=None, **options)
+
+
+def reporter(label, every):
+    state = {'next': every}
+
+    def progress(count):
+        if count >= state['next']:
+            state['next'] = count + every
+            print('{0}: {1}'.format(label, count), file=sys.stderr)
+    return progress
+
+
+def parse_args(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--host', help='redis host, from the settings by default')
+    common.add_argument('--port', type=int, help='redis port, from the settings by default')
+    common.add_argument('--db', type=int, help='redis db, from the settings by default')
+    common.add_argument('--password', help='redis password, from the settings by default')
+    common.add_argument('--scan-count', type=int, default=DEFAULT_SCAN_COUNT, help='COUNT hint of every SCAN page')
+    common.add_argument('--batch', type=int, default=DEFAULT_BATCH, help='keys per pipelined round trip')
+    common.add_argument('--rate', type=float, help='max keys (warm: calls) per second, unlimited by default')
+    common.add_argument('--progress', type=int, default=10000, help='report progress every that many keys')
+
+    parser = argparse.ArgumentParser(description='Dump, restore and warm up the redis cache.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    dump_parser = commands.add_parser('dump', parents=[common], help='write the keys of a namespace to a file')
+    dump_parser.add_argument('namespace', nargs='?', help='namespace to dump, every key when omitted')
+    dump_parser.add_argument('--output', '-o', default='-', help='dump file, gzipped when ending with .gz')
+
+    restore_parser = commands.add_parser('restore', parents=[common], help='load a dump file back with RESTORE')
+    restore_parser.add_argument('input', help='dump file, - for stdin')
+    restore_parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='parallel pipelines')
+
+    warm_parser = commands.add_parser('warm', parents=[common],
+                                      help='replay calls of cache_it functions from a JSONL file')
+    warm_parser.add_argument('input', help='JSONL file of calls, - for stdin')
+    warm_parser.add_argument('--function', help='module:function of lines naming none')
+    warm_parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='parallel calls')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    limiter = RateLimiter(args.rate)
+    start = time.time()
+    if args.command == 'dump':
+        cache = make_cache(args)
+        out = open_dump(args.output, 'wb')
+        try:
+            count = dump(cache, args.namespace, out, args.batch, limiter, reporter('dumped', args.progress))
+        finally:
+            if args.output != '-':
+                out.close()
+        print('dumped {0} keys in {1:.1f}s'.format(count, time.time() - start), file=sys.stderr)
+    elif args.command == 'restore':
+        cache = make_cache(args)
+        stream = open_dump(args.input, 'rb')
+        try:
+            restored, failed = restore(cache, read_records(stream), args.batch, args.workers, limiter,
+                                       reporter('restored', args.progress))
+        finally:
+            if args.input != '-':
+                stream.close()
+        print('restored {0} keys in {1:.1f}s, {2} failed'.format(restored, time.time() - start, failed),
+              file=sys.stderr)
+        return 1 if failed else 0
+    else:
+        stream = sys.stdin if args.input == '-' else open(args.input)
+        try:
+            called, failed = warm(read_calls(stream, args.function), args.workers, limiter,
+                                  reporter('called', args.progress))
+        finally:
+            if args.input != '-':
+                stream.close()
+        print('made {0} calls in {1:.1f}s, {2} failed'.format(called, time.time() - start, failed),
+              file=sys.stderr)
+        return 1 if failed else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+"""
+Circuit breaker and background health checking for a redis server.
+
+The breaker starts closed: commands go through and consecutive connection
+failures are counted. Once failure_threshold is reached it opens and callers
+skip redis immediately instead of each waiting on a connect timeout. After a
+jittered, exponentially growing delay it turns half-open and lets a single
+probe through; the probe's outcome closes it again or reopens it with a longer
+delay.
+
+A HealthChecker thread pings the server in the background, every `interval`
+seconds while closed and at each retry time while open, so recovery is noticed
+without any caller paying for it. Caches talking to the same server share one
+breaker and one health checker through get_breaker().
+"""
+import atexit
+import logging
+import random
+import threading
+import time
+import redis
+from prefork import register_after_fork
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_HEALTH_CHECK_INTERVAL = 5.0
+DEFAULT_RETRY_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30.0
+
+
+def jittered_backoff(attempt, base=DEFAULT_RETRY_BACKOFF, cap=DEFAULT_MAX_BACKOFF):
+    """
+    Exponential backoff with jitter: a random delay between half and all of
+    min(cap, base * 2 ** attempt), so clients which lost the server together
+    do not come back in lockstep.
+    :return: seconds to wait before the next attempt
+    """
+    delay = min(cap, base * 2 ** min(attempt, 32))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+class CircuitBreaker(object):
+    """
+    :param failure_threshold: consecutive failures which open the circuit
+    :param backoff: base delay in seconds before the first half-open probe
+    :param max_backoff: max delay between probes
+    :param probe_timeout: seconds after which a half-open probe that never reported back is replaced
+    """
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, backoff=DEFAULT_RETRY_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF, probe_timeout=5.0, name='redis', log=None):
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.probe_timeout = probe_timeout
+        self.name = name
+        self._log = log or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.attempt = 0
+        self.retry_at = 0.0
+        self.probe_deadline = 0.0
+        self.opened = 0
+        self.rejected = 0
+        self.health_checker = None
+
+    def allow(self):
+        """
+        :return: True if a command may be sent to the server now
+        """
+        if self.state == CLOSED:
+            return True
+        now = time.time()
+        with self._lock:
+            if (self.state == OPEN and now >= self.retry_at) or \
+                    (self.state == HALF_OPEN and now >= self.probe_deadline):
+                self.state = HALF_OPEN
+                self.probe_deadline = now + self.probe_timeout
+                return True
+            if self.state != CLOSED:
+                self.rejected += 1
+            return self.state == CLOSED
+
+    def record_success(self):
+        if self.state == CLOSED and not self.failures:
+            return
+        with self._lock:
+            if self.state != CLOSED:
+                self._log.info('Circuit for {} closed, redis is reachable again.'.format(self.name))
+            self.state = CLOSED
+            self.failures = 0
+            self.attempt = 0
+
+    def record_failure(self):
+        now = time.time()
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == OPEN and now >= self.retry_at) or \
+                    (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self._open(now)
+
+    def trip(self):
+        """
+        Opens the circuit right away, ex. when the first connection attempt failed.
+        """
+        with self._lock:
+            if self.state != OPEN:
+                self._open(time.time())
+
+    def _open(self, now):
+        delay = jittered_backoff(self.attempt, self.backoff, self.max_backoff)
+        self.attempt += 1
+        self.retry_at = now + delay
+        if self.state != OPEN:
+            self.opened += 1
+            self._log.warning('Circuit for {} opened, retrying in {:.2f} seconds.'
+                              .format(self.name, delay))
+        self.state = OPEN
+
+    def seconds_until_retry(self):
+        return max(self.retry_at - time.time(), 0.0) if self.state == OPEN else 0.0
+
+    def start_health_check(self, check, interval=DEFAULT_HEALTH_CHECK_INTERVAL):
+        """
+        Starts the background thread probing the server with check(), once per breaker.
+        """
+        with self._lock:
+            if self.health_checker is None or not self.health_checker.is_alive():
+                self.health_checker = HealthChecker(check, self, interval, log=self._log)
+                self.health_checker.start()
+        return self.health_checker
+
+    def stop_health_check(self):
+        if self.health_checker is not None:
+            self.health_checker.stop()
+            self.health_checker = None
+
+    def after_fork(self):
+        """
+        Forgets the lock and health check thread of the parent process; the cache restarts the check.
+        """
+        self._lock = threading.Lock()
+        self.health_checker = None
+
+    def stats(self):
+        return {'state': self.state,
+                'failures': self.failures,
+                'opened': self.opened,
+                'rejected': self.rejected,
+                'retry_in': self.seconds_until_retry()}
+
+
+class HealthChecker(threading.Thread):
+    """
+    Daemon thread reporting the outcome of check() to a breaker.
+    :param check: callable raising redis.RedisError when the server is unhealthy
+    """
+    def __init__(self, check, breaker, interval=DEFAULT_HEALTH_CHECK_INTERVAL, log=None):
+        super(HealthChecker, self).__init__(name='redis-health-check')
+        self.daemon = True
+        self.check = check
+        self.breaker = breaker
+        self.interval = interval
+        self._log = log or logging.getLogger(__name__)
+        self._stopped = threading.Event()
+
+    def next_delay(self):
+        if self.breaker.state == OPEN:
+            return max(self.breaker.seconds_until_retry(), 0.01)
+        return self.interval
+
+    def run(self):
+        while not self._stopped.wait(self.next_delay()):
+            try:
+                self.check()
+            except redis.RedisError as e:
+                self._log.debug('Redis health check failed: {}'.format(str(e)))
+                self.breaker.record_failure()
+            except Exception as e:
+                self._log.error('Redis health check crashed. \nERROR: {}'.format(str(e)))
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+    def stop(self):
+        self._stopped.set()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(key, **options):
+    """
+    Returns the breaker shared by every cache using the server identified by key,
+    creating it with options on first use.
+    :param key: connection_pool.pool_key() of the server
+    """
+    breaker = _breakers.get(key)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(key)
+            if breaker is None:
+                options.setdefault('name', '{0}:{1}/{2}'.format(*key[:3]))
+                breaker = _breakers[key] = CircuitBreaker(**options)
+    return breaker
+
+
+def breaker_stats():
+    """
+    :return: dict of "host:port/db" to the stats of every breaker of this process
+    """
+    return dict((breaker.name, breaker.stats()) for breaker in list(_breakers.values()))
+
+
+@register_after_fork
+def reset_breakers():
+    global _breakers_lock
+    _breakers_lock = threading.Lock()
+    for breaker in list(_breakers.values()):
+        breaker.after_fork()
+
+
+@atexit.register
+def stop_health_checks():
+    """
+    Stops the health check threads of every breaker, run at exit so they do not wake up mid-teardown.
+    """
+    for breaker in list(_breakers.values()):
+        breaker.stop_health_check()
@@ -4,12 +4,23 @@ Created on May 11, 2016
 
 @author: Venkata Mulam
 """
-from functools import wraps
+from functools import partial, wraps
 import json
-import hashlib
+import os
 import redis
 import logging
 import time as timer
+from connection_pool import get_connection
+from fanout import FanOut, DEFAULT_MGET_CHUNK, DEFAULT_FANOUT_THREADS
+from prefork import after_fork
+from generations import Generations, DEFAULT_REFRESH_INTERVAL
+from keyspace import iter_keys, iter_batches, unlink_keys, DEFAULT_SCAN_COUNT, DEFAULT_DELETE_BATCH
+from key_builder import KeyBuilder, digest
+from local_cache import MISSING
+from metrics import get_metrics, clock
+from serializers import get_serializer, is_encoded, DEFAULT_CODEC, DEFAULT_COMPRESSION, DEFAULT_COMPRESS_THRESHOLD
+from single_flight import SingleFlight, RedisLock, fetch_or_compute, REFRESH_SUFFIX
+from refresh import make_entry, is_entry, should_refresh, get_refresher
 try:
     import cPickle as pickle
 except:
@@ -17,6 +28,38 @@ except:
 
 DEFAULT_EXPIRY = 60 * 60 * 24
 
+try:
+    basestring
+except NameError:  # Python 3
+    basestring = unicode = str
+
+# Stores a value, records it in the recency index and evicts the least recently
+# used overflow, all atomically. At most ARGV[7] keys are evicted per call so
+# write latency stays bounded however far over the limit the index is; every
+# write adds one key at most, so the index still converges back to the limit.
+# KEYS[1] = value key, KEYS[2] = recency sorted set
+# ARGV = value, ttl (<= 0 for none), member, now (ms), limit, key prefix, max evictions
+LRU_SET_SCRIPT = """
+local ttl = tonumber(ARGV[2])
+if ttl > 0 then
+    redis.call('SETEX', KEYS[1], ttl, ARGV[1])
+else
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+redis.call('ZADD', KEYS[2], ARGV[4], ARGV[3])
+local over = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[5])
+if over <= 0 then
+    return 0
+end
+over = math.min(over, tonumber(ARGV[7]))
+local victims = redis.call('ZRANGE', KEYS[2], 0, over - 1)
+for _, member in ipairs(victims) do
+    redis.call('DEL', ARGV[6] .. member)
+end
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, over - 1)
+return over
+"""
+
 
 class CacheMissException(Exception):
     pass
@@ -47,33 +90,35 @@ class RedisConnect(object):
     This makes the MIO Cache class a little more flexible, for cases
     where redis connection configuration needs customizing.
     """
-    def __init__(self, host=None, port=None, db=None, password=None):
+    def __init__(self, host=None, port=None, db=None, password=None, max_connections=None, pool_timeout=None):
         self.host = host if host else 'localhost'
         self.port = port if port else 6379
         self.db = db if db else 0
         self.password = password
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
 
     def connect(self):
         """
         We cannot assume that connection will succeed, as such we use a ping()
         method in the redis client library to validate ability to contact redis.
         RedisNoConnException is raised if we fail to ping.
+        The returned client is backed by the connection pool shared by every
+        cache talking to the same server.
         :return: redis.StrictRedis Connection Object
         """
+        connection = get_connection(self.host, self.port, self.db, self.password,
+                                    max_connections=self.max_connections, timeout=self.pool_timeout)
         try:
-            redis.StrictRedis(host=self.host, port=self.port, password=self.password).ping()
+            connection.ping()
         except redis.ConnectionError:
             raise RedisNoConnException("Failed to create connection to redis",
                                        (self.host,
                                         self.port)
                                        )
-        return redis.StrictRedis(host=self.host,
-                                 port=self.port,
-                                 db=self.db,
-                                 password=self.password)
+        return connection
 
 class MIOCache(object):
-    connection = None
     def __init__(self,
                  limit=10000,
                  expire=DEFAULT_EXPIRY,
@@ -82,7 +127,21 @@ class MIOCache(object):
                  port=None,
                  db=None,
                  password=None,
-                 namespace='MIOCache'):
+                 namespace='MIOCache',
+                 max_connections=None,
+                 pool_timeout=None,
+                 codec=DEFAULT_CODEC,
+                 compression=DEFAULT_COMPRESSION,
+                 compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+                 scan_count=DEFAULT_SCAN_COUNT,
+                 delete_batch=DEFAULT_DELETE_BATCH,
+                 lru=False,
+                 evict_batch=16,
+                 metrics=None,
+                 versioned=False,
+                 generation_refresh=DEFAULT_REFRESH_INTERVAL,
+                 mget_chunk=DEFAULT_MGET_CHUNK,
+                 fanout_threads=DEFAULT_FANOUT_THREADS):
 
         self.limit = limit  # No of json encoded strings to cache
         self.expire = expire  # Time to keys to expire in seconds
@@ -90,19 +149,80 @@ class MIOCache(object):
         self.host = host
         self.port = port
         self.db = db
-
-        try:
-            self.connection = RedisConnect(host=self.host,
-                                           port=self.port,
-                                           db=self.db,
-                                           password=password).connect()
-        except RedisNoConnException:
-            self.connection = None
-            pass
+        self.redis_connect = RedisConnect(host=self.host,
+                                          port=self.port,
+                                          db=self.db,
+                                          password=password,
+                                          max_connections=max_connections,
+                                          pool_timeout=pool_timeout)
+
+        # Connected on first use, see the connection property, by the process which uses it.
+        self._connection = None
+        self._connected = False
+        self._pid = os.getpid()
 
         # Should we hash keys? There is a very small risk of collision involved.
         self.hashkeys = hashkeys
 
+        # Values are encoded with codec and compressed once they reach compress_threshold bytes
+        self.serializer = get_serializer(codec, compression, compress_threshold)
+
+        # Namespace operations SCAN scan_count keys per page and unlink at most delete_batch per round trip
+        self.scan_count = scan_count
+        self.delete_batch = delete_batch
+
+        # In lru mode keys are indexed in a sorted set scored by last access time, and
+        # set() evicts the least recently used ones (at most evict_batch per call) atomically.
+        self.lru = lru
+        self.evict_batch = evict_batch
+        self._lru_set = None
+
+        # Hits, misses, latencies and sizes are recorded to the metrics registry, labelled by namespace
+        self.metrics_registry = metrics or get_metrics()
+        self.metrics = self.metrics_registry.series(namespace)
+
+        # In versioned mode keys carry the generation of their namespace, read again every
+        # generation_refresh seconds, and expire_namespace is a single INCR, see generations.
+        self.generations = Generations(lambda: self.connection, generation_refresh) if versioned else None
+
+        # mget and set_many split more than mget_chunk keys into chunks sent over fanout_threads
+        # pooled connections at once, see fanout.
+        self.fanout = FanOut(mget_chunk, fanout_threads)
+
+    @property
+    def connection(self):
+        """
+        redis.StrictRedis client, connected (and pinged) on first use so creating
+        a cache at import time costs no round trip. None if redis was unreachable.
+        """
+        if self._pid != os.getpid():
+            self.after_fork()
+        if not self._connected:
+            try:
+                self._connection = self.redis_connect.connect()
+            except RedisNoConnException:
+                self._connection = None
+            self._connected = True
+        return self._connection
+
+    @connection.setter
+    def connection(self, connection):
+        self._connection = connection
+        self._connected = True
+
+    def after_fork(self):
+        """
+        Forgets the connection inherited from the parent process, a new one is made on next use.
+        """
+        after_fork()
+        self._pid = os.getpid()
+        self._connection = None
+        self._connected = False
+        self._lru_set = None
+        self.fanout.after_fork()
+        if self.generations is not None:
+            self.generations.after_fork()
+
     def get_default_cache(self,
                  limit=10000,
                  expire=DEFAULT_EXPIRY,
@@ -114,29 +234,79 @@ class MIOCache(object):
         pass
 
     def make_key(self, key):
+        if self.generations is not None:
+            return "{0}:{1}".format(self.generations.namespace(self.prefix), key)
         return "{0}:{1}".format(self.prefix, key)
 
     def namespace_key(self, namespace):
         return namespace + ':*'
 
     def get_set_name(self):
+        if self.lru:
+            return "{0}-lru".format(self.prefix)
         return "{0}-keys".format(self.prefix)
 
-    def get(self, key):
+    def forget(self, client, *keys):
+        """
+        Removes keys from the key index of this cache.
+        :param client: connection or pipeline to issue the command on
+        """
+        if self.lru:
+            client.zrem(self.get_set_name(), *keys)
+        else:
+            client.srem(self.get_set_name(), *keys)
+
+    def touch(self, client, *keys):
+        """
+        Marks keys as just used in lru mode, without re-adding evicted ones.
+        """
+        if self.lru and keys:
+            now = int(timer.time() * 1000)
+            client.zadd(self.get_set_name(), dict((key, now) for key in keys), xx=True)
+
+    def get_raw(self, key, metrics=None):
+        """
+        :param metrics: metrics.Series to record the lookup to, the one of this cache by default
+        :return: the stored bytes of key, raising CacheMissException or ExpiredKeyException when absent
+        """
         key = to_unicode(key)
         if key:  # No need to validate membership, which is an O(1) operation, but seems we can do without.
-            start = timer.time()
-            value = self.connection.get(self.make_key(key))
+            metrics = metrics or self.metrics
+            start = clock()
+            if self.lru:
+                pipe = self.connection.pipeline(transaction=False)
+                pipe.get(self.make_key(key))
+                self.touch(pipe, key)
+                value = pipe.execute()[0]
+            else:
+                value = self.connection.get(self.make_key(key))
+            network = clock() - start
             if value is None:  # expired key
+                metrics.read(0, 1, network)
                 if key not in self:  # If key does not exist at all, it is a straight miss.
-                    print "key not found"
                     raise CacheMissException
 
-                self.connection.srem(self.get_set_name(), key)
+                self.forget(self.connection, key)
                 raise ExpiredKeyException
             else:
-                print "Cache took {0} to retrieve data from the Redis Server".format(float(timer.time() - start))
-                return pickle.loads(value)
+                # Counted as a hit once decoded, see decode().
+                metrics.read(0, 0, network, None, len(value))
+                return value
+
+    def decode(self, value, loads=None, metrics=None):
+        """
+        Deserializes bytes returned by get_raw and records the hit.
+        :param loads: loader to use instead of the serializer of this cache
+        """
+        start = clock()
+        value = (loads or self.serializer.loads)(value)
+        (metrics or self.metrics).read(1, 0, None, clock() - start)
+        return value
+
+    def get(self, key):
+        value = self.get_raw(key)
+        if value is not None:
+            return self.decode(value)
 
     def mget(self, keys):
         """
@@ -145,17 +315,26 @@ class MIOCache(object):
         :return: dict of found key/values
         """
         if keys:
-            cache_keys = [self.make_key(to_unicode(key)) for key in keys]
-            values = self.connection.mget(cache_keys)
-
-            if None in values:
+            keys = [to_unicode(key) for key in keys]
+            cache_keys = [self.make_key(key) for key in keys]
+            start = clock()
+            connection = self.connection
+            values = [value for chunk in self.fanout.map(connection.mget, cache_keys) for value in chunk]
+            network = clock() - start
+
+            if None in values or self.lru:
                 pipe = self.connection.pipeline()
-                for cache_key, value in zip(cache_keys, values):
-                    if value is None:  # non-existant or expired key
-                        pipe.srem(self.get_set_name(), cache_key)
+                missing = [key for key, value in zip(keys, values) if value is None]  # non-existant or expired
+                if missing:
+                    self.forget(pipe, *missing)
+                self.touch(pipe, *[key for key, value in zip(keys, values) if value is not None])
                 pipe.execute()
 
-            return {k: v for (k, v) in zip(keys, values) if v is not None}
+            start = clock()
+            found = {k: self.serializer.loads(v) for (k, v) in zip(keys, values) if v is not None}
+            self.metrics.read(len(found), len(values) - len(found), network, clock() - start,
+                              sum(len(v) for v in values if v is not None))
+            return found
 
     def mget_json(self, keys):
         """
@@ -167,29 +346,47 @@ class MIOCache(object):
         d = self.mget(keys)
         if d:
             for key in d.keys():
-                d[key] = json.loads(d[key]) if d[key] else None
+                # Values stored before codecs existed come back as JSON text.
+                if isinstance(d[key], basestring):
+                    try:
+                        d[key] = json.loads(d[key])
+                    except ValueError:
+                        pass
             return d
 
-    def set(self, key, value, expire=None):
+    def set(self, key, value, expire=None, codec=None, metrics=None):
         """
         Method stores a value after checking for space constraints and
         freeing up space if required.
         :param key: key by which to reference datum being stored in Redis
         :param value: actual value being stored under this key
         :param expire: time-to-live (ttl) for this datum
+        :param codec: codec to encode the value with, defaults to the one of this cache
+        :param metrics: metrics.Series to record the write to, the one of this cache by default
         """
         key = to_unicode(key)
-        value = pickle.dumps(value)
+        start = clock()
+        value = self.serializer_for(codec).dumps(value)
+        encoded = clock()
         set_name = self.get_set_name()
+        if expire is None:
+            expire = self.expire
+
+        if self.lru:
+            if self._lru_set is None:
+                self._lru_set = self.connection.register_script(LRU_SET_SCRIPT)
+            ttl = expire if isinstance(expire, int) and expire > 0 else 0
+            self._lru_set(keys=[self.make_key(key), set_name],
+                          args=[value, ttl, key, int(timer.time() * 1000), self.limit, self.make_key(''),
+                                self.evict_batch])
+            (metrics or self.metrics).write(clock() - encoded, encoded - start, len(value))
+            return
 
         while self.connection.scard(set_name) >= self.limit:
-            del_key = self.connection.spop(set_name)
+            del_key = decode_key(self.connection.spop(set_name))
             self.connection.delete(self.make_key(del_key))
 
         pipe = self.connection.pipeline()
-        if expire is None:
-            expire = self.expire
-
         if (isinstance(expire, int) and expire <= 0) or (expire is None):
             pipe.set(self.make_key(key), value)
         else:
@@ -197,6 +394,56 @@ class MIOCache(object):
 
         pipe.sadd(set_name, key)
         pipe.execute()
+        (metrics or self.metrics).write(clock() - encoded, encoded - start, len(value))
+
+    def set_many(self, mapping, expire=None):
+        """
+        Method stores every key/value of mapping with the same expiration, in pipelines of at
+        most mget_chunk keys sent in parallel, then evicts the keys over the limit.
+        :param mapping: dict of key to value
+        :param expire: time-to-live (ttl) of every value
+        """
+        items = [(to_unicode(key), value) for key, value in mapping.items()]
+        if not items:
+            return
+        set_name = self.get_set_name()
+        if expire is None:
+            expire = self.expire
+        ttl = expire if isinstance(expire, int) and expire > 0 else 0
+        connection = self.connection
+        if self.lru and self._lru_set is None:
+            self._lru_set = connection.register_script(LRU_SET_SCRIPT)
+
+        def send(chunk):
+            start = clock()
+            encoded = [(key, self.serializer.dumps(value)) for key, value in chunk]
+            sent = clock()
+            pipe = connection.pipeline()
+            if self.lru:
+                now = int(timer.time() * 1000)
+                for key, value in encoded:
+                    self._lru_set(keys=[self.make_key(key), set_name],
+                                  args=[value, ttl, key, now, self.limit, self.make_key(''), self.evict_batch],
+                                  client=pipe)
+            else:
+                for key, value in encoded:
+                    if ttl:
+                        pipe.setex(self.make_key(key), ttl, value)
+                    else:
+                        pipe.set(self.make_key(key), value)
+                pipe.sadd(set_name, *[key for key, _ in encoded])
+            pipe.execute()
+            return clock() - sent, sent - start, sum(len(value) for _, value in encoded)
+
+        results = self.fanout.map(send, items)
+        if not self.lru:
+            over = connection.scard(set_name) - self.limit
+            if over > 0:
+                victims = connection.spop(set_name, over)
+                unlink_keys(connection, [self.make_key(decode_key(victim)) for victim in victims],
+                            self.delete_batch)
+        self.metrics.write(sum(result[0] for result in results), sum(result[1] for result in results),
+                           sum(result[2] for result in results), len(items))
 
     def delete(self, key):
         """
@@ -205,7 +452,7 @@ class MIOCache(object):
         """
         key = to_unicode(key)
         pipe = self.connection.pipeline()
-        pipe.srem(self.get_set_name(), key)
+        self.forget(pipe, key)
         pipe.delete(self.make_key(key))
         pipe.execute()
 
@@ -216,16 +463,25 @@ class MIOCache(object):
             pipe.delete(*keys)
             pipe.execute()
 
-    def delete_namespace(self, space):
+    def delete_namespace(self, space, progress=None):
+        """
+        Method removes all keys in a namespace, walking it with SCAN and
+        unlinking the keys in batches. Keys belonging to this cache are also
+        dropped from its key set.
+        :param progress: optional callable receiving the number of keys deleted so far
+        :return: number of keys deleted
+        """
         namespace = self.namespace_key(space)
-        setname = self.get_set_name()
-        keys = list(self.connection.keys(namespace))
-        # self.connection.delete(keys)
-        with self.connection.pipeline() as pipe:
-            if keys:
-                pipe.delete(*keys)
-                pipe.srem(setname, *space)
-                pipe.execute()
+        prefix = self.make_key('')
+        deleted = 0
+        for keys in iter_batches(iter_keys(self.connection, namespace, self.scan_count), self.delete_batch):
+            deleted += unlink_keys(self.connection, keys, self.delete_batch)
+            members = [k[len(prefix):] for k in map(decode_key, keys) if k.startswith(prefix)]
+            if members:
+                self.forget(self.connection, *members)
+            if progress is not None:
+                progress(deleted)
+        return deleted
 
     def isexpired(self, key):
         """
@@ -242,7 +498,7 @@ class MIOCache(object):
         if not ttl:
             return ttl
         else:
-            return self.connection.pttl("{0}:{1}".format(self.prefix, key))
+            return self.connection.pttl(self.make_key(key))
 
     def expire_all_in_set(self):
         """
@@ -264,7 +520,7 @@ class MIOCache(object):
 
         return len(self), len(all_members)
 
-    def expire_namespace(self, namespace):
+    def expire_namespace(self, namespace, progress=None):
         """
         Method expires all keys in the namespace of this object.
         At times there is  a need to delete cache in bulk, because a
@@ -275,58 +531,93 @@ class MIOCache(object):
         keys successfully expired.
         :return: int, int
         """
-        namespace = self.namespace_key(namespace)
-        all_members = list(self.connection.keys(namespace))
-        with self.connection.pipeline() as pipe:
-            pipe.delete(*all_members)
-            pipe.execute()
-
-        return len(self), len(all_members)
-
-    def store_json(self, key, value, expire=None):
-        self.set(key, json.dumps(value), expire)
-
-    def store_pickle(self, key, value, expire=None):
-        self.set(key, pickle.dumps(value), expire)
-
-    def get_json(self, key):
-        return json.loads(self.get(key))
-
-    def get_pickle(self, key):
-        return pickle.loads(self.get(key))
+        if self.generations is not None and namespace == self.prefix:
+            # Keys of the old generation age out through their TTL; only the key set has to go.
+            # Other namespaces carry no generation in their keys, see make_key, and are deleted.
+            self.generations.bump(namespace)
+            self.connection.unlink(self.get_set_name())
+            return len(self), 0
+        expired = self.delete_namespace(namespace, progress)
+        return len(self), expired
+
+    def serializer_for(self, codec=None):
+        if codec is None or codec == self.serializer.codec:
+            return self.serializer
+        return get_serializer(codec, self.serializer.compression, self.serializer.compress_threshold)
+
+    def store_json(self, key, value, expire=None, metrics=None):
+        self.set(key, value, expire, codec='json', metrics=metrics)
+
+    def store_pickle(self, key, value, expire=None, metrics=None):
+        self.set(key, value, expire, codec='pickle', metrics=metrics)
+
+    def get_json(self, key, metrics=None):
+        value = self.get_raw(key, metrics)
+        if is_encoded(value):
+            return self.decode(value, metrics=metrics)
+        # Written before codecs existed: JSON text, pickled by set.
+        return self.decode(value, lambda data: json.loads(pickle.loads(data)), metrics)
+
+    def get_pickle(self, key, metrics=None):
+        value = self.get_raw(key, metrics)
+        if is_encoded(value):
+            return self.decode(value, metrics=metrics)
+        # Written before codecs existed: pickled by store_pickle, then again by set.
+        return self.decode(value, lambda data: pickle.loads(pickle.loads(data)), metrics)
 
     def __contains__(self, key):
+        if self.lru:
+            return self.connection.zscore(self.get_set_name(), key) is not None
         return self.connection.sismember(self.get_set_name(), key)
 
     def __iter__(self):
         if not self.connection:
             return iter([])
         return iter(
-            ["{0}:{1}".format(self.prefix, x)
-                for x in self.connection.smembers(self.get_set_name())
+            [self.make_key(x)
+                for x in self.keys()
             ])
 
     def __len__(self):
+        if self.lru:
+            return self.connection.zcard(self.get_set_name())
         return self.connection.scard(self.get_set_name())
 
     def keys(self):
-        return self.connection.smembers(self.get_set_name())
+        if self.lru:
+            members = self.connection.zrange(self.get_set_name(), 0, -1)
+        else:
+            members = self.connection.smembers(self.get_set_name())
+        return [decode_key(member) for member in members]
 
     def get_hash(self, args):
         if self.hashkeys:
-            key = hashlib.md5(args).hexdigest()
+            key = digest(args)
         else:
             key = pickle.dumps(args)
         return key
 
 
 def cache_it(limit=10000, expire=DEFAULT_EXPIRY, cache=None,
-             use_json=False, namespace=None, view=True):
+             use_json=False, namespace=None, view=True,
+             single_flight=False, lock_timeout=10000, lock_wait=5,
+             stale_ttl=0, early_refresh=False, beta=1.0, codec=None, version=None):
     """
     Arguments and function result must be pickleable.
     :param limit: maximum number of keys to maintain in the set
     :param expire: period after which an entry in cache is considered expired
     :param cache: SimpleCache object, if created separately
+    :param single_flight: on a miss, let only one caller recompute the value; concurrent callers in this
+                          process share its result and other processes wait on a short redis lock
+    :param lock_timeout: milliseconds after which an abandoned recompute lock frees itself
+    :param lock_wait: seconds other processes wait for the fresh value before computing it themselves
+    :param stale_ttl: seconds an expired value is still served while it is recomputed in the background
+    :param early_refresh: refresh values in the background shortly before they expire (XFetch),
+                          the earlier the longer the function takes to compute
+    :param beta: XFetch weight, above 1 refreshes earlier and below 1 later
+    :param codec: serializer for the results ('pickle', 'json', 'msgpack' or 'orjson'),
+                  defaults to json when use_json is set and pickle otherwise
+    :param version: part of every key of the function, change it to drop all its cached results at once
     :return: decorated function
     """
     cache_ = cache    # Since python 2.x doesn't have the nonlocal keyword, we need to do this
@@ -343,6 +634,11 @@ def cache_it(limit=10000, expire=DEFAULT_EXPIRY, cache=None,
             # If the expire arg value is the default, set it to None so we set
             # the expire value of the passed cache object
             expire = None
+        flight = SingleFlight()
+        metrics = cache.metrics_registry.series(cache.prefix, function.__name__)
+        keys = KeyBuilder(None, function.__name__, version=version, hashed=cache.hashkeys)
+        logical_expire = cache.expire if expire is None else expire
+        swr = bool(logical_expire and logical_expire > 0 and (stale_ttl or early_refresh))
 
         @wraps(function)
         def func(*args, **kwargs):
@@ -351,41 +647,76 @@ def cache_it(limit=10000, expire=DEFAULT_EXPIRY, cache=None,
                 result = function(*args, **kwargs)
                 return result
 
-            serializer = json if use_json else pickle
-            fetcher = cache.get_json if use_json else cache.get_pickle
-            # This way, you need to make sure all args must be json or pcikle serializable.
-            storer = cache.store_json if use_json else cache.store_pickle
+            fetcher = partial(cache.get_json if use_json else cache.get_pickle, metrics=metrics)
+            storer = partial(cache.store_json if use_json else cache.store_pickle, metrics=metrics)
+            if codec is not None:
+                storer = partial(cache.set, codec=codec, metrics=metrics)
 
-            # Key will be either a md5 hash or just pickle object,
+            # Key will be either a digest or the canonical encoding of the arguments,
             # in the form of `function name`:`key`
-            key = cache.get_hash(serializer.dumps([args, kwargs]))
-            cache_key = '{func_name}:{key}'.format(func_name=function.__name__, key=key)
+            cache_key = '{func_name}:{key}'.format(func_name=function.__name__, key=keys.key(args, kwargs))
 
-            try:
+            def fetch():
+                try:
+                    return fetcher(cache_key)
+
+                except (ExpiredKeyException, CacheMissException) as e:
+                    # Add some sort of cache miss handing here.
+                    pass
+                except:
+                    metrics.error()
+                    logging.exception("Unknown redis-cache error. Please check your Redis free space.")
+                return MISSING
+
+            def compute():
                 start = timer.time()
-                result = fetcher(cache_key)
-                print "Cache took {0} to retireve data from the Redis Server".format(float(timer.time() - start))
+                try:
+                    result = function(*args, **kwargs)
+                except DoNotCache as e:
+                    result = e.result
+                else:
+                    try:
+                        if swr:
+                            entry = make_entry(result, timer.time() - start, logical_expire)
+                            storer(cache_key, entry, logical_expire + stale_ttl)
+                        else:
+                            storer(cache_key, result, expire)
+                    except redis.ConnectionError as e:
+                        logging.exception(e)
+
                 return result
 
-            except (ExpiredKeyException, CacheMissException) as e:
-                # Add some sort of cache miss handing here.
-                pass
-            except:
-                logging.exception("Unknown redis-cache error. Please check your Redis free space.")
+            def refresh():
+                # Only one process refreshes a given entry, the others keep serving the current one.
+                lock = RedisLock(cache.connection, cache.make_key(cache_key) + REFRESH_SUFFIX, lock_timeout)
+                if lock.acquire():
+                    try:
+                        compute()
+                    finally:
+                        lock.release()
+
+            def fetch_value():
+                result = fetch()
+                if swr and result is not MISSING:
+                    return result[0] if is_entry(result) else MISSING
+                return result
 
-            try:
-                result = function(*args, **kwargs)
-            except DoNotCache as e:
-                result = e.result
-            else:
-                try:
-                    start = timer.time()
-                    storer(cache_key, result, expire)
-                    print "Cache took {0} to set data from the Redis Server".format(float(timer.time() - start))
-                except redis.ConnectionError as e:
-                    logging.exception(e)
+            result = fetch()
+            if swr and result is not MISSING:
+                if not is_entry(result):
+                    result = MISSING  # written before stale_ttl/early_refresh was turned on
+                else:
+                    value, delta, expiry = result
+                    if timer.time() >= expiry or (early_refresh and should_refresh(delta, expiry, beta)):
+                        get_refresher().submit(cache_key, refresh)
+                    return value
+            if result is not MISSING:
+                return result
 
-            return result
+            if single_flight:
+                return flight.do(cache_key, fetch_or_compute, cache.connection, cache.make_key(cache_key),
+                                 fetch_value, compute, lock_timeout=lock_timeout, lock_wait=lock_wait)
+            return compute()
         return func
     return decorator
 
@@ -409,8 +740,15 @@ def to_unicode(obj, encoding='utf-8'):
     return obj
 
 
+def decode_key(key, encoding='utf-8'):
+    """
+    :return: key as text, for keys and set members read back from redis, which are bytes on Python 3
+    """
+    return to_unicode(key.decode(encoding) if isinstance(key, bytes) else key)
+
+
 def get_default_cache():
     return RedisConnect.connect()
 
-# Other way to just import MIOCache and use it.
+# Other way to just import MIOCache and use it. It connects on its first command.
 my_cache = MIOCache()
@@ -0,0 +1,133 @@
+"""
+Process-wide registry of redis connection pools.
+
+Every MyCache, MIOCache and RedisConnect pointing at the same host/port/db/password
+shares a single BlockingConnectionPool, so a process holds at most
+`max_connections` sockets per server no matter how many cache objects or
+decorated functions it creates. When the pool is exhausted callers block for up
+to `timeout` seconds waiting for a connection to be released.
+"""
+import threading
+import time
+import redis
+from prefork import register_after_fork
+
+DEFAULT_MAX_CONNECTIONS = 50
+DEFAULT_POOL_TIMEOUT = 20
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    """
+    BlockingConnectionPool which keeps track of how connections are used and
+    how long callers wait to get one.
+    """
+    def reset(self):
+        self._stats_lock = threading.Lock()
+        self.in_use = 0
+        self.acquired = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        super(InstrumentedConnectionPool, self).reset()
+
+    def get_connection(self, *args, **options):
+        # redis-py 5+ no longer passes the command name, older versions require it.
+        start = time.time()
+        connection = super(InstrumentedConnectionPool, self).get_connection(*args, **options)
+        waited = time.time() - start
+        with self._stats_lock:
+            self.in_use += 1
+            self.acquired += 1
+            self.wait_time += waited
+            if waited > self.max_wait_time:
+                self.max_wait_time = waited
+            # Anything above a millisecond means we sat in the queue or had to dial a new socket.
+            if waited > 0.001:
+                self.waits += 1
+        return connection
+
+    def release(self, connection):
+        if connection.pid == self.pid:
+            with self._stats_lock:
+                self.in_use = max(self.in_use - 1, 0)
+        super(InstrumentedConnectionPool, self).release(connection)
+
+    def stats(self):
+        """
+        :return: dict describing current pool usage and accumulated wait times
+        """
+        with self._stats_lock:
+            created = len(self._connections)
+            return {'max_connections': self.max_connections,
+                    'created': created,
+                    'in_use': self.in_use,
+                    'idle': max(created - self.in_use, 0),
+                    'acquired': self.acquired,
+                    'waits': self.waits,
+                    'wait_time': self.wait_time,
+                    'max_wait_time': self.max_wait_time,
+                    'avg_wait_time': self.wait_time / self.acquired if self.acquired else 0.0}
+
+
+def pool_key(host, port, db, password):
+    return (host or 'localhost', int(port or 6379), int(db or 0), password or None)
+
+
+def get_pool(host=None, port=None, db=None, password=None, max_connections=None, timeout=None):
+    """
+    Returns the shared pool for the given server, creating it on first use.
+    max_connections and timeout only apply when the pool is created; later
+    callers get the existing pool as it is.
+    :return: InstrumentedConnectionPool
+    """
+    key = pool_key(host, port, db, password)
+    pool = _pools.get(key)
+    if pool is not None:
+        return pool
+
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = InstrumentedConnectionPool(host=key[0], port=key[1], db=key[2], password=key[3],
+                                              max_connections=max_connections or DEFAULT_MAX_CONNECTIONS,
+                                              timeout=DEFAULT_POOL_TIMEOUT if timeout is None else timeout)
+            _pools[key] = pool
+    return pool
+
+
+def get_connection(host=None, port=None, db=None, password=None, max_connections=None, timeout=None):
+    """
+    :return: redis.StrictRedis client backed by the shared pool for the given server
+    """
+    return redis.StrictRedis(connection_pool=get_pool(host, port, db, password, max_connections, timeout))
+
+
+def pool_stats():
+    """
+    :return: dict of "host:port/db" to the stats of every pool created by this process
+    """
+    return dict(("{0}:{1}/{2}".format(*key[:3]), pool.stats()) for key, pool in list(_pools.items()))
+
+
+@register_after_fork
+def forget_pools():
+    """
+    Drops the pools inherited from the parent process without closing their sockets, which the
+    parent still uses; new pools are created on first use.
+    """
+    global _pools_lock
+    _pools_lock = threading.Lock()
+    _pools.clear()
+
+
+def disconnect_all():
+    """
+    Closes every socket held by the registered pools and forgets them.
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.disconnect()
+        _pools.clear()
@@ -0,0 +1,123 @@
+"""
+Parallel fan-out of very large multi-key reads and writes.
+
+A single MGET of 50k keys makes Redis build one huge reply while every other
+client waits, and decoding it runs on one core. FanOut splits the keys into
+chunks of chunk_size and runs the chunks on a small thread pool, each on its own
+pooled connection (or replica), so Redis serves other clients between chunks
+and the replies come back concurrently. Every chunk is decoded by the thread
+which fetched it, which already overlaps decompression (zlib, lz4 and zstd
+release the GIL). With decode_processes, the decoding of chunks carrying at
+least decode_threshold bytes goes to a process pool instead, for CPU-bound
+codecs; its results are pickled back, so it only pays off for payloads which
+are expensive to decode.
+"""
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import threading
+from large_values import is_manifest
+from local_cache import MISSING
+from prefork import register_after_fork
+from serializers import get_serializer
+
+DEFAULT_MGET_CHUNK = 1000
+DEFAULT_FANOUT_THREADS = 4
+DEFAULT_DECODE_THRESHOLD = 4 * 1024 * 1024
+
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+
+
+def chunked(items, size):
+    """
+    :return: list of consecutive slices of items holding at most size items
+    """
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def decode_values(values, serializer=None, skip=None):
+    """
+    :param skip: predicate of raw values which are returned undecoded, ex. large value manifests
+    :return: decoded values, MISSING for missing keys
+    """
+    serializer = serializer or get_serializer()
+    return [MISSING if value is None else value if skip is not None and skip(value) else serializer.loads(value)
+            for value in values]
+
+
+def _decode_in_process(values):
+    # Runs in a decode process, where any Serializer decodes values of every codec; the caller
+    # tells missing and skipped values apart by their raw value.
+    serializer = get_serializer()
+    return [None if value is None or is_manifest(value) else serializer.loads(value) for value in values]
+
+
+def get_process_pool(processes):
+    pool = _process_pools.get(processes)
+    if pool is None:
+        with _process_pools_lock:
+            pool = _process_pools.get(processes)
+            if pool is None:
+                pool = _process_pools[processes] = multiprocessing.Pool(processes)
+    return pool
+
+
+@register_after_fork
+def forget_process_pools():
+    # The decode processes belong to the parent, which also terminates them.
+    global _process_pools_lock
+    _process_pools_lock = threading.Lock()
+    _process_pools.clear()
+
+
+class FanOut(object):
+    """
+    :param chunk_size: max keys per MGET or pipeline, None disables splitting
+    :param threads: chunks running at the same time
+    :param decode_processes: size of the process pool decoding big chunks, 0 decodes in the fetching thread
+    :param decode_threshold: bytes in a chunk from which it is decoded in the process pool
+    """
+    def __init__(self, chunk_size=DEFAULT_MGET_CHUNK, threads=DEFAULT_FANOUT_THREADS, decode_processes=0,
+                 decode_threshold=DEFAULT_DECODE_THRESHOLD):
+        self.chunk_size = chunk_size
+        self.threads = threads
+        self.decode_processes = decode_processes
+        self.decode_threshold = decode_threshold
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def splits(self, count):
+        """
+        :return: True if count keys are split into several chunks
+        """
+        return bool(self.chunk_size) and count > self.chunk_size
+
+    def map(self, function, items):
+        """
+        :return: [function(chunk) for chunk in chunked(items)], the chunks running on the thread pool
+        """
+        chunks = chunked(items, self.chunk_size) if self.chunk_size else [items]
+        if len(chunks) <= 1 or self.threads <= 1:
+            return [function(chunk) for chunk in chunks]
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPool(self.threads)
+        return self._pool.map(function, chunks)
+
+    def decode(self, values, serializer, skip=None):
+        """
+        Decodes the raw values of one chunk, in the process pool when they are big enough.
+        :param skip: predicate of raw values which are returned undecoded
+        :return: decoded values, MISSING for missing keys
+        """
+        if self.decode_processes and \
+                sum(len(value) for value in values if value is not None) >= self.decode_threshold:
+            decoded = get_process_pool(self.decode_processes).apply(_decode_in_process, (values,))
+            return [MISSING if raw is None else raw if skip is not None and skip(raw) else value
+                    for raw, value in zip(values, decoded)]
+        return decode_values(values, serializer, skip)
+
+    def after_fork(self):
+        self._pool = None
+        self._lock = threading.Lock()
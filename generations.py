@@ -0,0 +1,85 @@
+"""
+Namespace generations: O(1) invalidation of every key of a namespace.
+
+In versioned mode the current generation of a namespace is part of its keys
+(namespace:g<generation>:...), read from a counter which is never deleted.
+Invalidating the namespace is a single INCR of that counter: later reads and
+writes use the next generation and the keys of older ones are never read
+again, ageing out through their TTL. Patterns like namespace:* still match
+every generation, so a full sweep remains possible.
+
+Generations are kept in process for refresh_interval seconds, so the counter
+costs one GET per namespace and interval instead of a round trip per command;
+other processes pick up an invalidation within that interval.
+"""
+import binascii
+import os
+import threading
+import time
+import redis
+
+DEFAULT_REFRESH_INTERVAL = 1.0
+
+
+def generation_key(namespace):
+    """
+    :return: key of the generation counter of namespace, outside of namespace:* on purpose so
+             that deleting the keys of the namespace never resets its generation
+    """
+    return 'generation:' + namespace
+
+
+def versioned(namespace, generation):
+    return '{0}:g{1}'.format(namespace, generation)
+
+
+class Generations(object):
+    """
+    :param connection: callable returning the redis client the counters live on
+    :param refresh_interval: seconds a generation read from redis is used before being read again
+    """
+    def __init__(self, connection, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self.connection = connection
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._known = {}  # namespace -> (generation, time it was read)
+
+    def get(self, namespace):
+        """
+        :return: current generation of namespace, 0 before its first invalidation
+        """
+        known = self._known.get(namespace)
+        now = time.time()
+        if known is not None and now - known[1] < self.refresh_interval:
+            return known[0]
+        try:
+            value = self.connection().get(generation_key(namespace))
+        except (redis.RedisError, AttributeError):
+            if known is None:
+                # Unknown generation: a key nobody reads, so the call is a miss rather than a possibly stale hit.
+                return 'x' + binascii.hexlify(os.urandom(8)).decode('ascii')
+            generation = known[0]  # keep the last one until redis answers again
+        else:
+            generation = int(value or 0)
+        with self._lock:
+            self._known[namespace] = (generation, now)
+        return generation
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def namespace(self, namespace):
+        """
+        :return: namespace with its current generation, as written in keys
+        """
+        return versioned(namespace, self.get(namespace))
+
+    def bump(self, namespace):
+        """
+        Invalidates every key of namespace in one INCR, seen at once by this process.
+        :return: the new generation
+        """
+        generation = self.connection().incr(generation_key(namespace))
+        with self._lock:
+            self._known[namespace] = (generation, time.time())
+        return generation
@@ -4,12 +4,16 @@ Created on May 11, 2016
 
 @author: Venkata Mulam
 """
+from collections import OrderedDict
 from functools import wraps
+import inspect
 import json
-import hashlib
 import redis
-from redis.exceptions import ConnectionError
+from redis.exceptions import ConnectionError, ReadOnlyError
+from redis.sentinel import Sentinel
 import logging
+import os
+import threading
 import time
 import time as timer
 try:
@@ -17,31 +21,70 @@ try:
 except:
     import pickle
 from settings import get_settings
+from batching import GetBatcher
+from circuit_breaker import get_breaker, jittered_backoff, DEFAULT_FAILURE_THRESHOLD, \
+    DEFAULT_HEALTH_CHECK_INTERVAL, DEFAULT_RETRY_BACKOFF
+from connection_pool import get_connection, pool_key
+from fanout import FanOut, decode_values, DEFAULT_MGET_CHUNK, DEFAULT_FANOUT_THREADS, DEFAULT_DECODE_THRESHOLD
+from prefork import after_fork
+from generations import Generations, DEFAULT_REFRESH_INTERVAL
+from large_values import chunking_supported, pickle_frames, split_frames, store_chunks, load_chunks, drop_chunks, \
+    chunks_of, is_manifest, is_chunk_key, read_manifest, DEFAULT_CHUNK_SIZE
+from keyspace import iter_keys, iter_batches, unlink_keys, DEFAULT_SCAN_COUNT, DEFAULT_DELETE_BATCH
+from key_builder import KeyBuilder, build_key, digest
+from local_cache import LocalCache, InvalidationListener, MISSING
+from metrics import get_metrics, clock
+from serializers import get_serializer, DEFAULT_CODEC, DEFAULT_COMPRESSION, DEFAULT_COMPRESS_THRESHOLD
+from replicas import ReplicaSet, ROUND_ROBIN
+from sharding import ShardedRedis, HashRing, ClusterSlots, node_name, parse_node, DEFAULT_SHARD_THREADS
+from write_behind import WriteBehindQueue
+from single_flight import SingleFlight, RedisLock, fetch_or_compute, is_lock_key, REFRESH_SUFFIX
+from tags import TagInvalidator, record_tags
+from refresh import make_entry, is_entry, should_refresh, get_refresher
+from client import DoNotCache
 
 DEFAULT_EXPIRY = 60 * 60 * 24
-env_settings = get_settings()
-REDIS_HOST = env_settings.REDIS_HOST
-REDIS_PORT = env_settings.REDIS_PORT
-REDIS_PASSWORD = env_settings.REDIS_PASSWORD
-REDIS_DB = env_settings.REDIS_DB
+# Read from the settings on first access instead of at import, see __getattr__.
+LAZY_SETTINGS = ('REDIS_HOST', 'REDIS_PORT', 'REDIS_PASSWORD', 'REDIS_DB')
+
+try:
+    basestring
+except NameError:  # Python 3
+    basestring = unicode = str
+
+
+def __getattr__(name):
+    # Importing this module does no I/O: settings (and the log files they set up)
+    # are loaded the first time env_settings or one of the REDIS_* values is used.
+    if name == 'env_settings':
+        return get_settings()
+    if name in LAZY_SETTINGS:
+        return getattr(get_settings(), name)
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+
+def warmup():
+    """
+    Loads settings, sets up logging and hashes the Lua scripts ahead of time, ex. in the
+    master process of a prefork server before it forks its workers. Opens no connection:
+    caches connect on their first command, in each worker. Pair it with after_fork() in
+    the post-fork hook of the server.
+    :return: the settings of the current environment
+    """
+    env_settings = get_settings()
+    client = get_connection(env_settings.REDIS_HOST, env_settings.REDIS_PORT, env_settings.REDIS_DB,
+                            env_settings.REDIS_PASSWORD)
+    RedisLock.load_script(client)
+    TagInvalidator.load_script(client)
+    return env_settings
 
 
 # create the cache key for storage
 def cache_create_key(namespace, ignore_args, func_name, *args, **kwargs):
-    import hashlib
-    serialise = []
-    if ignore_args:
-        serialise.append(str(args[0]))
-    else:
-        for arg in args:
-            serialise.append(str(arg))
-        for key, arg in kwargs.items():
-            serialise.append(str(key))
-            serialise.append(str(arg))
-    key = hashlib.md5("".join(serialise)).hexdigest()
-    if namespace:
-        key = ':'.join([namespace, func_name, key])
-    return key
+    """
+    :return: namespace:func_name:digest of the canonical encoding of the arguments, see key_builder
+    """
+    return build_key(namespace, ignore_args, func_name, args, kwargs)
 
 
 class MyCache(redis.client.Redis):
@@ -53,6 +96,7 @@ class MyCache(redis.client.Redis):
         # Save them for re connection purposes
         self.args = args
         self.kwargs = kwargs
+        env_settings = get_settings()
 
         # conn_retries is the number of times that reconnect will try to connect
         if 'conn_retries' in kwargs:
@@ -60,12 +104,30 @@ class MyCache(redis.client.Redis):
         else:
             self.conn_retries = 1
 
-        # max_sleep is the amount of time between reconnection attempts by safe_reconnect
+        # max_sleep is the max amount of time between reconnection attempts, retry_backoff the first one
         if 'max_sleep' in kwargs:
             self.max_sleep = kwargs.pop('max_sleep')
         else:
             self.max_sleep = 30
 
+        if 'retry_backoff' in kwargs:
+            self.retry_backoff = kwargs.pop('retry_backoff')
+        else:
+            self.retry_backoff = DEFAULT_RETRY_BACKOFF
+
+        # failure_threshold consecutive connection errors open the circuit, after which calls skip redis
+        # until a background health check (every health_check_interval seconds, None disables it) or a
+        # probing call succeeds
+        if 'failure_threshold' in kwargs:
+            failure_threshold = kwargs.pop('failure_threshold')
+        else:
+            failure_threshold = DEFAULT_FAILURE_THRESHOLD
+
+        if 'health_check_interval' in kwargs:
+            health_check_interval = kwargs.pop('health_check_interval')
+        else:
+            health_check_interval = DEFAULT_HEALTH_CHECK_INTERVAL
+
         if 'log' in kwargs:
             self._log = kwargs.pop('log')
         else:
@@ -76,17 +138,372 @@ class MyCache(redis.client.Redis):
         else:
             self.prefix = None
 
+        # hashkeys False puts the readable argument encoding in cache_it keys instead of its digest
         if 'hashkeys' in kwargs:
-            self.prefix = kwargs.pop('hashkeys')
+            self.hashkeys = kwargs.pop('hashkeys')
         else:
             self.hashkeys = True
 
-        self.host = kwargs.get('host', REDIS_HOST)
-        self.port = kwargs.get('port', REDIS_PORT)
-        self.db = kwargs.get('db', REDIS_DB)
-        self.password = kwargs.get('password', REDIS_PASSWORD)
+        # local_cache is the max number of unpickled values kept in the in-process L1 tier, 0 disables it
+        if 'local_cache' in kwargs:
+            local_size = kwargs.pop('local_cache')
+        else:
+            local_size = 0
+
+        # local_ttl is the number of seconds a value may be served from the L1 tier
+        if 'local_ttl' in kwargs:
+            local_ttl = kwargs.pop('local_ttl')
+        else:
+            local_ttl = 5
+
+        # invalidation is how the L1 tier learns about changes made elsewhere: 'keyspace', 'tracking' or None
+        if 'invalidation' in kwargs:
+            self.invalidation = kwargs.pop('invalidation')
+        else:
+            self.invalidation = 'keyspace'
+
+        # codec is the default serializer for values: 'pickle', 'json', 'msgpack' or 'orjson'
+        if 'codec' in kwargs:
+            codec = kwargs.pop('codec')
+        else:
+            codec = DEFAULT_CODEC
+
+        # values whose encoded size reaches compress_threshold bytes are compressed with compression
+        if 'compression' in kwargs:
+            compression = kwargs.pop('compression')
+        else:
+            compression = DEFAULT_COMPRESSION
+
+        if 'compress_threshold' in kwargs:
+            compress_threshold = kwargs.pop('compress_threshold')
+        else:
+            compress_threshold = DEFAULT_COMPRESS_THRESHOLD
+
+        self.serializer = get_serializer(codec, compression, compress_threshold)
+
+        # pickled values of large_value_threshold bytes or more (None disables it) are stored with their
+        # buffers out-of-band, split into chunks of chunk_size bytes under sub-keys, see large_values
+        if 'large_value_threshold' in kwargs:
+            self.large_value_threshold = kwargs.pop('large_value_threshold')
+        else:
+            self.large_value_threshold = None
+
+        if 'chunk_size' in kwargs:
+            self.chunk_size = kwargs.pop('chunk_size')
+        else:
+            self.chunk_size = DEFAULT_CHUNK_SIZE
+
+        # scan_count is the COUNT hint of every SCAN page, delete_batch the max keys unlinked per round trip
+        if 'scan_count' in kwargs:
+            self.scan_count = kwargs.pop('scan_count')
+        else:
+            self.scan_count = DEFAULT_SCAN_COUNT
+
+        if 'delete_batch' in kwargs:
+            self.delete_batch = kwargs.pop('delete_batch')
+        else:
+            self.delete_batch = DEFAULT_DELETE_BATCH
+        self.tag_invalidator = TagInvalidator(lambda: self.connection, self.delete_batch)
+        # batch_window (seconds) merges get() calls arriving from concurrent threads into one MGET of
+        # up to batch_size keys, None disables it
+        if 'batch_window' in kwargs:
+            batch_window = kwargs.pop('batch_window')
+        else:
+            batch_window = None
+
+        if 'batch_size' in kwargs:
+            batch_size = kwargs.pop('batch_size')
+        else:
+            batch_size = 64
+
+        self.batcher = GetBatcher(lambda keys: self.reader().mget(keys), batch_window, batch_size) \
+            if batch_window else None
+
+        # mget and set_many split more than mget_chunk keys (None disables it) into chunks sent over
+        # fanout_threads pooled connections at once; chunks of decode_threshold bytes or more are
+        # decoded on a pool of decode_processes processes (0 decodes them in the fetching thread)
+        if 'mget_chunk' in kwargs:
+            mget_chunk = kwargs.pop('mget_chunk')
+        else:
+            mget_chunk = DEFAULT_MGET_CHUNK
+
+        if 'fanout_threads' in kwargs:
+            fanout_threads = kwargs.pop('fanout_threads')
+        else:
+            fanout_threads = DEFAULT_FANOUT_THREADS
+
+        if 'decode_processes' in kwargs:
+            decode_processes = kwargs.pop('decode_processes')
+        else:
+            decode_processes = 0
+
+        if 'decode_threshold' in kwargs:
+            decode_threshold = kwargs.pop('decode_threshold')
+        else:
+            decode_threshold = DEFAULT_DECODE_THRESHOLD
+
+        self.fanout = FanOut(mget_chunk, fanout_threads, decode_processes, decode_threshold)
+        # write_behind queues set/store_* writes (up to write_queue_size) and sends them from a
+        # background thread in pipelines of write_batch; call flush() or close() before exiting
+        if 'write_behind' in kwargs:
+            write_behind = kwargs.pop('write_behind')
+        else:
+            write_behind = False
+
+        if 'write_queue_size' in kwargs:
+            write_queue_size = kwargs.pop('write_queue_size')
+        else:
+            write_queue_size = 10000
+
+        if 'write_batch' in kwargs:
+            write_batch = kwargs.pop('write_batch')
+        else:
+            write_batch = 500
+
+        self.write_queue = None
+        if write_behind:
+            self.write_queue = WriteBehindQueue(lambda: self.connection, write_queue_size, write_batch, log=self._log)
+        self.local_cache = LocalCache(local_size, local_ttl) if local_size else None
+        self.invalidation_listeners = []
+
+        # metrics is the registry hits, misses, latencies and sizes are recorded to, labelled by prefix
+        if 'metrics' in kwargs:
+            self.metrics_registry = kwargs.pop('metrics')
+        else:
+            self.metrics_registry = get_metrics()
+        self.metrics = self.metrics_registry.series(self.prefix)
+
+        # max_connections and pool_timeout size the connection pool shared by every cache on the same server
+        if 'max_connections' in kwargs:
+            self.max_connections = kwargs.pop('max_connections')
+        else:
+            self.max_connections = env_settings.REDIS_MAX_CONNECTIONS
+
+        if 'pool_timeout' in kwargs:
+            self.pool_timeout = kwargs.pop('pool_timeout')
+        else:
+            self.pool_timeout = env_settings.REDIS_POOL_TIMEOUT
+
+        self.host = kwargs.get('host', env_settings.REDIS_HOST)
+        self.port = kwargs.get('port', env_settings.REDIS_PORT)
+        self.db = kwargs.get('db', env_settings.REDIS_DB)
+        self.password = kwargs.get('password', env_settings.REDIS_PASSWORD)
+
+        # nodes ('host:port' or (host, port)) spreads keys over several standalone servers on a
+        # consistent hash ring; with cluster they are the startup nodes of a Redis Cluster instead
+        if 'nodes' in kwargs:
+            nodes = kwargs.pop('nodes')
+        else:
+            nodes = None
+
+        if 'cluster' in kwargs:
+            cluster = kwargs.pop('cluster')
+        else:
+            cluster = False
+
+        # shard_threads is the number of nodes talked to in parallel by mget, pipelines and scans
+        if 'shard_threads' in kwargs:
+            shard_threads = kwargs.pop('shard_threads')
+        else:
+            shard_threads = DEFAULT_SHARD_THREADS
+
+        # hash_tags writes keys as {prefix}:key and {namespace}:function:digest, so that every key
+        # of a namespace lives on one node and namespace-wide operations only involve that node
+        if 'hash_tags' in kwargs:
+            self.hash_tags = kwargs.pop('hash_tags')
+        else:
+            self.hash_tags = False
+
+        self.shards = None
+        if cluster or nodes:
+            names = [node_name(node) for node in (nodes or [(self.host, self.port)])]
+            self.host, self.port = parse_node(names[0])
+            if cluster:
+                self.db = 0  # clusters only have db 0
+                locator = ClusterSlots(names, self.node_connection)
+            else:
+                locator = HashRing(names)
+            self.shards = ShardedRedis(locator, self.node_connection, shard_threads)
+            breaker_key = ('cluster' if cluster else 'ring', self.db) + tuple(sorted(names))
+            breaker_name = ','.join(names)
+        else:
+            breaker_key = pool_key(self.host, self.port, self.db, self.password)
+            breaker_name = '{0}:{1}/{2}'.format(*breaker_key[:3])
+
+        self.breaker = get_breaker(breaker_key, failure_threshold=failure_threshold, backoff=self.retry_backoff,
+                                   max_backoff=self.max_sleep, name=breaker_name, log=self._log)
+
+        # replicas ('host:port' or (host, port)) receive get/mget/get_value reads and scans, writes go to
+        # the primary; read_from picks a replica 'round_robin' or by 'least_latency' (measured by the
+        # health check). Reads fall back to the primary while no replica answers.
+        if 'replicas' in kwargs:
+            replicas = kwargs.pop('replicas')
+        else:
+            replicas = None
+
+        if 'read_from' in kwargs:
+            read_from = kwargs.pop('read_from')
+        else:
+            read_from = None
+
+        # sentinels ((host, port) pairs) are asked for the primary of service_name, and its replicas when
+        # read_from is set; the answer is refreshed by the health check and after connection errors, so
+        # a failover is followed without a restart
+        if 'sentinels' in kwargs:
+            sentinels = kwargs.pop('sentinels')
+        else:
+            sentinels = None
+
+        if 'service_name' in kwargs:
+            self.service_name = kwargs.pop('service_name')
+        else:
+            self.service_name = 'mymaster'
+
+        if self.shards is not None and (replicas or sentinels):
+            raise ValueError("Replica routing and sentinels are not supported on a sharded cache")
+        self.sentinel = Sentinel(sentinels, socket_timeout=1.0) if sentinels else None
+        self._primary_checked = 0.0
+        self.replicas = None
+        if replicas or (sentinels and read_from):
+            self.replicas = ReplicaSet(replicas or [], self.node_connection, read_from or ROUND_ROBIN,
+                                       log=self._log)
+        self.health_check_interval = health_check_interval
+
+        # versioned puts the generation of the prefix and of cache_it namespaces in their keys, so that
+        # delete_namespace is a single INCR; generations are read again every generation_refresh seconds
+        if 'versioned' in kwargs:
+            versioned = kwargs.pop('versioned')
+        else:
+            versioned = False
+
+        if 'generation_refresh' in kwargs:
+            generation_refresh = kwargs.pop('generation_refresh')
+        else:
+            generation_refresh = DEFAULT_REFRESH_INTERVAL
+
+        self.generations = Generations(lambda: self.connection, generation_refresh) if versioned else None
+        # Namespaces of cache_it functions decorated with this cache, the only ones besides the prefix
+        # whose keys carry a generation.
+        self.versioned_namespaces = set()
+
+        # Nothing is sent to redis until the connection is first used, see start().
+        self._connection = None
+        self._started = False
+        self._start_lock = threading.Lock()
+        # Process which owns the connections and threads of this cache, see after_fork().
+        self._pid = os.getpid()
+
+    @property
+    def connection(self):
+        """
+        redis.StrictRedis client on the shared pool, connected on first use;
+        None while redis could not be reached.
+        """
+        if self._pid != os.getpid():
+            self.after_fork()
+        if not self._started:
+            self.start()
+        return self._connection
+
+    @connection.setter
+    def connection(self, connection):
+        self._connection = connection
+
+    def start(self):
+        """
+        Connects and starts the background threads of this cache, once. Called by
+        the first command, so creating a cache (or importing a module which does)
+        costs no round trip and does not hang when redis is down.
+        """
+        with self._start_lock:
+            if self._started:
+                return
+            if self.sentinel is not None:
+                try:
+                    self.refresh_primary()
+                except ConnectionError as e:
+                    self._log.error('No sentinel knows the primary of {}. \nERROR: {}'.format(self.service_name, e))
+            if self.connect() is None:
+                self.breaker.trip()
+            if self.health_check_interval:
+                self.breaker.start_health_check(self.health_check, self.health_check_interval)
+            if self.local_cache is not None and self.invalidation:
+                self.start_invalidation_listener()
+            self._started = True
+
+    def after_fork(self):
+        """
+        Drops what this cache inherited from its parent process, ex. when it was created in the
+        master of a prefork server: connections are made again and background threads restarted
+        on next use, writes queued in the parent are left to it and the L1 tier starts empty.
+        Called by the first command after the pid changed.
+        """
+        after_fork()
+        self._pid = os.getpid()
+        self._start_lock = threading.Lock()
+        self._started = False
+        self._connection = None
+        self.invalidation_listeners = []
+        for part in (self.local_cache, self.batcher, self.fanout, self.write_queue, self.shards, self.replicas,
+                     self.generations):
+            if part is not None:
+                part.after_fork()
+
+    def start_invalidation_listener(self):
+        """
+        Starts the background threads which keep the L1 tier coherent with Redis, one per node.
+        """
+        if self._connection is None:
+            return
+        connections = self.shards.clients() if self.shards is not None else [self._connection]
+        for connection in connections:
+            prefix = self.tag(self.prefix) + ':' if self.prefix else ''
+            listener = InvalidationListener(connection, self.local_cache, db=self.db, prefix=prefix,
+                                            mode=self.invalidation, log=self._log)
+            listener.start()
+            self.invalidation_listeners.append(listener)
 
-        self.connection = self.connect()
+    def pool_stats(self):
+        """
+        :return: dict of in-use/idle connections and wait times of the shared pool behind this cache,
+                 for a sharded cache a dict of node name to the stats of its pool
+        """
+        if self.shards is not None:
+            return self.shards.pool_stats()
+        if self._connection is not None:
+            return self._connection.connection_pool.stats()
+
+    def flush(self, timeout=None):
+        """
+        Waits until all write-behind writes queued so far have reached Redis.
+        :return: True if nothing is left queued
+        """
+        if self.write_queue is not None:
+            return self.write_queue.flush(timeout)
+        return True
+
+    def close(self):
+        """
+        Drains pending writes and stops the background threads of this cache.
+        """
+        if getattr(self, 'write_queue', None) is not None:
+            self.write_queue.close()
+        for listener in getattr(self, 'invalidation_listeners', []):
+            listener.stop()
+        self.invalidation_listeners = []
+
+    def metrics_stats(self):
+        """
+        :return: dict of hit/miss/error counters and latency/size histograms of this cache
+        """
+        return self.metrics.snapshot()
+
+    def local_stats(self):
+        """
+        :return: dict of L1 hit/miss/eviction/invalidation counters, None when the L1 tier is disabled
+        """
+        if self.local_cache is not None:
+            return self.local_cache.stats()
 
     def ping(self):
         """
@@ -101,6 +518,115 @@ class MyCache(redis.client.Redis):
             self._log.info("Unable to ping Redis Server: %s" % e)
             return False
 
+    def available(self):
+        """
+        Cheap, non-blocking check used on every cached call instead of ping().
+        :return: False while the circuit is open, True if commands may be sent
+        """
+        if self._pid != os.getpid():
+            self.after_fork()
+        if not self._started:
+            self.start()
+        if not self.breaker.allow():
+            return False
+        if self.connection is None:
+            # The server came back after the first connection attempt failed.
+            self.connection = self.pooled_connection()
+        return True
+
+    def health_check(self):
+        """
+        Pings the server, raising redis.RedisError if it is unreachable. Also follows
+        a sentinel failover and measures the round trip to every replica.
+        """
+        if self.sentinel is not None:
+            self.refresh_primary()
+        if self.replicas is not None:
+            self.replicas.check()
+        (self.connection or self.pooled_connection()).ping()
+
+    def command_failed(self, e, connection=None):
+        """
+        Counts connection errors towards opening the circuit. A failing replica is
+        left out of reads instead, and with sentinels the primary is looked up again.
+        :param connection: client the failed command was sent to
+        """
+        if connection is not None and self.replicas is not None and self.replicas.failed(connection):
+            return
+        if isinstance(e, ConnectionError):
+            self.breaker.record_failure()
+        if self.sentinel is not None and isinstance(e, (ConnectionError, ReadOnlyError)) \
+                and time.time() - self._primary_checked >= 1:
+            try:
+                self.refresh_primary()
+            except ConnectionError as error:
+                self._log.error('Could not look up the primary of {}. \nERROR: {}'.format(self.service_name, error))
+
+    def refresh_primary(self):
+        """
+        Asks the sentinels for the current primary (and replicas), switching to it after a failover.
+        :return: True if the primary changed
+        """
+        self._primary_checked = time.time()
+        host, port = self.sentinel.discover_master(self.service_name)
+        if self.replicas is not None:
+            self.replicas.update(self.sentinel.discover_slaves(self.service_name))
+        if (host, port) == (self.host, self.port):
+            return False
+        self._log.warning('Primary of {} is now {}:{}, was {}:{}'.format(self.service_name, host, port,
+                                                                       self.host, self.port))
+        self.host, self.port = host, port
+        if self._started:
+            self.connection = self.node_connection(host, port)
+            if self.invalidation_listeners:
+                # Changes made on the new primary are announced there, and the L1 copies may be stale.
+                for listener in self.invalidation_listeners:
+                    listener.stop()
+                self.invalidation_listeners = []
+                self.local_cache.clear()
+                self.start_invalidation_listener()
+        return True
+
+    def reader(self):
+        """
+        :return: client reads are sent to: a replica when replicas are configured and one is up,
+                 the primary otherwise
+        """
+        if self.replicas is not None:
+            client = self.replicas.client()
+            if client is not None:
+                return client
+        return self.connection
+
+    def replica_stats(self):
+        """
+        :return: dict of replica name to its round trip, availability and failed reads, None without replicas
+        """
+        if self.replicas is not None:
+            return self.replicas.stats()
+
+    def breaker_stats(self):
+        """
+        :return: dict with the circuit state and failure counters of the server behind this cache
+        """
+        return self.breaker.stats()
+
+    def pooled_connection(self):
+        """
+        :return: redis.StrictRedis client on the process-wide pool for this server,
+                 the sharding.ShardedRedis router over all nodes for a sharded cache
+        """
+        if self.shards is not None:
+            return self.shards
+        return self.node_connection(self.host, self.port)
+
+    def node_connection(self, host, port):
+        """
+        :return: redis.StrictRedis client on the process-wide pool for the given server
+        """
+        return get_connection(host, port, self.db, self.password,
+                              max_connections=self.max_connections, timeout=self.pool_timeout)
+
     def connect(self, *args, **kwargs):
         """
         We cannot assume that connection will succeed, as such we use a ping()
@@ -108,7 +634,7 @@ class MyCache(redis.client.Redis):
         :return: redis.StrictRedis Connection Object
         """
         try:
-            connection = redis.StrictRedis(host=self.host, port=self.port, db=self.db, password=self.password)
+            connection = self.pooled_connection()
             connection.ping()
             self._log.info("Successfully connected to redis with: %s, %s" % (self.host, self.port))
             self.connection = connection
@@ -117,54 +643,82 @@ class MyCache(redis.client.Redis):
             self._log.error("Failed to create connection to redis with: %s, %s" % (self.host, self.port))
             self._log.error("Please check the redis connection. ERROR: %s" % e)
 
+    def try_connect(self):
+        """
+        Single connection attempt, reported to the circuit breaker.
+        :return: True if redis answered
+        """
+        connection = self.pooled_connection()
+        try:
+            connection.ping()
+        except ConnectionError as e:
+            self.breaker.record_failure()
+            self._log.info('Connecting failed: {0}'.format(e))
+            return False
+        self._log.info('Connected to Redis!')
+        self.connection = connection
+        self.breaker.record_success()
+        return True
+
     def reconnect(self, conn_retries=None):
-        """ Connects to Redis with a exponential waiting (3**n) """
+        """ Connects to Redis, waiting a jittered exponential backoff between attempts """
         if conn_retries is None:
             conn_retries = self.conn_retries
 
-        count = 0
         if self._log:
             self._log.info('Connecting to Redis.')
-        while count < conn_retries:
-            # super(redis.client.Redis, self).__init__(*self.args, **self.kwargs)
-            connection = redis.StrictRedis(host=self.host, port=self.port, db=self.db, password=self.password)
-
-            if connection.ping():
-                self._log.info('Connected to Redis!')
+        for attempt in range(conn_retries):
+            if self.try_connect():
                 return True
-            else:
-                sl = min(3 ** count, self.max_sleep)
-                self._log.info('Connecting failed, retrying in {0} seconds'.format(sl))
+            if attempt + 1 < conn_retries:
+                sl = jittered_backoff(attempt, self.retry_backoff, self.max_sleep)
+                self._log.info('Retrying in {0:.2f} seconds'.format(sl))
                 time.sleep(sl)
-                count += 1
         return False
 
     def safe_reconnect(self):
-        """ Connects to Redis with a exponential waiting (3**n), wont return until successfully connected"""
-        count = 0
+        """ Connects to Redis with a jittered exponential backoff, wont return until successfully connected"""
+        attempt = 0
         if self._log:
             self._log.info('Connecting to Redis.')
-        while True:
-            # super(redis.client.Redis, self).__init__(*self.args, **self.kwargs)
-            connection = redis.StrictRedis(host=self.host, port=self.port, db=self.db, password=self.password)
+        while not self.try_connect():
+            sl = jittered_backoff(attempt, self.retry_backoff, self.max_sleep)
+            self._log.info('Retrying in {0:.2f} seconds'.format(sl))
+            time.sleep(sl)
+            attempt += 1
+        return True
 
-            if connection.ping():
-                self._log.info('Connected to Redis!')
-                return True
-            else:
-                sl = min(3 ** count, self.max_sleep)
-                self._log.info('Connecting failed, retrying in {0} seconds'.format(sl))
-                time.sleep(sl)
-                count += 1
+    def tag(self, namespace):
+        """
+        :return: namespace as written in keys, wrapped in a hash tag when hash_tags is on
+        """
+        if self.hash_tags and namespace:
+            return '{' + namespace + '}'
+        return namespace
+
+    def versioned_namespace(self, namespace):
+        """
+        :return: namespace as written in keys, followed by its current generation in versioned mode
+        """
+        if self.generations is not None and namespace:
+            return self.generations.namespace(self.tag(namespace))
+        return self.tag(namespace)
+
+    def is_versioned(self, namespace):
+        """
+        :return: True if the keys of namespace carry its generation, see versioned_namespace
+        """
+        return self.generations is not None and bool(namespace) and (
+            namespace == self.prefix or namespace in self.versioned_namespaces)
 
     def make_key(self, key):
         if self.prefix:
-            return "{0}:{1}".format(self.prefix, key)
+            return "{0}:{1}".format(self.versioned_namespace(self.prefix), key)
 
         return key
 
     def namespace_key(self, namespace):
-        return namespace + ':*'
+        return self.tag(namespace) + ':*'
 
     def get(self, key):
         """
@@ -174,16 +728,44 @@ class MyCache(redis.client.Redis):
         """
         key = to_unicode(key)
         if key:  # No need to validate membership, which is an O(1) operation, but seems we can do without.
-            start = timer.time()
+            cache_key = self.make_key(key)
+            if self.local_cache is not None:
+                value = self.local_cache.get(cache_key)
+                if value is not MISSING:
+                    self.metrics.read()
+                    return value
+            if not self.available():
+                return
+
+            start = clock()
+            reader = None
             try:
-                value = self.connection.get(self.make_key(key))
-                if not value:  # expired key
-                    self._log.info('Key - %s Not found' % key)
+                if self.batcher is not None:
+                    raw = self.batcher.get(cache_key)
+                else:
+                    reader = self.reader()
+                    raw = reader.get(cache_key)
+                fetched = clock()
+                self.breaker.record_success()
+                if not raw:  # expired key
+                    self.metrics.read(0, 1, fetched - start)
                     return
 
-                self._log.info("Cache took {0} to retrieve data from the Redis".format(float(timer.time() - start)))
-                return pickle.loads(value)
+                if is_manifest(raw):
+                    reader = reader or self.reader()
+                    value = load_chunks(reader, cache_key, raw)
+                    if value is MISSING:
+                        self.metrics.read(0, 1, fetched - start)
+                        return
+                else:
+                    value = self.serializer.loads(raw)
+                self.metrics.read(1, 0, fetched - start, clock() - fetched, len(raw))
+                if self.local_cache is not None:
+                    self.local_cache.set(cache_key, value)
+                return value
             except (ConnectionError, AttributeError) as e:
+                self.metrics.error()
+                self.command_failed(e, reader)
                 msg = "Error while getting key - %s" % key
                 self._log.error('{} \nERROR: {}'.format(msg, str(e)))
 
@@ -195,21 +777,120 @@ class MyCache(redis.client.Redis):
         """
         if keys:
             cache_keys = [self.make_key(to_unicode(key)) for key in keys]
+            found = {}
+            if self.local_cache is not None:
+                pending = []
+                for key, cache_key in zip(keys, cache_keys):
+                    value = self.local_cache.get(cache_key)
+                    if value is MISSING:
+                        pending.append((key, cache_key))
+                    else:
+                        found[key] = value
+                if not pending:
+                    return found
+                keys, cache_keys = [k for k, _ in pending], [ck for _, ck in pending]
+            local_hits = len(found)
+            if not self.available():
+                return found
+            reader = self.reader()
+
+            def fetch(chunk):
+                values = reader.mget(chunk)
+                return values, self.fanout.decode(values, self.serializer, is_manifest)
             try:
-                values = self.connection.mget(cache_keys)
-                return {k: pickle.loads(v) for (k, v) in zip(keys, values)}
+                start = clock()
+                if self.fanout.splits(len(cache_keys)):
+                    # Chunks are fetched and decoded concurrently, their time all counts as network time.
+                    chunks = self.fanout.map(fetch, cache_keys)
+                    values = [value for raw, _ in chunks for value in raw]
+                    decoded = [value for _, chunk in chunks for value in chunk]
+                    fetched = clock()
+                else:
+                    values = reader.mget(cache_keys)
+                    fetched = clock()
+                    decoded = decode_values(values, self.serializer, is_manifest)
+                self.breaker.record_success()
+                for key, cache_key, raw, value in zip(keys, cache_keys, values, decoded):
+                    if value is MISSING:  # missing or expired
+                        continue
+                    if is_manifest(raw):
+                        value = load_chunks(reader, cache_key, raw)
+                        if value is MISSING:
+                            continue
+                    found[key] = value
+                    if self.local_cache is not None:
+                        self.local_cache.set(cache_key, value)
+                hits = sum(1 for value in values if value is not None)
+                self.metrics.read(local_hits + hits, len(values) - hits, fetched - start, clock() - fetched,
+                                  sum(len(value) for value in values if value is not None))
+                return found
             except (ConnectionError, AttributeError) as e:
+                self.metrics.error()
+                self.command_failed(e, reader)
                 self._log.error('Error while getting multiple keys. \nERROR: {}'.format(str(e)))
 
+    def iter_keys(self, pattern=None):
+        """
+        Generator over the keys matching pattern (all keys by default), walking
+        the keyspace incrementally with SCAN, on a replica when there are some.
+        """
+        return iter_keys(self.reader(), pattern, self.scan_count)
+
+    def iter_items(self, namespace, batch=None):
+        """
+        Generator of (key, value, ttl) of every key of a namespace, for exports and migrations.
+        Keys are walked with SCAN and every batch is read with one pipeline of MGET and PTTL, so
+        memory use does not grow with the namespace; values are decoded as they are yielded. Keys
+        which expired or were deleted meanwhile are skipped, and a key may be yielded twice if
+        the keyspace was rehashed during the walk. Of a versioned namespace only the keys of the
+        current generation are read.
+        :param namespace: namespace to walk, None for every key
+        :param batch: keys per round trip, scan_count by default
+        :return: generator of (key as text, value, seconds left or None for keys without expiry)
+        """
+        if namespace is None:
+            pattern = None
+        elif self.is_versioned(namespace):
+            pattern = self.versioned_namespace(namespace) + ':*'
+        else:
+            pattern = self.namespace_key(namespace)
+        reader = self.reader()
+        try:
+            for keys in iter_batches(iter_keys(reader, pattern, self.scan_count), batch or self.scan_count):
+                # Locks of cache_it share the namespace but hold raw tokens, not encoded values.
+                keys = [key for key in keys if not is_lock_key(key)]
+                if self.large_value_threshold is not None:
+                    keys = [key for key in keys if not is_chunk_key(key)]
+                if not keys:
+                    continue
+                pipe = reader.pipeline(transaction=False)
+                if self.shards is None:
+                    pipe.mget(keys)
+                for key in keys:
+                    pipe.pttl(key)
+                replies = pipe.execute()
+                if self.shards is not None:
+                    # MGET is split per node by the router, the TTLs follow in one pipeline per node.
+                    replies.insert(0, reader.mget(keys))
+                for key, value, ttl in zip(keys, replies[0], replies[1:]):
+                    if value is None or ttl == -2:
+                        continue
+                    key = to_unicode(key.decode('utf-8') if isinstance(key, bytes) else key)
+                    value = load_chunks(reader, key, value) if is_manifest(value) \
+                        else self.serializer.loads(value)
+                    if value is not MISSING:
+                        yield key, value, ttl / 1000.0 if ttl >= 0 else None
+        except (ConnectionError, AttributeError) as e:
+            self.command_failed(e, reader)
+            self._log.error('Error while iterating namespace {}. \nERROR: {}'.format(namespace, str(e)))
+            raise
+
     def keys(self):
         """
         :return: Returns all keys in the cache as a list
         """
-        start = timer.time()
         try:
-            keys = self.connection.keys()
-            self._log.info("Cache took {0} to retrieve data from the Redis Server".format(float(timer.time() - start)))
-            return keys
+            return list(self.iter_keys())
         except (ConnectionError, AttributeError) as e:
             self._log.error('Error while getting all keys in the cache. \nERROR: {}'.format(str(e)))
 
@@ -220,10 +901,8 @@ class MyCache(redis.client.Redis):
         :param keys: List of keys to look up in Redis
         :return: dict of found key/values with values parsed from JSON format
         """
-        start = timer.time()
         d = self.mget(keys)
         if d:
-            self._log.info("Cache took {0} to retrieve data from the Redis Server".format(float(timer.time() - start)))
             for key, value in d.items():
                 d[key] = json.loads(value if value else None)
             return d
@@ -236,100 +915,368 @@ class MyCache(redis.client.Redis):
         :param expire: time-to-live (ttl) for this datum
         """
         key = to_unicode(key)
-        value = pickle.dumps(value)
+        start = clock()
+        value = self.serializer.dumps(value)
+        encoded = clock()
 
         if expire is None:
             expire = self.expire
+        if self.local_cache is not None:
+            self.local_cache.invalidate(self.make_key(key))
         try:
+            if self.write_queue is not None:
+                self.write_queue.set(self.make_key(key), value, expire)
+                self.metrics.write(None, encoded - start, len(value))
+                return
+            if not self.available():
+                return
+            sent = clock()
             self.connection.set(self.make_key(key), value, expire)
-            self._log.info("Successfully set %s: %s" % (key, value))
-        except (ConnectionError, AttributeError) as e:
+            self.metrics.write(clock() - sent, encoded - start, len(value))
+            self.breaker.record_success()
+            self._log.debug("Successfully set %s" % key)
+        except (ConnectionError, ReadOnlyError, AttributeError) as e:
+            self.metrics.error()
+            self.command_failed(e)
             self._log.error('Error While setting key, values \nERROR: {}'.format(str(e)))
 
+    def set_many(self, mapping, expire=DEFAULT_EXPIRY):
+        """
+        Method stores every key/value of mapping with the same expiration, in pipelines of at
+        most mget_chunk keys which are encoded and sent in parallel.
+        :param mapping: dict of key to value
+        :param expire: time-to-live (ttl) of every value, None for no expiry
+        """
+        items = [(self.make_key(to_unicode(key)), value) for key, value in mapping.items()]
+        if not items:
+            return
+        if self.local_cache is not None:
+            for cache_key, _ in items:
+                self.local_cache.invalidate(cache_key)
+
+        def send(chunk):
+            start = clock()
+            encoded = [(cache_key, self.serializer.dumps(value)) for cache_key, value in chunk]
+            sent = clock()
+            pipe = self.connection.pipeline(transaction=False)
+            for cache_key, value in encoded:
+                pipe.set(cache_key, value, ex=expire)
+            pipe.execute()
+            return clock() - sent, sent - start, sum(len(value) for _, value in encoded)
+        try:
+            if self.write_queue is not None:
+                start = clock()
+                size = 0
+                for cache_key, value in items:
+                    value = self.serializer.dumps(value)
+                    size += len(value)
+                    self.write_queue.set(cache_key, value, expire)
+                self.metrics.write(None, clock() - start, size, len(items))
+                return
+            if not self.available():
+                return
+            results = self.fanout.map(send, items)
+            self.metrics.write(sum(result[0] for result in results), sum(result[1] for result in results),
+                               sum(result[2] for result in results), len(items))
+            self.breaker.record_success()
+            self._log.debug("Successfully set %s keys" % len(items))
+        except (ConnectionError, ReadOnlyError, AttributeError) as e:
+            self.metrics.error()
+            self.command_failed(e)
+            self._log.error('Error while setting multiple keys. \nERROR: {}'.format(str(e)))
+
     def delete(self, key):
         """
         Method removes (invalidates) an item from the cache.
         :param key: key to remove from Redis
         """
         key = to_unicode(key)
+        if self.local_cache is not None:
+            self.local_cache.invalidate(self.make_key(key))
         try:
+            if self.large_value_threshold is not None:
+                # Chunks of a large value are not referenced by anything else once the key is gone. They
+                # never go through the write-behind queue, so they are dropped right away in both modes.
+                drop_chunks(self.connection, self.make_key(key), read_manifest(self.connection, self.make_key(key)))
+            if self.write_queue is not None:
+                self.write_queue.delete(self.make_key(key))
+                return
             self.connection.delete(self.make_key(key))
             self._log.info("Successfully deleted key: %s" % key)
-        except (ConnectionError, AttributeError) as e:
+        except (ConnectionError, ReadOnlyError, AttributeError) as e:
+            self.command_failed(e)
             self._log.error('Error while deleting key -{} \nERROR: {}'.format(key, str(e)))
 
-    def delete_all(self):
+    def delete_all(self, progress=None):
         """
         Method removes (invalidates) all items from the cache.
+        :param progress: optional callable receiving the number of keys deleted so far
+        :return: number of keys deleted
         """
+        if self.local_cache is not None:
+            self.local_cache.clear()
         try:
-            keys = self.connection.keys()
-            if keys:
-                self.connection.delete(*keys)
-                self._log.info("Successfully deleted keys: %s" % keys)
-                return
+            deleted = unlink_keys(self.connection, self.iter_keys(), self.delete_batch, progress)
+            if deleted:
+                self._log.info("Successfully deleted %s keys" % deleted)
+                return deleted
 
             self._log.info("No keys found in cache")
+            return 0
         except (ConnectionError, AttributeError) as e:
             self._log.error('Error while deleting/flushing all keys. \nERROR: {}'.format(str(e)))
 
-    def delete_namespace(self, space):
+    def delete_namespace(self, space, progress=None):
         """
         Method removes (invalidates) all items in a given namespace from the cache.
-        :param key: key to remove from Redis
+        In versioned mode the prefix and cache_it namespaces move to their next generation instead,
+        see invalidate_namespace; the keys of other namespaces carry no generation and are deleted.
+        :param space: namespace to remove from Redis
+        :param progress: optional callable receiving the number of keys deleted so far
+        :return: number of keys deleted, 0 for a versioned namespace
         """
         namespace = self.namespace_key(space)
+        if self.local_cache is not None:
+            self.local_cache.invalidate_prefix(self.tag(space) + ':')
+        if self.is_versioned(space):
+            self.invalidate_namespace(space)
+            return 0
         try:
-            keys = list(self.connection.keys(namespace))
-            if keys:
-                self.connection.delete(keys)
-                self._log.info("Successfully deleted namespace: %s" % namespace)
-                return
+            deleted = unlink_keys(self.connection, self.iter_keys(namespace), self.delete_batch, progress)
+            if deleted:
+                self._log.info("Successfully deleted namespace: %s (%s keys)" % (namespace, deleted))
+                return deleted
 
             self._log.info("No keys found in cache with namespace: %s" % namespace)
+            return 0
         except (ConnectionError, AttributeError) as e:
             self._log.error('Error while deleting namespace. \nERROR: {}'.format(str(e)))
 
-    def store_json(self, key, value, expire=None):
+    def invalidate_namespace(self, space):
+        """
+        Invalidates every key of a namespace with a single INCR of its generation (versioned mode only).
+        Keys of older generations are left to expire; delete_all or a sweep of namespace_key(space) with
+        keyspace.unlink_keys reclaims their memory earlier.
+        :return: the new generation, None if redis could not be reached
+        """
+        if self.generations is None:
+            raise ValueError("invalidate_namespace needs a cache created with versioned=True")
+        if self.local_cache is not None:
+            self.local_cache.invalidate_prefix(self.tag(space) + ':')
         try:
-            self.connection.set(key, json.dumps(value), expire)
-        except (ConnectionError, AttributeError) as e:
-            self._log.error('Error while storing as  JSON. \nERROR: {}'.format(str(e)))
+            generation = self.generations.bump(self.tag(space))
+            self._log.info("Invalidated namespace: %s (generation %s)" % (space, generation))
+            return generation
+        except (ConnectionError, ReadOnlyError, AttributeError) as e:
+            self.command_failed(e)
+            self._log.error('Error while invalidating namespace. \nERROR: {}'.format(str(e)))
 
-    def store_pickle(self, key, value, expire=None):
+    def invalidate_tags(self, tags, progress=None):
+        """
+        Deletes every entry written with one of tags (see cache_it), and the tag sets, atomically
+        in batches of at most delete_batch keys so that large tags do not block Redis.
+        :param progress: optional callable receiving the number of keys deleted so far
+        :return: number of keys deleted, a key being counted once per tag set it was recorded in
+        """
+        deleted = [0]
+
+        def removed(keys):
+            if self.local_cache is not None:
+                for key in keys:
+                    self.local_cache.invalidate(to_unicode(key.decode('utf-8') if isinstance(key, bytes) else key))
+            deleted[0] += len(keys)
+            if progress is not None:
+                progress(deleted[0])
         try:
-            self.connection.set(key, pickle.dumps(value), expire)
-        except (ConnectionError, AttributeError) as e:
-            self._log.error('Error while doing pickling. \nERROR: {}'.format(str(e)))
+            self.tag_invalidator.invalidate(tags, removed)
+            self._log.info("Invalidated tags: %s (%s keys)" % (', '.join(map(str, tags)), deleted[0]))
+            return deleted[0]
+        except (ConnectionError, ReadOnlyError, AttributeError) as e:
+            self.command_failed(e)
+            self._log.error('Error while invalidating tags. \nERROR: {}'.format(str(e)))
 
-    def get_json(self, key):
+    def serializer_for(self, codec=None):
+        """
+        :param codec: codec name, None for the cache default
+        :return: Serializer using this cache's compression settings
+        """
+        if codec is None or codec == self.serializer.codec:
+            return self.serializer
+        return get_serializer(codec, self.serializer.compression, self.serializer.compress_threshold)
+
+    def store_value(self, key, value, expire=None, codec=None, metrics=None, tags=None, checked=False):
+        """
+        Stores value under the (unprefixed) key encoded with the given codec.
+        :param metrics: metrics.Series to record the write to, the one of this cache by default
+        :param tags: tags the key is recorded under in the same transaction, see invalidate_tags
+        :param checked: True if the caller got this call past available() already; asking the breaker
+                        again would use up the single half-open probe before the command is sent
+        """
+        metrics = metrics or self.metrics
         try:
-            return json.loads(self.connection.get(key))
-        except (ConnectionError, AttributeError) as e:
-            self._log.error('Error while converting to JSON. \nERROR: {}'.format(str(e)))
+            start = clock()
+            serializer = self.serializer_for(codec)
+            if self.chunks_values(codec):
+                frames = pickle_frames(value)
+                if sum(frame.nbytes for frame in frames) >= self.large_value_threshold:
+                    sizes, chunks = split_frames(frames, self.chunk_size)
+                    self.store_chunks(key, sizes, chunks, expire, metrics, start, tags, checked)
+                    return
+                # Without out-of-band buffers the stream already is the pickle of value.
+                value = serializer.encode(frames[0]) if len(frames) == 1 else serializer.dumps(value)
+            else:
+                value = serializer.dumps(value)
+            encoded = clock()
+            if self.write_queue is not None:
+                stale = self.stale_chunks(key)
+                self.write_queue.set(key, value, expire, tags)
+                for chunk_key in stale:
+                    self.write_queue.delete(chunk_key)
+                metrics.write(None, encoded - start, len(value))
+                return
+            if not checked and not self.available():
+                return
+            stale = self.stale_chunks(key)
+            if tags or stale:
+                pipe = self.connection.pipeline()
+                if tags:
+                    record_tags(pipe, key, tags, expire)
+                pipe.set(key, value, ex=expire)
+                if stale:
+                    pipe.unlink(*stale)
+                pipe.execute()
+            else:
+                self.connection.set(key, value, expire)
+            metrics.write(clock() - encoded, encoded - start, len(value))
+            self.breaker.record_success()
+        except (ConnectionError, ReadOnlyError, AttributeError) as e:
+            metrics.error()
+            self.command_failed(e)
+            self._log.error('Error while storing value with codec {}. \nERROR: {}'.format(codec, str(e)))
 
-    def get_pickle(self, key):
+    def stale_chunks(self, key):
+        """
+        :return: chunks of the large value stored under key, left behind by a plain value written
+                 over it unless they are dropped; none when large values are off
+        """
+        if self.large_value_threshold is None:
+            return []
+        return chunks_of(key, read_manifest(self.connection, key))
+
+    def chunks_values(self, codec=None):
+        """
+        :return: True if values written with codec go through the large-value path when big enough
+        """
+        return self.large_value_threshold is not None and (codec or self.serializer.codec) == 'pickle' \
+            and chunking_supported()
+
+    def store_chunks(self, key, sizes, chunks, expire, metrics, start, tags=None, checked=False):
+        """
+        Writes a value split by large_values.split_frames, bypassing the write-behind queue
+        so that large buffers are not held in memory waiting for a flush.
+        """
+        encoded = clock()
+        if not checked and not self.available():
+            return
+        if self.write_queue is not None:
+            # Queued writes of key are older, they must not land on top of this one.
+            self.write_queue.flush()
+        if tags:
+            # Tagged before the value is written, so an invalidation can never miss it.
+            pipe = self.connection.pipeline()
+            record_tags(pipe, key, tags, expire)
+            pipe.execute()
+        previous = read_manifest(self.connection, key)
+        size = store_chunks(self.connection, key, sizes, chunks, expire, previous)
+        metrics.write(clock() - encoded, encoded - start, size)
+        self.breaker.record_success()
+
+    def get_value(self, key, legacy=pickle.loads, metrics=None, checked=False):
+        """
+        Reads a value stored by store_value, whatever codec it was written with.
+        :param legacy: loader for values written before codec headers existed
+        :param metrics: metrics.Series to record the lookup to, the one of this cache by default
+        :param checked: True if the caller got this call past available() already, see store_value
+        :return: the value, or MISSING if the key does not exist
+        """
+        metrics = metrics or self.metrics
+        if not checked and not self.available():
+            return MISSING
+        reader = self.reader()
         try:
-            return pickle.loads(self.connection.get(key))
+            start = clock()
+            value = reader.get(key)
+            fetched = clock()
+            self.breaker.record_success()
+            if value is None:
+                metrics.read(0, 1, fetched - start)
+                return MISSING
+            if is_manifest(value):
+                result = load_chunks(reader, key, value)
+                if result is MISSING:
+                    metrics.read(0, 1, fetched - start)
+                    return MISSING
+            else:
+                result = self.serializer.loads(value, legacy=legacy)
+            metrics.read(1, 0, fetched - start, clock() - fetched, len(value))
+            return result
         except (ConnectionError, AttributeError) as e:
-            self._log.error('Error while doing un-pickling. \nERROR: {}'.format(str(e)))
+            metrics.error()
+            self.command_failed(e, reader)
+            self._log.error('Error while getting value of key - {} \nERROR: {}'.format(key, str(e)))
+            return MISSING
+
+    def store_json(self, key, value, expire=None):
+        self.store_value(key, value, expire, codec='json')
+
+    def store_pickle(self, key, value, expire=None):
+        self.store_value(key, value, expire, codec='pickle')
+
+    def get_json(self, key):
+        value = self.get_value(key, legacy=json.loads)
+        if value is not MISSING:
+            return value
+
+    def get_pickle(self, key):
+        value = self.get_value(key)
+        if value is not MISSING:
+            return value
 
     def __contains__(self, key):
-        return key in self.connection.keys()
+        return bool(self.connection.exists(self.make_key(to_unicode(key))))
 
     def get_hash(self, args):
         if self.hashkeys:
-            key = hashlib.md5(args).hexdigest()
+            key = digest(args)
         else:
             key = pickle.dumps(args)
         return key
 
 
-def cache_it(namespace=None, expire=DEFAULT_EXPIRY, cache=None, ignore_args=False, use_json=False, view=False):
+def cache_it(namespace=None, expire=DEFAULT_EXPIRY, cache=None, ignore_args=False, use_json=False, view=False,
+             single_flight=False, lock_timeout=10000, lock_wait=5,
+             stale_ttl=0, early_refresh=False, beta=1.0, codec=None, version=None, tags=None):
     """
     Arguments and function result must be pickleable.
+    Coroutine functions are supported on Python 3; they are cached through an
+    async_cache.AsyncMyCache, which is what `cache` must be for them if given.
+    single_flight, stale_ttl, early_refresh and tags raise ValueError on coroutine functions.
     :param expire: period after which an entry in cache is considered expired
     :param cache: SimpleCache object, if created separately
+    :param single_flight: on a miss, let only one caller recompute the value; concurrent callers in this
+                          process share its result and other processes wait on a short redis lock
+    :param lock_timeout: milliseconds after which an abandoned recompute lock frees itself
+    :param lock_wait: seconds other processes wait for the fresh value before computing it themselves
+    :param stale_ttl: seconds an expired value is still served while it is recomputed in the background
+    :param early_refresh: refresh values in the background shortly before they expire (XFetch),
+                          the earlier the longer the function takes to compute
+    :param beta: XFetch weight, above 1 refreshes earlier and below 1 later
+    :param codec: serializer for the results ('pickle', 'json', 'msgpack' or 'orjson'),
+                  defaults to json when use_json is set and pickle otherwise
+    :param version: part of every key of the function, change it to drop all its cached results at once
+    :param tags: callable receiving the arguments of a call and returning the tags of its result,
+                 ex. lambda report_id, user, org: ['user:%s' % user, 'org:%s' % org], see
+                 MyCache.invalidate_tags
     :return: decorated function
     """
     cache_ = cache    # Since python 2.x doesn't have the nonlocal keyword, we need to do this
@@ -337,50 +1284,101 @@ def cache_it(namespace=None, expire=DEFAULT_EXPIRY, cache=None, ignore_args=Fals
 
     def decorator(function):
         cache, expire = cache_, expire_
+        if is_coroutine_function(function):
+            unsupported = [name for name, value in (('single_flight', single_flight), ('stale_ttl', stale_ttl),
+                                                    ('early_refresh', early_refresh), ('tags', tags))
+                           if value]
+            if unsupported:
+                raise ValueError("Not supported on coroutine functions: {0}".format(', '.join(unsupported)))
+            from async_cache import async_cache_it
+            return async_cache_it(function, namespace=namespace, expire=expire, cache=cache,
+                                  ignore_args=ignore_args, use_json=use_json, codec=codec, version=version)
         if cache is None:
-            cache = MIOCache(namespace=namespace)
+            cache = MyCache()
+        flight = SingleFlight()
+        codec_ = codec or ('json' if use_json else 'pickle')
+        legacy = json.loads if use_json else pickle.loads
+        swr = bool(expire and (stale_ttl or early_refresh))
+        metrics = cache.metrics_registry.series(namespace, function.__name__)
+        keys = KeyBuilder(cache.tag(namespace), function.__name__, ignore_args, version, hashed=cache.hashkeys)
+        versioned = cache.generations is not None and bool(namespace)
+        if versioned:
+            cache.versioned_namespaces.add(namespace)
 
         @wraps(function)
         def func(*args, **kwargs):
-            # Handle cases where caching is down or otherwise not available.
-            if cache.connection is None or cache.ping() is False:
+            # Handle cases where caching is down or otherwise not available, without a round trip.
+            # The breaker is asked once per call: in half-open state its answer is the probe, which
+            # get_value and store_value then send and report on.
+            if not cache.available():
                 result = function(*args, **kwargs)
                 return result
 
-            # serializer = json if use_json else pickle
-            fetcher = cache.get_json if use_json else cache.get_pickle
-            # This way, you need to make sure all args must be json or pcikle serializable.
-            storer = cache.store_json if use_json else cache.store_pickle
+            cache_key = keys.key(args, kwargs, cache.versioned_namespace(namespace) if versioned else None)
 
-            cache_key = cache_create_key(namespace, ignore_args, func.__name__, *args, **kwargs)
+            def fetch():
+                try:
+                    return cache.get_value(cache_key, legacy=legacy, metrics=metrics, checked=True)
 
-            try:
+                except Exception as e:
+                    # Add some sort of cache miss handing here.
+                    metrics.error()
+                except:
+                    cache._log.info("Unknown redis-cache error. Please check your Redis free space.")
+                return MISSING
+
+            def compute():
                 start = timer.time()
-                result = fetcher(cache_key)
-                msg = "Cache took {0} to retireve data from the Redis Server".format(float(timer.time() - start))
-                cache._log.info(msg)
+                try:
+                    result = function(*args, **kwargs)
+                except DoNotCache as e:
+                    result = e.result
+                else:
+                    try:
+                        entry_tags = tags(*args, **kwargs) if tags is not None else None
+                        if swr:
+                            entry = make_entry(result, timer.time() - start, expire)
+                            cache.store_value(cache_key, entry, expire + stale_ttl, codec=codec_, metrics=metrics,
+                                              tags=entry_tags, checked=True)
+                        else:
+                            cache.store_value(cache_key, result, expire, codec=codec_, metrics=metrics,
+                                              tags=entry_tags, checked=True)
+                    except redis.ConnectionError as e:
+                        logging.exception(e)
+
                 return result
 
-            except Exception as e:
-                # Add some sort of cache miss handing here.
-                pass
-            except:
-                cache._log.info("Unknown redis-cache error. Please check your Redis free space.")
+            def refresh():
+                # Only one process refreshes a given entry, the others keep serving the current one.
+                lock = RedisLock(cache.connection, cache_key + REFRESH_SUFFIX, lock_timeout)
+                if lock.acquire():
+                    try:
+                        compute()
+                    finally:
+                        lock.release()
 
-            try:
-                result = function(*args, **kwargs)
-            except Exception as e:
-                result = e.result
-            else:
-                try:
-                    start = timer.time()
-                    storer(cache_key, result, expire)
-                    msg = "Cache took {0} to retireve data from the Redis Server".format(float(timer.time() - start))
-                    cache._log.info(msg)
-                except redis.ConnectionError as e:
-                    logging.exception(e)
+            def fetch_value():
+                result = fetch()
+                if swr and result is not MISSING:
+                    return result[0] if is_entry(result) else MISSING
+                return result
 
-            return result
+            result = fetch()
+            if swr and result is not MISSING:
+                if not is_entry(result):
+                    result = MISSING  # written before stale_ttl/early_refresh was turned on
+                else:
+                    value, delta, expiry = result
+                    if timer.time() >= expiry or (early_refresh and should_refresh(delta, expiry, beta)):
+                        get_refresher().submit(cache_key, refresh)
+                    return value
+            if result is not MISSING:
+                return result
+
+            if single_flight:
+                return flight.do(cache_key, fetch_or_compute, cache.connection, cache_key, fetch_value, compute,
+                                 lock_timeout=lock_timeout, lock_wait=lock_wait)
+            return compute()
         return func
     return decorator
 
@@ -396,6 +1394,85 @@ def cache_it_json(expire=DEFAULT_EXPIRY, cache=None, namespace=None, view=True):
     return cache_it(expire=expire, use_json=True, cache=cache, namespace=None)
 
 
+def cache_it_many(namespace=None, expire=DEFAULT_EXPIRY, cache=None, codec=None, as_dict=False, version=None):
+    """
+    Caches functions taking a list of ids as first argument, ex. load_users(ids), one entry per id.
+    All ids are looked up with a single MGET, the function is called with the missing ids only and
+    its results are written back in one pipeline. The function must return either a dict of id to
+    value or a list of values in the order of the ids it was given; ids it returns nothing for are
+    not cached. Remaining arguments are part of the key, so they must be pickleable.
+    :param expire: period after which an entry in cache is considered expired
+    :param cache: MyCache object, if created separately
+    :param codec: serializer for the values, pickle by default
+    :param as_dict: return an ordered dict of id to value instead of a list of values
+    :param version: part of every key of the function, change it to drop all its cached results at once
+    :return: decorated function returning the values in the order of the requested ids
+    """
+    cache_ = cache  # Since python 2.x doesn't have the nonlocal keyword, we need to do this
+
+    def decorator(function):
+        cache = cache_
+        if cache is None:
+            cache = MyCache()
+        serializer = cache.serializer_for(codec)
+        keys = KeyBuilder(None, function.__name__, version=version)
+        if cache.generations is not None and namespace:
+            cache.versioned_namespaces.add(namespace)
+
+        @wraps(function)
+        def func(ids, *args, **kwargs):
+            ids = list(ids)
+            if not ids or not cache.available():
+                return function(ids, *args, **kwargs)
+
+            base = ':'.join(part for part in
+                            [cache.versioned_namespace(namespace), function.__name__, keys.key(args, kwargs)]
+                            if part)
+            unique = list(OrderedDict.fromkeys(ids))
+            cache_keys = dict((id_, '{0}:{1}'.format(base, id_)) for id_ in unique)
+
+            found = {}
+            missing = unique
+            reader = cache.reader()
+            try:
+                values = reader.mget([cache_keys[id_] for id_ in unique])
+                cache.breaker.record_success()
+                missing = []
+                for id_, value in zip(unique, values):
+                    if value is None:
+                        missing.append(id_)
+                    else:
+                        found[id_] = serializer.loads(value)
+            except redis.RedisError as e:
+                cache.command_failed(e, reader)
+                cache._log.error('Error while getting multiple keys. \nERROR: {}'.format(str(e)))
+
+            if missing:
+                result = function(missing, *args, **kwargs)
+                fresh = result if isinstance(result, dict) else dict(zip(missing, result))
+                try:
+                    pipe = cache.connection.pipeline(transaction=False)
+                    for id_, value in fresh.items():
+                        if id_ in cache_keys:
+                            pipe.set(cache_keys[id_], serializer.dumps(value), ex=expire)
+                    pipe.execute()
+                except redis.RedisError as e:
+                    cache.command_failed(e)
+                    cache._log.error('Error while storing multiple keys. \nERROR: {}'.format(str(e)))
+                found.update(fresh)
+
+            if as_dict:
+                return OrderedDict((id_, found[id_]) for id_ in ids if id_ in found)
+            return [found.get(id_) for id_ in ids]
+        return func
+    return decorator
+
+
+def is_coroutine_function(function):
+    iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', None)
+    return iscoroutinefunction is not None and iscoroutinefunction(function)
+
+
 def to_unicode(obj, encoding='utf-8'):
     if isinstance(obj, basestring):
         if not isinstance(obj, unicode):
@@ -0,0 +1,291 @@
+"""
+Canonical cache keys for the arguments of decorated functions.
+
+Arguments are encoded into bytes with a type tag and, for strings and
+containers, a length prefix, so f(1, 23) and f(12, 3), f(1) and f('1') or
+f([1]) and f((1,)) never share a key. Keyword arguments are sorted by name and
+dict or set elements by their encoding, so keys do not depend on ordering.
+-0.0 is encoded as 0.0 since both compare equal; on Python 2, str arguments
+are encoded like unicode ones so keys are the same on both versions. Objects
+of other types are tagged with their type name and encoded with str(), or
+with their __cache_key__() method when they have one.
+
+The encoding is hashed with blake2b (md5 on Python 2, which lacks it); xxh3
+is available through set_hash() when the xxhash package is installed. Every
+process sharing a cache must use the same hash.
+"""
+import hashlib
+import threading
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    unicode
+except NameError:  # Python 3
+    unicode = str
+    long = int
+
+DEFAULT_MEMO_SIZE = 256
+
+_hashes = {'md5': lambda data: hashlib.md5(data).hexdigest()}
+if hasattr(hashlib, 'blake2b'):
+    _hashes['blake2b'] = lambda data: hashlib.blake2b(data, digest_size=16).hexdigest()
+if xxhash is not None:
+    _hashes['xxh3'] = lambda data: xxhash.xxh3_128_hexdigest(data)
+
+_hash_name = 'blake2b' if 'blake2b' in _hashes else 'md5'
+_hash = _hashes[_hash_name]
+
+
+def set_hash(name):
+    """
+    Selects the hash used for keys built from now on: 'blake2b', 'md5' or 'xxh3'.
+    Changing it changes every key, so cached entries are recomputed once.
+    """
+    global _hash_name, _hash
+    if name not in _hashes:
+        raise ValueError("Unknown or unavailable hash %r, choose from %s" % (name, sorted(_hashes)))
+    _hash_name, _hash = name, _hashes[name]
+
+
+def hash_name():
+    return _hash_name
+
+
+def digest(data):
+    """
+    :return: hex digest of bytes with the selected hash
+    """
+    return _hash(data)
+
+
+def _sized(tag, data):
+    return tag + str(len(data)).encode('ascii') + b':' + data
+
+
+def _encode_text(value, out):
+    out.append(_sized(b'u', value.encode('utf-8')))
+
+
+def _encode_bytes(value, out):
+    if bytes is str:  # Python 2, where str is also the text type
+        try:
+            value.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+        else:
+            out.append(_sized(b'u', value))
+            return
+    out.append(_sized(b'b', value))
+
+
+def _encode_int(value, out):
+    out.append(b'i' + str(int(value)).encode('ascii') + b';')
+
+
+def _encode_float(value, out):
+    out.append(b'f' + repr(value + 0.0).encode('ascii') + b';')
+
+
+def _encode_none(value, out):
+    out.append(b'N')
+
+
+def _encode_bool(value, out):
+    out.append(b'T' if value else b'F')
+
+
+def _encode_sequence(tag):
+    def encode(value, out):
+        head = tag + str(len(value)).encode('ascii')
+        types = set(map(type, value))
+        # Long lists of ids or names are common arguments; encode them without a call per item.
+        if len(types) == 1:
+            item_type = types.pop()
+            if item_type is int:
+                # repr runs in C and is unambiguous for plain ints (Python 2 longs would get an L suffix).
+                out.append(head + b'i' + repr(list(value)).encode('ascii'))
+                return
+            encoded = None
+            if item_type is unicode:
+                encoded = [item.encode('utf-8') for item in value]
+            elif item_type is bytes and bytes is str:  # Python 2 str, encoded like unicode when it is UTF-8
+                try:
+                    for item in value:
+                        item.decode('utf-8')
+                    encoded = value
+                except UnicodeDecodeError:
+                    pass
+            if encoded is not None:
+                out.append(head + b'u[' + ','.join(map(str, map(len, encoded))).encode('ascii') + b'|')
+                out.extend(encoded)
+                out.append(b']')
+                return
+        out.append(head + b'[')
+        for item in value:
+            _encode(item, out)
+        out.append(b']')
+    return encode
+
+
+def _encode_set(value, out):
+    items = sorted(encode_value(item) for item in value)
+    out.append(b's' + str(len(items)).encode('ascii') + b'[')
+    out.extend(items)
+    out.append(b']')
+
+
+def _encode_dict(value, out):
+    items = sorted((encode_value(k), encode_value(v)) for k, v in value.items())
+    out.append(b'd' + str(len(items)).encode('ascii') + b'{')
+    for k, v in items:
+        out.append(k)
+        out.append(v)
+    out.append(b'}')
+
+
+def _encode_object(value, out):
+    cache_key = getattr(value, '__cache_key__', None)
+    text = cache_key() if cache_key is not None else str(value)
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    cls = type(value)
+    out.append(_sized(b'o', ('%s.%s' % (cls.__module__, cls.__name__)).encode('utf-8')))
+    out.append(_sized(b'=', text))
+
+
+_encoders = {
+    unicode: _encode_text,
+    bytes: _encode_bytes,
+    bool: _encode_bool,
+    int: _encode_int,
+    long: _encode_int,
+    float: _encode_float,
+    type(None): _encode_none,
+    list: _encode_sequence(b'l'),
+    tuple: _encode_sequence(b't'),
+    set: _encode_set,
+    frozenset: _encode_set,
+    dict: _encode_dict,
+}
+
+# Exact types which compare equal only to values with the same encoding, the
+# ones argument tuples may be memoized for (1 == 1.0 == True, so types are part
+# of the memo key).
+_memo_types = frozenset([unicode, bytes, bool, int, long, float, type(None)])
+
+
+def _encode(value, out):
+    encoder = _encoders.get(type(value))
+    if encoder is None:
+        # Subclasses (OrderedDict, namedtuple, IntEnum...) are encoded like their base type.
+        for base, base_encoder in _encoders.items():
+            if base is not bool and isinstance(value, base):
+                encoder = base_encoder
+                break
+        else:
+            encoder = _encode_object
+    encoder(value, out)
+
+
+def encode_value(value):
+    out = []
+    _encode(value, out)
+    return b''.join(out)
+
+
+def encode_args(args, kwargs, head=b''):
+    """
+    :param head: bytes put in front of the encoded arguments, ex. a version salt
+    :return: canonical bytes of a call's arguments
+    """
+    out = [head]
+    _encode(tuple(args), out)
+    if kwargs:
+        out.append(b'k' + str(len(kwargs)).encode('ascii') + b'{')
+        for name in sorted(kwargs):
+            _encode_text(name, out)
+            _encode(kwargs[name], out)
+        out.append(b'}')
+    return b''.join(out)
+
+
+class KeyBuilder(object):
+    """
+    Builds the cache keys of one decorated function.
+    :param namespace: leading key part, the key is namespace:function:digest when set
+    :param ignore_args: only the first positional argument is part of the key
+    :param version: salt changing every key of the function, bump it when its results change shape
+    :param hashed: False puts the canonical encoding itself in the key instead of its digest
+    :param memo_size: number of recent argument tuples whose key is remembered, 0 disables it
+    """
+    def __init__(self, namespace, func_name, ignore_args=False, version=None, hashed=True,
+                 memo_size=DEFAULT_MEMO_SIZE):
+        self.namespace = namespace
+        self.func_name = func_name
+        self.ignore_args = ignore_args
+        self.version = version
+        self.hashed = hashed
+        self.memo_size = memo_size
+        self._prefix = ':'.join([namespace, func_name, '']) if namespace else ''
+        # Without a namespace the key is the bare digest, so the function name goes into it.
+        self._head = b''.join([_sized(b'n', func_name.encode('utf-8')) if not namespace else b'',
+                               _sized(b'v', str(version).encode('utf-8')) if version is not None else b''])
+        self._memo = {}
+        self._memo_hash = None
+
+    def key(self, args, kwargs, namespace=None):
+        """
+        :param namespace: leading key part used instead of the one of the builder, ex. the namespace
+                          with its generation; only for builders created with a namespace
+        """
+        if self.ignore_args:
+            args, kwargs = args[:1], None
+        memo_key = None
+        if self.memo_size:
+            # Flat arguments of plain types are remembered; types are part of the memo key since 1 == 1.0 == True.
+            types = tuple(map(type, args))
+            if kwargs:
+                items = tuple(sorted(kwargs.items()))
+                types += tuple([type(value) for _, value in items])
+            if _memo_types.issuperset(types):
+                memo_key = (args, items, types) if kwargs else (args, types)
+                if self._memo_hash != _hash_name:
+                    self._memo, self._memo_hash = {}, _hash_name
+                key = self._memo.get(memo_key)
+                if key is not None:
+                    return self.prefix(namespace) + key
+
+        encoded = encode_args(args, kwargs, self._head)
+        key = _hash(encoded) if self.hashed else encoded.decode('latin-1')
+
+        if memo_key is not None:
+            if len(self._memo) >= self.memo_size:
+                self._memo.clear()
+            self._memo[memo_key] = key
+        return self.prefix(namespace) + key
+
+    def prefix(self, namespace=None):
+        if namespace is None:
+            return self._prefix
+        return ':'.join([namespace, self.func_name, ''])
+
+
+_builders = {}
+_builders_lock = threading.Lock()
+
+
+def build_key(namespace, ignore_args, func_name, args, kwargs):
+    """
+    Key of a call through a KeyBuilder shared by every caller passing the same
+    namespace/function, so ad-hoc callers benefit from the memo too.
+    """
+    builder = _builders.get((namespace, func_name, ignore_args))
+    if builder is None:
+        with _builders_lock:
+            if len(_builders) >= 1024:
+                _builders.clear()
+            builder = _builders[(namespace, func_name, ignore_args)] = KeyBuilder(namespace, func_name, ignore_args)
+    return builder.key(args, kwargs)
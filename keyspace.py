@@ -0,0 +1,71 @@
+"""
+Incremental keyspace helpers shared by MyCache and MIOCache.
+
+Bulk operations walk the keyspace with SCAN instead of KEYS, so Redis is never
+blocked for longer than one SCAN page, and remove keys with UNLINK (reclaiming
+memory in a background thread on the server) in pipelined batches of bounded
+size. Servers older than 4.0 fall back to DEL.
+"""
+import redis
+
+DEFAULT_SCAN_COUNT = 1000
+DEFAULT_DELETE_BATCH = 500
+
+_unlink_supported = True
+
+
+def iter_keys(connection, pattern=None, count=DEFAULT_SCAN_COUNT):
+    """
+    Generator over the keys matching pattern, fetched `count` at a time.
+    A key may be yielded more than once if the keyspace is rehashed meanwhile.
+    """
+    return connection.scan_iter(match=pattern, count=count)
+
+
+def iter_batches(iterable, size):
+    """
+    Generator of lists holding at most size consecutive items of iterable.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def unlink_keys(connection, keys, batch_size=DEFAULT_DELETE_BATCH, progress=None):
+    """
+    Removes keys from an iterable in pipelined batches of at most batch_size keys.
+    :param connection: redis client
+    :param keys: iterable of keys, typically iter_keys()
+    :param batch_size: max number of keys sent per round trip
+    :param progress: optional callable receiving the number of keys removed so far
+    :return: number of keys removed
+    """
+    removed = 0
+    for batch in iter_batches(keys, batch_size):
+        removed += _unlink_batch(connection, batch)
+        if progress is not None:
+            progress(removed)
+    return removed
+
+
+def _unlink_batch(connection, batch):
+    global _unlink_supported
+    pipe = connection.pipeline(transaction=False)
+    # Split large batches so that no single command carries an unbounded argument list.
+    for i in range(0, len(batch), 100):
+        if _unlink_supported:
+            pipe.unlink(*batch[i:i + 100])
+        else:
+            pipe.delete(*batch[i:i + 100])
+    try:
+        return sum(pipe.execute())
+    except redis.ResponseError as e:
+        if not _unlink_supported or 'unknown command' not in str(e).lower():
+            raise
+        _unlink_supported = False
+        return _unlink_batch(connection, batch)
@@ -0,0 +1,174 @@
+"""
+Chunked, zero-copy storage of large pickled values.
+
+Values are pickled with protocol 5, so the data of objects supporting
+out-of-band buffers (NumPy arrays, bytearrays, pickle.PickleBuffer) is handed
+over as memoryviews instead of being copied into the pickle stream. The stream
+and the buffers are cut into chunks of at most chunk_size bytes, still
+memoryviews over the original memory, and written under sub-keys in a single
+pipeline followed by a small manifest stored under the key itself.
+
+Reading fetches the manifest, then every chunk in one pipeline, copying each
+reply once into a preallocated buffer and dropping it; the unpickled objects
+use that buffer directly. Pickle protocol 5 needs Python 3.8, elsewhere
+chunking_supported() is False and values take the regular codec path.
+"""
+import json
+import pickle
+import re
+import struct
+import uuid
+from local_cache import MISSING
+from serializers import MAGIC, HEADER_SIZE, MANIFEST_CODEC_ID
+
+PROTOCOL = 5
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# Written under the key instead of an encoded value, see serializers.MANIFEST_CODEC_ID.
+MANIFEST_HEADER = MAGIC + struct.pack('B', MANIFEST_CODEC_ID << 4)
+CHUNK_KEY = re.compile(br':chunk:[0-9a-f]{16}:[0-9]+$')
+
+
+def chunking_supported():
+    return pickle.HIGHEST_PROTOCOL >= PROTOCOL
+
+
+def pickle_frames(value):
+    """
+    Pickles value with its buffers out-of-band.
+    :return: memoryviews of the pickle stream and of every buffer; without buffers the stream
+             is a regular pickle of value
+    """
+    buffers = []
+    frames = [memoryview(pickle.dumps(value, PROTOCOL, buffer_callback=buffers.append))]
+    for buffer in buffers:
+        try:
+            frames.append(buffer.raw())
+        except BufferError:  # not contiguous, has to be copied
+            frames.append(memoryview(bytes(buffer)))
+    return frames
+
+
+def split_frames(frames, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    :return: (sizes of frames, list of memoryview chunks of at most chunk_size bytes)
+    """
+    chunks = [frame[offset:offset + chunk_size]
+              for frame in frames for offset in range(0, frame.nbytes, chunk_size)]
+    return [frame.nbytes for frame in frames], chunks
+
+
+def split_value(value, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Pickles value with its buffers out-of-band.
+    :return: (sizes of the pickle stream and of every buffer, list of memoryview chunks)
+    """
+    return split_frames(pickle_frames(value), chunk_size)
+
+
+def is_manifest(data):
+    return data is not None and data[:HEADER_SIZE] == MANIFEST_HEADER
+
+
+def read_manifest(connection, key):
+    """
+    Reads the manifest stored under key with a GETRANGE of its header first, so that a plain
+    value is never transferred just to find out it is not a manifest.
+    :return: the manifest, or None if key holds no manifest
+    """
+    if connection.getrange(key, 0, HEADER_SIZE - 1) != MANIFEST_HEADER:
+        return None
+    return connection.get(key)
+
+
+def encode_manifest(sizes, chunk_count, token):
+    return MANIFEST_HEADER + json.dumps({'frames': sizes, 'chunks': chunk_count, 'id': token}).encode('utf-8')
+
+
+def decode_manifest(data):
+    return json.loads(data[HEADER_SIZE:].decode('utf-8'))
+
+
+def chunk_keys(key, manifest):
+    """
+    :return: sub-keys holding the chunks described by manifest; every write uses a new id, so
+             readers never mix chunks of two versions
+    """
+    return ['{0}:chunk:{1}:{2}'.format(key, manifest['id'], index) for index in range(manifest['chunks'])]
+
+
+def is_chunk_key(key):
+    """
+    :return: True if key is one of the sub-keys written by store_chunks
+    """
+    return CHUNK_KEY.search(key if isinstance(key, bytes) else key.encode('utf-8')) is not None
+
+
+def store_chunks(connection, key, sizes, chunks, expire=None, previous=None):
+    """
+    Writes chunks from split_value() and their manifest in one pipeline, chunks first.
+    :param expire: ttl of the key and of every chunk
+    :param previous: value previously stored under key; the chunks of an older manifest are unlinked
+    :return: number of bytes written
+    """
+    manifest = {'frames': sizes, 'chunks': len(chunks), 'id': uuid.uuid4().hex[:16]}
+    pipe = connection.pipeline(transaction=False)
+    for chunk_key, chunk in zip(chunk_keys(key, manifest), chunks):
+        pipe.set(chunk_key, chunk, ex=expire)
+    data = encode_manifest(sizes, len(chunks), manifest['id'])
+    pipe.set(key, data, ex=expire)
+    if is_manifest(previous):
+        pipe.unlink(*chunk_keys(key, decode_manifest(previous)))
+    pipe.execute()
+    return sum(sizes) + len(data)
+
+
+def load_chunks(connection, key, data):
+    """
+    Fetches and unpickles the value of a manifest read from key.
+    :return: the value, or MISSING if a chunk expired or was replaced meanwhile
+    """
+    manifest = decode_manifest(data)
+    pipe = connection.pipeline(transaction=False)
+    for chunk_key in chunk_keys(key, manifest):
+        pipe.get(chunk_key)
+    return join_chunks(manifest, pipe.execute())
+
+
+def join_chunks(manifest, replies):
+    """
+    Unpickles a value from the replies of GET for each of the chunk keys of its manifest.
+    :return: the value, or MISSING if a chunk expired or was replaced meanwhile
+    """
+    total = sum(manifest['frames'])
+    buffer = bytearray(total)
+    view = memoryview(buffer)
+    offset = 0
+    for index, chunk in enumerate(replies):
+        if chunk is None or offset + len(chunk) > total:
+            return MISSING
+        view[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+        replies[index] = None  # release the reply as soon as it is copied
+    if offset != total:
+        return MISSING
+
+    frames, offset = [], 0
+    for size in manifest['frames']:
+        frames.append(view[offset:offset + size])
+        offset += size
+    return pickle.loads(frames[0], buffers=frames[1:])
+
+
+def chunks_of(key, data):
+    """
+    :return: sub-keys of the chunks of a manifest read from key, none if data is not a manifest
+    """
+    return chunk_keys(key, decode_manifest(data)) if is_manifest(data) else []
+
+
+def drop_chunks(connection, key, data):
+    """
+    Unlinks the chunks of a manifest read from key.
+    """
+    if is_manifest(data):
+        connection.unlink(*chunks_of(key, data))
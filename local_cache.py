@@ -0,0 +1,213 @@
+"""
+In-process (L1) cache tier that sits in front of the Redis lookups in MyCache.
+
+Values are kept already unpickled in a bounded, TTL-limited LRU. Coherence
+across processes is maintained by an InvalidationListener which evicts local
+copies whenever Redis reports that a key was written, deleted or expired,
+either through keyspace notifications or CLIENT TRACKING (Redis >= 6) messages.
+"""
+from collections import OrderedDict
+import logging
+import threading
+import time
+import redis
+
+# Returned by LocalCache.get (and the cache_it fetch helpers) for keys that are
+# not held, so that a cached None can be told apart from a miss.
+MISSING = object()
+
+KEYSPACE = 'keyspace'
+TRACKING = 'tracking'
+
+
+class LocalCache(object):
+    """
+    Thread-safe LRU of at most `maxsize` entries, each living for `ttl` seconds.
+    """
+    def __init__(self, maxsize=1000, ttl=5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        :param key: full redis key
+        :return: the locally held value or MISSING
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            if entry[1] <= now:
+                self.misses += 1
+                self.evictions += 1
+                return MISSING
+            # Re-insert to mark it as the most recently used entry.
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + self.ttl)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def invalidate_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def after_fork(self):
+        """
+        Empties the tier in a forked child, whose invalidation listener is yet to start.
+        """
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def stats(self):
+        """
+        :return: dict with the hit/miss/eviction/invalidation counters and current size
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'size': len(self._data)}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class InvalidationListener(threading.Thread):
+    """
+    Background thread evicting LocalCache entries on server-side changes.
+
+    mode='keyspace' subscribes to __keyspace@<db>__ notifications; the server must
+    have `notify-keyspace-events` containing K plus the g, $, x and e classes.
+    mode='tracking' uses CLIENT TRACKING in broadcast mode, redirected to the
+    listener's own connection, and needs no server configuration.
+
+    Whenever the subscription is lost the whole local cache is cleared, since
+    invalidations may have been missed in the meantime.
+    """
+    def __init__(self, connection, cache, db=0, prefix='', mode=KEYSPACE, log=None, retry_interval=1):
+        super(InvalidationListener, self).__init__(name='redis-l1-invalidation')
+        self.daemon = True
+        self.connection = connection
+        self.cache = cache
+        self.db = db
+        self.prefix = prefix or ''
+        self.mode = mode
+        self.retry_interval = retry_interval
+        self._log = log or logging.getLogger(__name__)
+        self._stop_event = threading.Event()
+        self._pubsub = None
+        self._tracking_conn = None
+        self._tracking_pool = None
+
+    def stop(self):
+        self._stop_event.set()
+        self._close()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._subscribe()
+                while not self._stop_event.is_set():
+                    message = self._pubsub.get_message(timeout=1.0)
+                    if message and message['type'] in ('message', 'pmessage'):
+                        self._handle(message)
+            except (redis.ConnectionError, redis.TimeoutError, redis.ResponseError) as e:
+                self._log.error('L1 invalidation subscription lost, clearing local cache. ERROR: %s' % e)
+            except Exception:
+                if self._stop_event.is_set():
+                    break
+                self._log.exception('Unexpected error in L1 invalidation listener')
+            self.cache.clear()
+            self._close()
+            self._stop_event.wait(self.retry_interval)
+
+    def _subscribe(self):
+        self._pubsub = self.connection.pubsub(ignore_subscribe_messages=True)
+        if self.mode == TRACKING:
+            # The tracking client must be told which connection receives the
+            # invalidation messages, so grab the pub/sub connection up front.
+            pool = self.connection.connection_pool
+            conn = pool.get_connection()
+            conn.send_command('CLIENT', 'ID')
+            client_id = conn.read_response()
+            self._pubsub.connection = conn
+            self._pubsub.subscribe('__redis__:invalidate')
+
+            self._tracking_conn = pool.get_connection()
+            self._tracking_pool = pool
+            args = ['CLIENT', 'TRACKING', 'on', 'REDIRECT', client_id, 'BCAST']
+            if self.prefix:
+                args.extend(['PREFIX', self.prefix])
+            self._tracking_conn.send_command(*args)
+            self._tracking_conn.read_response()
+        else:
+            self._pubsub.psubscribe('__keyspace@{0}__:{1}*'.format(self.db, self.prefix))
+        # Anything cached before the subscription was in place may be stale.
+        self.cache.clear()
+
+    def _handle(self, message):
+        if self.mode == TRACKING:
+            keys = message['data']
+            if keys is None:  # FLUSHDB / FLUSHALL
+                self.cache.clear()
+                return
+            if not isinstance(keys, list):
+                keys = [keys]
+            for key in keys:
+                self.cache.invalidate(_decode(key))
+        else:
+            channel = _decode(message['channel'])
+            self.cache.invalidate(channel.split(':', 1)[1])
+
+    def _close(self):
+        if self._tracking_conn is not None:
+            # Dropping the connection also switches tracking off on the server.
+            try:
+                self._tracking_conn.disconnect()
+                self._tracking_pool.release(self._tracking_conn)
+            except Exception:
+                pass
+            self._tracking_conn = None
+        if self._pubsub is not None:
+            try:
+                self._pubsub.close()
+            except Exception:
+                pass
+            self._pubsub = None
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value
+    return value
@@ -0,0 +1,268 @@
+"""
+In-process metrics for the cache layer.
+
+Every cache owns a Series per (namespace, function) label pair, created once
+and kept by the caller, so recording an operation is a handful of integer
+increments and bisects on fixed bucket bounds. Recording takes no lock to stay
+well under a microsecond: with many threads a rare increment may be lost to a
+thread switch, which is fine for dashboards but means counts are not exact.
+Reads record the network round trip and the deserialization time separately,
+writes the serialization and network time, and both the payload size.
+
+The Metrics registry renders everything as a stats() snapshot or in the
+Prometheus text exposition format, ready to be served from a /metrics view.
+"""
+from bisect import bisect_left
+import threading
+import time
+
+try:
+    clock = time.perf_counter
+except AttributeError:  # Python 2
+    clock = time.time
+
+# Upper bounds in seconds, from 100us round trips on a LAN to a stalled server.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Upper bounds in bytes, the last ones being values worth compressing or splitting.
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Histogram(object):
+    """
+    Fixed bucket histogram; counts[i] holds observations <= bounds[i], the last slot the overflow.
+    """
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        :return: list of (upper bound, observations <= bound), ending with ('+Inf', count)
+        """
+        total, buckets = 0, []
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+    def snapshot(self):
+        count = self.count
+        return {'count': count,
+                'sum': self.sum,
+                'mean': float(self.sum) / count if count else 0.0,
+                'buckets': self.cumulative()}
+
+
+class Series(object):
+    """
+    Counters and histograms of one namespace/function pair.
+    """
+    def __init__(self, registry, namespace, function):
+        self.registry = registry
+        self.namespace = namespace
+        self.function = function
+        self.histograms = {
+            ('network_seconds', 'get'): Histogram(LATENCY_BUCKETS),
+            ('network_seconds', 'set'): Histogram(LATENCY_BUCKETS),
+            ('serialization_seconds', 'loads'): Histogram(LATENCY_BUCKETS),
+            ('serialization_seconds', 'dumps'): Histogram(LATENCY_BUCKETS),
+            ('payload_bytes', 'get'): Histogram(SIZE_BUCKETS),
+            ('payload_bytes', 'set'): Histogram(SIZE_BUCKETS),
+        }
+        self._get = self.histograms[('network_seconds', 'get')]
+        self._set = self.histograms[('network_seconds', 'set')]
+        self._loads = self.histograms[('serialization_seconds', 'loads')]
+        self._dumps = self.histograms[('serialization_seconds', 'dumps')]
+        self._read_bytes = self.histograms[('payload_bytes', 'get')]
+        self._write_bytes = self.histograms[('payload_bytes', 'set')]
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.writes = 0
+        for histogram in self.histograms.values():
+            histogram.reset()
+
+    def read(self, hits=1, misses=0, network=None, decode=None, size=None):
+        """
+        Records a lookup of hits + misses keys.
+        :param network: seconds spent on the round trip, None for values served locally
+        :param decode: seconds spent deserializing the values found
+        :param size: bytes received
+        """
+        if not self.registry.enabled:
+            return
+        self.hits += hits
+        self.misses += misses
+        # Histogram.observe inlined, this is the hot path of every lookup.
+        if network is not None:
+            histogram = self._get
+            histogram.counts[bisect_left(LATENCY_BUCKETS, network)] += 1
+            histogram.sum += network
+        if decode is not None:
+            histogram = self._loads
+            histogram.counts[bisect_left(LATENCY_BUCKETS, decode)] += 1
+            histogram.sum += decode
+        if size:
+            histogram = self._read_bytes
+            histogram.counts[bisect_left(SIZE_BUCKETS, size)] += 1
+            histogram.sum += size
+
+    def write(self, network=None, encode=None, size=None, count=1):
+        """
+        Records count values written.
+        :param network: seconds spent sending them, None when queued for write-behind
+        :param encode: seconds spent serializing them
+        :param size: bytes sent
+        """
+        if not self.registry.enabled:
+            return
+        self.writes += count
+        # Histogram.observe inlined as in read(), every write goes through here.
+        if network is not None:
+            histogram = self._set
+            histogram.counts[bisect_left(LATENCY_BUCKETS, network)] += 1
+            histogram.sum += network
+        if encode is not None:
+            histogram = self._dumps
+            histogram.counts[bisect_left(LATENCY_BUCKETS, encode)] += 1
+            histogram.sum += encode
+        if size:
+            histogram = self._write_bytes
+            histogram.counts[bisect_left(SIZE_BUCKETS, size)] += 1
+            histogram.sum += size
+
+    def error(self):
+        if self.registry.enabled:
+            self.errors += 1
+
+    def snapshot(self):
+        lookups = self.hits + self.misses
+        return {'namespace': self.namespace,
+                'function': self.function,
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors,
+                'writes': self.writes,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                'histograms': dict(('%s:%s' % key, histogram.snapshot())
+                                   for key, histogram in self.histograms.items())}
+
+
+class Metrics(object):
+    """
+    Registry of the Series of every cache and decorated function in the process.
+    :param enabled: False turns every recording call into a no-op
+    """
+    HELP = {
+        'requests_total': ('counter', 'Cache lookups by result.'),
+        'writes_total': ('counter', 'Values written to the cache.'),
+        'network_seconds': ('histogram', 'Time spent on the redis round trip.'),
+        'serialization_seconds': ('histogram', 'Time spent encoding or decoding values.'),
+        'payload_bytes': ('histogram', 'Size of the values read or written.'),
+    }
+
+    def __init__(self, enabled=True, prefix='redis_cache'):
+        self.enabled = enabled
+        self.prefix = prefix
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def series(self, namespace=None, function=None):
+        """
+        :return: the Series of the namespace/function pair, created on first use
+        """
+        key = (namespace or '', function or '')
+        series = self._series.get(key)
+        if series is None:
+            with self._lock:
+                series = self._series.get(key)
+                if series is None:
+                    series = self._series[key] = Series(self, key[0], key[1])
+        return series
+
+    def reset(self):
+        for series in list(self._series.values()):
+            series.reset()
+
+    def stats(self):
+        """
+        :return: list of per namespace/function snapshots
+        """
+        return [self._series[key].snapshot() for key in sorted(self._series)]
+
+    def prometheus(self):
+        """
+        :return: all metrics in the Prometheus text exposition format
+        """
+        snapshots = self.stats()
+        lines = []
+
+        def header(name):
+            kind, text = self.HELP[name]
+            lines.append('# HELP %s_%s %s' % (self.prefix, name, text))
+            lines.append('# TYPE %s_%s %s' % (self.prefix, name, kind))
+
+        header('requests_total')
+        for s in snapshots:
+            for result, field in (('hit', 'hits'), ('miss', 'misses'), ('error', 'errors')):
+                lines.append('%s_requests_total{%s,result="%s"} %d' % (self.prefix, _labels(s), result, s[field]))
+        header('writes_total')
+        for s in snapshots:
+            lines.append('%s_writes_total{%s} %d' % (self.prefix, _labels(s), s['writes']))
+        for name in ('network_seconds', 'serialization_seconds', 'payload_bytes'):
+            header(name)
+            for s in snapshots:
+                for key in sorted(s['histograms']):
+                    metric, op = key.split(':')
+                    if metric != name:
+                        continue
+                    histogram = s['histograms'][key]
+                    labels = '%s,op="%s"' % (_labels(s), op)
+                    for bound, count in histogram['buckets']:
+                        lines.append('%s_%s_bucket{%s,le="%s"} %d' % (self.prefix, name, labels, bound, count))
+                    lines.append('%s_%s_sum{%s} %r' % (self.prefix, name, labels, float(histogram['sum'])))
+                    lines.append('%s_%s_count{%s} %d' % (self.prefix, name, labels, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(snapshot):
+    return 'namespace="%s",function="%s"' % (_escape(snapshot['namespace']), _escape(snapshot['function']))
+
+
+registry = Metrics()
+
+
+def get_metrics():
+    """
+    :return: the process-wide Metrics registry caches record to by default
+    """
+    return registry
+
+
+def stats():
+    return registry.stats()
+
+
+def prometheus():
+    return registry.prometheus()
@@ -0,0 +1,56 @@
+"""
+Fork safety for caches created before a prefork server (gunicorn, uwsgi,
+multiprocessing) forks its workers.
+
+Caches are usually created at import, in the master process. Sockets,
+background threads, thread pools and locks do not survive a fork in a usable
+state: a worker writing on a socket inherited from its parent interleaves its
+commands with those of its siblings, and a thread pool of the parent has no
+threads left in the child.
+
+Process-wide registries (connection pools, circuit breakers, the refresh pool)
+register a reset with register_after_fork(). after_fork() runs them once in
+every new process. It is called on os.fork() (Python 3.7+), by every cache
+which notices that its pid changed, which covers servers forking from C, and
+can be called from the post-fork hook of the server.
+"""
+import logging
+import os
+
+_pid = os.getpid()
+_hooks = []
+
+
+def register_after_fork(hook):
+    """
+    Registers a callable resetting process-wide state, run in the child after a fork.
+    """
+    _hooks.append(hook)
+    return hook
+
+
+def forked():
+    """
+    :return: True if this process was forked since the hooks last ran
+    """
+    return os.getpid() != _pid
+
+
+def after_fork():
+    """
+    Resets the state inherited from the parent process, once per process; does nothing in the
+    process which created it. Opens no connection.
+    """
+    global _pid
+    if not forked():
+        return
+    _pid = os.getpid()
+    for hook in _hooks:
+        try:
+            hook()
+        except Exception:
+            logging.getLogger(__name__).exception('After-fork reset %r failed' % hook)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=after_fork)
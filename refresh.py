@@ -0,0 +1,107 @@
+"""
+Stale-while-revalidate support for the cache_it decorators.
+
+When enabled, cached values are stored as entries [value, delta, expiry], where
+delta is the number of seconds the function took to compute the value and
+expiry the (logical) epoch time after which it is stale. The redis TTL is set
+to expire + stale_ttl, so stale entries stay readable for a while and can be
+served immediately while a background thread recomputes them.
+
+Entries may also be refreshed before they expire, following the XFetch rule
+(Vattani et al., "Optimal Probabilistic Cache Stampede Prevention"): a reader
+refreshes when  now - delta * beta * log(random()) >= expiry, so expensive
+functions start refreshing earlier and only a few readers trigger it.
+"""
+from multiprocessing.pool import ThreadPool
+import logging
+import math
+import random
+import threading
+import time
+from prefork import register_after_fork
+
+REFRESH_THREADS = 4
+
+
+def make_entry(value, delta, expire):
+    return [value, delta, time.time() + expire]
+
+
+def is_entry(entry):
+    return isinstance(entry, (list, tuple)) and len(entry) == 3 and \
+        isinstance(entry[1], (int, float)) and isinstance(entry[2], (int, float))
+
+
+def should_refresh(delta, expiry, beta=1.0, now=None):
+    """
+    XFetch early expiration test.
+    :param delta: seconds it took to compute the value
+    :param expiry: epoch time at which the value expires
+    :param beta: > 1 favours earlier refreshes, < 1 later ones
+    :return: True if this reader should refresh the value now
+    """
+    if now is None:
+        now = time.time()
+    return now - delta * beta * math.log(1.0 - random.random()) >= expiry
+
+
+class Refresher(object):
+    """
+    Runs refresh callables on a small thread pool, at most once at a time per key.
+    """
+    def __init__(self, threads=REFRESH_THREADS, log=None):
+        self.threads = threads
+        self._log = log or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._pool = None
+
+    def submit(self, key, function, *args, **kwargs):
+        """
+        Schedules function(*args, **kwargs) unless a refresh for key is already queued or running.
+        :return: True if the refresh was scheduled
+        """
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+            if self._pool is None:
+                self._pool = ThreadPool(self.threads)
+        self._pool.apply_async(self._run, (key, function, args, kwargs))
+        return True
+
+    def _run(self, key, function, args, kwargs):
+        try:
+            function(*args, **kwargs)
+        except Exception:
+            self._log.exception('Background refresh of %s failed' % key)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+_refresher = None
+
+
+@register_after_fork
+def forget_refresher():
+    # The thread pool of the parent has no threads in the child.
+    global _refresher
+    _refresher = None
+
+
+def get_refresher():
+    """
+    :return: process-wide Refresher shared by every decorated function
+    """
+    global _refresher
+    if _refresher is None:
+        _refresher = Refresher()
+    return _refresher
@@ -0,0 +1,129 @@
+"""
+Read routing over the replicas of a redis primary.
+
+MyCache sends its reads (GET, MGET, SCAN) to a ReplicaSet and its writes to the
+primary. Replicas are picked round-robin or by the lowest round trip measured
+by the background health check. A replica whose command fails is skipped for
+retry_interval seconds and reads fall back to the primary while no replica is
+available. The replica list can be replaced at any time, ex. with the replicas
+reported by Sentinel after a failover.
+"""
+import itertools
+import logging
+import threading
+import time
+import redis
+from sharding import node_name, parse_node
+
+ROUND_ROBIN = 'round_robin'
+LEAST_LATENCY = 'least_latency'
+READ_STRATEGIES = (ROUND_ROBIN, LEAST_LATENCY)
+
+# Weight of the latest ping in the moving average of a replica's round trip.
+LATENCY_SMOOTHING = 0.3
+
+
+class Replica(object):
+    __slots__ = ('name', 'client', 'latency', 'down_until', 'reads_failed')
+
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.latency = None
+        self.down_until = 0.0
+        self.reads_failed = 0
+
+
+class ReplicaSet(object):
+    """
+    :param replicas: 'host:port' or (host, port) of every replica
+    :param connect: callable(host, port) returning a redis client for a replica
+    :param strategy: ROUND_ROBIN or LEAST_LATENCY
+    :param retry_interval: seconds a failing replica is left out
+    """
+    def __init__(self, replicas, connect, strategy=ROUND_ROBIN, retry_interval=5.0, log=None):
+        if strategy not in READ_STRATEGIES:
+            raise ValueError("Unknown read strategy %r, choose from %s" % (strategy, READ_STRATEGIES))
+        self.connect = connect
+        self.strategy = strategy
+        self.retry_interval = retry_interval
+        self._log = log or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        self.replicas = []
+        self.update(replicas)
+
+    def update(self, replicas):
+        """
+        Replaces the replica list, keeping the state of replicas listed before.
+        """
+        names = [node_name(replica) for replica in replicas]
+        with self._lock:
+            if names == [replica.name for replica in self.replicas]:
+                return
+            known = dict((replica.name, replica) for replica in self.replicas)
+            self.replicas = [known.get(name) or Replica(name, self.connect(*parse_node(name))) for name in names]
+        self._log.info('Reading from replicas: %s' % ', '.join(names))
+
+    def after_fork(self):
+        """
+        Reconnects every replica in a forked child.
+        """
+        self._lock = threading.Lock()
+        self.replicas = [Replica(replica.name, self.connect(*parse_node(replica.name))) for replica in self.replicas]
+
+    def client(self):
+        """
+        :return: redis client of the replica to read from, None when none is available
+        """
+        replicas, now = self.replicas, time.time()
+        up = [replica for replica in replicas if replica.down_until <= now]
+        if not up:
+            return None
+        if self.strategy == LEAST_LATENCY:
+            return min(up, key=lambda replica: replica.latency or 0.0).client
+        return up[next(self._counter) % len(up)].client
+
+    def find(self, client):
+        for replica in self.replicas:
+            if replica.client is client:
+                return replica
+
+    def failed(self, client):
+        """
+        Leaves the replica behind client out for retry_interval seconds.
+        :return: True if client is one of the replicas
+        """
+        replica = self.find(client)
+        if replica is None:
+            return False
+        replica.reads_failed += 1
+        replica.down_until = time.time() + self.retry_interval
+        return True
+
+    def check(self):
+        """
+        Pings every replica, updating its round trip average and bringing it back once it answers.
+        """
+        for replica in self.replicas:
+            start = time.time()
+            try:
+                replica.client.ping()
+            except redis.RedisError as e:
+                replica.down_until = time.time() + self.retry_interval
+                self._log.debug('Replica {} failed its health check: {}'.format(replica.name, str(e)))
+                continue
+            elapsed = time.time() - start
+            replica.latency = elapsed if replica.latency is None else \
+                LATENCY_SMOOTHING * elapsed + (1 - LATENCY_SMOOTHING) * replica.latency
+            replica.down_until = 0.0
+
+    def stats(self):
+        """
+        :return: dict of replica name to its average round trip, availability and failed reads
+        """
+        now = time.time()
+        return dict((replica.name, {'latency': replica.latency,
+                                    'up': replica.down_until <= now,
+                                    'reads_failed': replica.reads_failed})
+                    for replica in self.replicas)
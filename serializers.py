@@ -0,0 +1,198 @@
+"""
+Codec registry used to encode values stored by MyCache, MIOCache and cache_it.
+
+Every encoded value starts with a two byte header: a zero magic byte, which
+neither pickle nor JSON output ever starts with, followed by one byte holding
+the codec id in its high nibble and the compression id in its low nibble.
+Values without the header were written before codecs existed and are handed
+to a legacy loader, so old and new data can be read side by side while a
+deployment migrates.
+
+pickle and json are always available; msgpack, orjson, lz4 and zstandard are
+used when installed.
+"""
+import json
+import struct
+import zlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'\x00'
+HEADER_SIZE = 2
+DEFAULT_CODEC = 'pickle'
+DEFAULT_COMPRESSION = 'zlib'
+DEFAULT_COMPRESS_THRESHOLD = 16 * 1024
+# Codec id of the manifests written by large_values in place of chunked values.
+MANIFEST_CODEC_ID = 15
+
+# name -> (id, dumps, loads) and id -> name
+_codecs = {}
+_codec_names = {}
+# name -> (id, compress, decompress) and id -> name
+_compressors = {}
+_compressor_names = {}
+
+
+def register_codec(name, codec_id, dumps, loads):
+    """
+    :param codec_id: 1-14, stored in the header of every value written with this codec
+    :param dumps: callable turning a value into bytes
+    :param loads: callable turning bytes back into the value
+    """
+    if not 0 < codec_id < MANIFEST_CODEC_ID:
+        raise ValueError("codec id must be between 1 and %s, got %s" % (MANIFEST_CODEC_ID - 1, codec_id))
+    _codecs[name] = (codec_id, dumps, loads)
+    _codec_names[codec_id] = name
+
+
+def register_compressor(name, compressor_id, compress, decompress):
+    """
+    :param compressor_id: 1-15, stored in the header of every value compressed this way
+    """
+    if not 0 < compressor_id < 16:
+        raise ValueError("compressor id must be between 1 and 15, got %s" % compressor_id)
+    _compressors[name] = (compressor_id, compress, decompress)
+    _compressor_names[compressor_id] = name
+
+
+def available_codecs():
+    return sorted(_codecs)
+
+
+def available_compressors():
+    return sorted(_compressors)
+
+
+def _json_dumps(value):
+    data = json.dumps(value)
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return data
+
+
+def _json_loads(data):
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+register_codec('pickle', 1, lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL), pickle.loads)
+register_codec('json', 2, _json_dumps, _json_loads)
+if msgpack is not None:
+    register_codec('msgpack', 3, lambda value: msgpack.packb(value, use_bin_type=True),
+                   lambda data: msgpack.unpackb(data, raw=False))
+if orjson is not None:
+    register_codec('orjson', 4, orjson.dumps, orjson.loads)
+
+register_compressor('zlib', 1, zlib.compress, zlib.decompress)
+if lz4 is not None:
+    register_compressor('lz4', 2, lz4.compress, lz4.decompress)
+if zstandard is not None:
+    register_compressor('zstd', 3, lambda data: zstandard.ZstdCompressor().compress(data),
+                        lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+
+def is_encoded(data):
+    """
+    :return: True if data carries a codec header, False for legacy values
+    """
+    return data is not None and len(data) >= HEADER_SIZE and data[:1] == MAGIC
+
+
+def codec_of(data):
+    """
+    :return: (codec name, compression name or None) of an encoded value
+    """
+    flags = struct.unpack('B', data[1:2])[0]
+    return _codec_names.get(flags >> 4), _compressor_names.get(flags & 0x0F)
+
+
+class Serializer(object):
+    """
+    Encodes values with one codec, compressing those whose encoded size reaches
+    compress_threshold. Decodes values written with any registered codec.
+    """
+    def __init__(self, codec=DEFAULT_CODEC, compression=DEFAULT_COMPRESSION,
+                 compress_threshold=DEFAULT_COMPRESS_THRESHOLD):
+        if codec not in _codecs:
+            raise ValueError("Unknown or unavailable codec %r, choose from %s" % (codec, available_codecs()))
+        if compression is not None and compression not in _compressors:
+            raise ValueError("Unknown or unavailable compression %r, choose from %s"
+                             % (compression, available_compressors()))
+        self.codec = codec
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self._codec_id, self._dumps, _ = _codecs[codec]
+        if compression is not None:
+            self._compressor_id, self._compress, _ = _compressors[compression]
+
+    def dumps(self, value):
+        return self.encode(self._dumps(value))
+
+    def encode(self, data):
+        """
+        :param data: value already encoded with the codec of this serializer
+        :return: data behind its header, compressed when it reaches compress_threshold
+        """
+        flags = self._codec_id << 4
+        if self.compression is not None and self.compress_threshold is not None \
+                and len(data) >= self.compress_threshold:
+            compressed = self._compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+                flags |= self._compressor_id
+        return MAGIC + struct.pack('B', flags) + data
+
+    def loads(self, data, legacy=pickle.loads):
+        """
+        :param data: bytes read from redis
+        :param legacy: loader for values written without a header
+        :return: decoded value
+        """
+        if not is_encoded(data):
+            return legacy(data)
+        flags = struct.unpack('B', data[1:2])[0]
+        codec_id, compressor_id = flags >> 4, flags & 0x0F
+        payload = data[HEADER_SIZE:]
+        if compressor_id:
+            name = _compressor_names.get(compressor_id)
+            if name is None:
+                raise ValueError("Value compressed with unavailable compressor id %s" % compressor_id)
+            payload = _compressors[name][2](payload)
+        name = _codec_names.get(codec_id)
+        if name is None:
+            raise ValueError("Value encoded with unavailable codec id %s" % codec_id)
+        return _codecs[name][2](payload)
+
+
+_serializers = {}
+
+
+def get_serializer(codec=DEFAULT_CODEC, compression=DEFAULT_COMPRESSION,
+                   compress_threshold=DEFAULT_COMPRESS_THRESHOLD):
+    """
+    :return: shared Serializer for the given settings
+    """
+    key = (codec, compression, compress_threshold)
+    serializer = _serializers.get(key)
+    if serializer is None:
+        serializer = _serializers[key] = Serializer(codec, compression, compress_threshold)
+    return serializer
@@ -1,10 +1,15 @@
-import ConfigParser
+try:
+    from ConfigParser import SafeConfigParser
+except ImportError:  # Python 3
+    from configparser import ConfigParser as SafeConfigParser
 import os
 import logging
+import threading
 import utils
 
 curr_env = None
 settings_dict = {}
+_load_lock = threading.RLock()
 
 
 class EnvironmentType:
@@ -25,13 +30,15 @@ class EnvSettings:
         self.REDIS_PORT = None
         self.REDIS_PASSWORD = None
         self.REDIS_DB = None
+        self.REDIS_MAX_CONNECTIONS = None
+        self.REDIS_POOL_TIMEOUT = None
 
 
 def load_settings(env=None):
     global settings_dict, curr_env
     mass_redis_settings = EnvSettings()
 
-    mass_redis_settings.cpg = ConfigParser.SafeConfigParser()
+    mass_redis_settings.cpg = SafeConfigParser()
     if env is None or env == EnvironmentType.LOCAL:
         mass_redis_settings.cpg.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), r'config.txt'))
     else:
@@ -59,6 +66,8 @@ def load_settings(env=None):
     mass_redis_settings.REDIS_PORT = mass_redis_settings.cpg.get('general', 'redis_port')
     mass_redis_settings.REDIS_PASSWORD = mass_redis_settings.cpg.get('general', 'redis_password')
     mass_redis_settings.REDIS_DB = mass_redis_settings.cpg.get('general', 'redis_db')
+    mass_redis_settings.REDIS_MAX_CONNECTIONS = get_int_option(mass_redis_settings.cpg, 'redis_max_connections', 50)
+    mass_redis_settings.REDIS_POOL_TIMEOUT = get_int_option(mass_redis_settings.cpg, 'redis_pool_timeout', 20)
 
     # For debugging purposes, log settings data
     logger.info('log_root: %s, log_name:%s, log_level:%s' % (mass_redis_settings.LOG_ROOT, mass_redis_settings.LOG_NAME,
@@ -67,13 +76,23 @@ def load_settings(env=None):
     settings_dict[mass_redis_settings.ENV] = mass_redis_settings
 
 
-def get_settings(env=None):
-    if env is None:
-        env = curr_env
+def get_int_option(cpg, option, default, section='general'):
+    if cpg.has_option(section, option) and cpg.get(section, option):
+        return cpg.getint(section, option)
+    return default
 
-    if env not in settings_dict:
-        load_settings(env)
-    return settings_dict[env]
 
-# LOAD SETTINGS
-load_settings()
+def get_settings(env=None):
+    """
+    Settings of env, the environment the app runs in by default. Nothing is read
+    at import time: config files are parsed and logging is set up on first call.
+    """
+    with _load_lock:
+        if env is None:
+            if curr_env is None:
+                load_settings()
+            env = curr_env
+
+        if env not in settings_dict:
+            load_settings(env)
+        return settings_dict[env]
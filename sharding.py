@@ -0,0 +1,440 @@
+"""
+Sharding of MyCache over several redis servers.
+
+ShardedRedis looks like a redis client to the rest of the cache layer but sends
+every command to the node owning its key. The owner is found either with the
+slot map of a Redis Cluster (CRC16 of the key modulo 16384, as the servers do)
+or, for standalone servers, on a ketama consistent hash ring, where adding a
+node only moves about 1/N of the keys. Both honour hash tags: only the part of
+a key between the first { and the following } is hashed, so a namespace
+written as {namespace}:key lives on a single node.
+
+Multi-key commands (MGET, DEL, UNLINK, EXISTS) and pipelines are split by node
+and the per-node requests run in parallel on a small thread pool. SCAN walks
+every node, or only the owner of the hash tag the pattern starts with. Nothing
+is atomic across nodes: a pipeline with transaction=True runs one MULTI/EXEC
+per node, and all keys of a script must live on the same node.
+"""
+from bisect import bisect_left
+from multiprocessing.pool import ThreadPool
+import hashlib
+import struct
+import threading
+import redis
+from redis.commands.core import Script
+from redis.crc import key_slot, REDIS_CLUSTER_HASH_SLOTS
+from redis.exceptions import AskError, ClusterDownError
+
+DEFAULT_POINTS_PER_NODE = 160
+DEFAULT_SHARD_THREADS = 8
+
+# Commands whose first argument is the only key, sent as they are to its node.
+KEYED_COMMANDS = ('get', 'getrange', 'set', 'setex', 'getex', 'incr', 'incrby', 'expire', 'pexpire', 'ttl', 'pttl',
+                  'dump', 'restore', 'sadd', 'srem', 'smembers', 'sismember', 'scard', 'spop',
+                  'zadd', 'zrem', 'zscore', 'zcard', 'zrange')
+# Commands taking any number of keys and returning how many of them matched.
+COUNTING_COMMANDS = ('delete', 'unlink', 'exists')
+
+try:
+    unicode
+except NameError:  # Python 3
+    unicode = str
+
+
+def to_bytes(key):
+    if isinstance(key, bytes):
+        return key
+    if not isinstance(key, unicode):
+        key = unicode(key)
+    return key.encode('utf-8')
+
+
+def hash_tag(key):
+    """
+    :return: bytes hashed to place key: the text between its first { and the next }, if not empty,
+             the whole key otherwise
+    """
+    key = to_bytes(key)
+    start = key.find(b'{')
+    if start > -1:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def node_name(node):
+    """
+    :param node: 'host:port' or (host, port)
+    :return: 'host:port'
+    """
+    if isinstance(node, (tuple, list)):
+        return '{0}:{1}'.format(*node)
+    return node
+
+
+def parse_node(name):
+    """
+    :return: (host, port) of a 'host:port' node name
+    """
+    host, _, port = node_name(name).rpartition(':')
+    return host, int(port)
+
+
+class HashRing(object):
+    """
+    Ketama consistent hash ring over standalone servers. Every node owns
+    points_per_node points on a 32 bit circle placed by the md5 of its name,
+    and a key belongs to the first point at or after the hash of its hash tag.
+    Points depend on node names only, so the order nodes are listed in does not matter.
+    """
+    def __init__(self, nodes, points_per_node=DEFAULT_POINTS_PER_NODE):
+        self.names = [node_name(node) for node in nodes]
+        if not self.names:
+            raise ValueError("A hash ring needs at least one node")
+        ring = []
+        for index, name in enumerate(self.names):
+            for i in range(max(points_per_node // 4, 1)):
+                digest = hashlib.md5('{0}-{1}'.format(name, i).encode('utf-8')).digest()
+                ring.extend((point, index) for point in struct.unpack('<4I', digest))
+        ring.sort()
+        self._points = [point for point, _ in ring]
+        self._nodes = [index for _, index in ring]
+
+    def node(self, key):
+        """
+        :return: index in names of the node owning key
+        """
+        point = struct.unpack('<I', hashlib.md5(hash_tag(key)).digest()[:4])[0]
+        return self._nodes[bisect_left(self._points, point) % len(self._points)]
+
+    def nodes(self):
+        return list(range(len(self.names)))
+
+
+class ClusterSlots(object):
+    """
+    Slot map of a Redis Cluster, read with CLUSTER SLOTS from the first startup
+    node (or known node) that answers. It is loaded on first use and reloaded
+    by ShardedRedis whenever a node replies MOVED or ASK.
+    :param connect: callable(host, port) returning a redis client for a node
+    """
+    def __init__(self, startup_nodes, connect):
+        self.startup_nodes = [node_name(node) for node in startup_nodes]
+        if not self.startup_nodes:
+            raise ValueError("A cluster needs at least one startup node")
+        self.connect = connect
+        # Append only, so node indexes handed out earlier stay valid after a reload.
+        self.names = []
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Reads the slot to primary mapping from the cluster.
+        """
+        with self._lock:
+            error = None
+            for name in self.startup_nodes + [n for n in self.names if n not in self.startup_nodes]:
+                host, port = parse_node(name)
+                try:
+                    reply = self.connect(host, port).execute_command('CLUSTER', 'SLOTS')
+                except redis.ConnectionError as e:
+                    error = e
+                    continue
+                slots = [None] * REDIS_CLUSTER_HASH_SLOTS
+                for entry in reply:
+                    primary = entry[2]
+                    # An empty or '?' endpoint means "the node you asked".
+                    primary_host = _text(primary[0])
+                    if primary_host in ('', '?'):
+                        primary_host = host
+                    index = self._index('{0}:{1}'.format(primary_host, primary[1]))
+                    for slot in range(int(entry[0]), int(entry[1]) + 1):
+                        slots[slot] = index
+                self._slots = slots
+                return
+            raise error or redis.ConnectionError("No cluster node could be reached")
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def _index(self, name):
+        if name not in self.names:
+            self.names.append(name)
+        return self.names.index(name)
+
+    def node(self, key):
+        if self._slots is None:
+            self.load()
+        index = self._slots[key_slot(to_bytes(key))]
+        if index is None:
+            raise ClusterDownError("Hash slot of {0!r} is not served by any node".format(key))
+        return index
+
+    def nodes(self):
+        if self._slots is None:
+            self.load()
+        return sorted(set(index for index in self._slots if index is not None))
+
+
+class ShardedRedis(object):
+    """
+    Redis client look-alike routing commands over the nodes of a HashRing or ClusterSlots.
+    :param locator: HashRing or ClusterSlots
+    :param connect: callable(host, port) returning the redis client of a node
+    :param threads: max number of nodes talked to in parallel by multi-node operations
+    """
+    def __init__(self, locator, connect, threads=DEFAULT_SHARD_THREADS):
+        self.locator = locator
+        self.connect = connect
+        self.threads = threads
+        self._clients = {}
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def client(self, index):
+        """
+        :return: redis client of the node at index, created on first use
+        """
+        client = self._clients.get(index)
+        if client is None:
+            client = self._clients[index] = self.connect(*parse_node(self.locator.names[index]))
+        return client
+
+    def client_for(self, key):
+        return self.client(self.locator.node(key))
+
+    def clients(self):
+        """
+        :return: clients of every node holding keys (the primaries of a cluster)
+        """
+        return [self.client(index) for index in self.locator.nodes()]
+
+    def nodes_for(self, pattern):
+        """
+        :return: indexes of the nodes which may hold keys matching pattern, only one when the
+                 pattern starts with a hash tag without wildcards
+        """
+        if pattern is not None:
+            tag = hash_tag(pattern)
+            if tag != to_bytes(pattern) and not any(c in tag for c in (b'*', b'?', b'[', b'\\')):
+                return [self.locator.node(pattern)]
+        return self.locator.nodes()
+
+    def group(self, keys):
+        """
+        :return: dict of node index to the positions in keys of the keys it owns
+        """
+        groups = {}
+        for position, key in enumerate(keys):
+            groups.setdefault(self.locator.node(key), []).append(position)
+        return groups
+
+    def after_fork(self):
+        """
+        Drops the node clients and thread pool inherited from the parent process.
+        """
+        self._clients = {}
+        self._pool = None
+        self._lock = threading.Lock()
+        if isinstance(self.locator, ClusterSlots):
+            self.locator.after_fork()
+
+    def run_parallel(self, function, items):
+        """
+        :return: [function(item) for item in items], the calls running on the shard thread pool
+        """
+        if len(items) <= 1:
+            return [function(item) for item in items]
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPool(self.threads)
+        return self._pool.map(function, items)
+
+    def moved(self, error):
+        """
+        Reloads the cluster slot map when a node answered MOVED or ASK (redis-py strips the word
+        from the message and raises MovedError, a subclass of AskError, instead).
+        :return: True if the failed command should be retried
+        """
+        if isinstance(self.locator, ClusterSlots) and isinstance(error, AskError):
+            self.locator.load()
+            return True
+        return False
+
+    def retrying(self, function, *args, **kwargs):
+        """
+        Calls function, once more after the slot map was reloaded if it hit a moved slot.
+        """
+        try:
+            return function(*args, **kwargs)
+        except redis.ResponseError as e:
+            if not self.moved(e):
+                raise
+            return function(*args, **kwargs)
+
+    def call(self, key, command, *args, **kwargs):
+        """
+        Sends command to the node owning key.
+        """
+        return self.retrying(lambda: getattr(self.client_for(key), command)(*args, **kwargs))
+
+    def ping(self):
+        return all(self.run_parallel(lambda client: client.ping(), self.clients()))
+
+    def mget(self, keys, *args):
+        keys = list(keys) + list(args)
+        return self.retrying(self._mget, keys)
+
+    def _mget(self, keys):
+        values = [None] * len(keys)
+        groups = self.group(keys)
+
+        def fetch(index):
+            return groups[index], self.client(index).mget([keys[position] for position in groups[index]])
+
+        for positions, found in self.run_parallel(fetch, list(groups)):
+            for position, value in zip(positions, found):
+                values[position] = value
+        return values
+
+    def _count(self, command, keys):
+        groups = self.group(keys)
+        return sum(self.run_parallel(
+            lambda index: getattr(self.client(index), command)(*[keys[position] for position in groups[index]]),
+            list(groups)))
+
+    def delete(self, *keys):
+        return self.retrying(self._count, 'delete', keys)
+
+    def unlink(self, *keys):
+        return self.retrying(self._count, 'unlink', keys)
+
+    def exists(self, *keys):
+        return self.retrying(self._count, 'exists', keys)
+
+    def scan_iter(self, match=None, count=None, **kwargs):
+        for index in self.nodes_for(match):
+            for key in self.client(index).scan_iter(match=match, count=count, **kwargs):
+                yield key
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ShardedPipeline(self, transaction)
+
+    def get_encoder(self):
+        return self.client(self.locator.nodes()[0]).get_encoder()
+
+    def register_script(self, script):
+        return Script(self, script)
+
+    def script_load(self, script):
+        return self.run_parallel(lambda client: client.script_load(script), self.clients())[0]
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        if not numkeys:
+            raise redis.RedisError("Scripts sent to a sharded cache need a key to be routed by")
+        return self.call(keys_and_args[0], 'evalsha', sha, numkeys, *keys_and_args)
+
+    def eval(self, script, numkeys, *keys_and_args):
+        if not numkeys:
+            raise redis.RedisError("Scripts sent to a sharded cache need a key to be routed by")
+        return self.call(keys_and_args[0], 'eval', script, numkeys, *keys_and_args)
+
+    def pool_stats(self):
+        """
+        :return: dict of node name to the stats of its connection pool
+        """
+        return dict((self.locator.names[index], self.client(index).connection_pool.stats())
+                    for index in self.locator.nodes())
+
+
+class ShardedPipeline(object):
+    """
+    Queues commands and, on execute(), sends one pipeline per node, in parallel.
+    Replies come back in the order the commands were queued; DEL, UNLINK and
+    EXISTS over keys of several nodes are split and their counts summed.
+    """
+    def __init__(self, router, transaction=True):
+        self.router = router
+        self.transaction = transaction
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def __len__(self):
+        return len(self.commands)
+
+    def reset(self):
+        self.commands = []
+
+    def execute(self, raise_on_error=True):
+        try:
+            return self.router.retrying(self._execute, raise_on_error)
+        finally:
+            self.reset()
+
+    def _execute(self, raise_on_error=True):
+        # (node index, command, args, kwargs) of every command sent, and for each
+        # queued command the positions of its replies in that list.
+        sent, replies_of = [], []
+        for command, args, kwargs in self.commands:
+            if command in COUNTING_COMMANDS:
+                groups = self.router.group(args)
+                replies_of.append(list(range(len(sent), len(sent) + len(groups))))
+                for index, positions in groups.items():
+                    sent.append((index, command, [args[position] for position in positions], kwargs))
+            else:
+                replies_of.append([len(sent)])
+                sent.append((self.router.locator.node(args[0]), command, args, kwargs))
+
+        by_node = {}
+        for position, (index, _, _, _) in enumerate(sent):
+            by_node.setdefault(index, []).append(position)
+
+        def send(index):
+            pipe = self.router.client(index).pipeline(transaction=self.transaction)
+            for position in by_node[index]:
+                _, command, args, kwargs = sent[position]
+                getattr(pipe, command)(*args, **kwargs)
+            return by_node[index], pipe.execute(raise_on_error)
+
+        replies = [None] * len(sent)
+        for positions, results in self.router.run_parallel(send, list(by_node)):
+            for position, result in zip(positions, results):
+                replies[position] = result
+        return [replies[positions[0]] if len(positions) == 1 and self.commands[i][0] not in COUNTING_COMMANDS
+                else sum(replies[position] for position in positions)
+                for i, positions in enumerate(replies_of)]
+
+
+def _routed(command):
+    def send(self, key, *args, **kwargs):
+        return self.call(key, command, key, *args, **kwargs)
+    send.__name__ = command
+    return send
+
+
+def _queued(command):
+    def queue(self, *args, **kwargs):
+        self.commands.append((command, args, kwargs))
+        return self
+    queue.__name__ = command
+    return queue
+
+
+for _command in KEYED_COMMANDS:
+    setattr(ShardedRedis, _command, _routed(_command))
+for _command in KEYED_COMMANDS + COUNTING_COMMANDS:
+    setattr(ShardedPipeline, _command, _queued(_command))
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
@@ -0,0 +1,147 @@
+"""
+Stampede protection for the cache_it decorators.
+
+SingleFlight coalesces concurrent callers for the same key inside one process
+onto a single computation. RedisLock is a short-lived token lock (SET NX PX)
+used to elect a single process to recompute an expired entry; the others poll
+the cache for the fresh value for a little while instead of hitting the
+backend themselves.
+"""
+import threading
+import time
+import uuid
+import redis
+from local_cache import MISSING
+
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Locks live next to the entry they protect: key:lock while recomputing a missing entry,
+# key:refresh while refreshing a stale one in the background.
+LOCK_SUFFIX = ':lock'
+REFRESH_SUFFIX = ':refresh'
+
+
+def is_lock_key(key):
+    """
+    :return: True if key is a lock of fetch_or_compute or of a background refresh, holding a raw token
+    """
+    if isinstance(key, bytes):
+        key = key.decode('utf-8', 'replace')
+    return key.endswith(LOCK_SUFFIX) or key.endswith(REFRESH_SUFFIX)
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Runs at most one function call per key at a time, handing its result
+    (or exception) to every caller that asked for the same key meanwhile.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+class RedisLock(object):
+    """
+    Non-blocking lock held in Redis for at most `timeout` milliseconds.
+    Only the holder of the random token can release it.
+    """
+    _release = None
+
+    def __init__(self, connection, name, timeout=10000):
+        self.connection = connection
+        self.name = name
+        self.timeout = timeout
+        self.token = uuid.uuid4().hex
+
+    def acquire(self):
+        return bool(self.connection.set(self.name, self.token, nx=True, px=self.timeout))
+
+    @classmethod
+    def load_script(cls, connection):
+        """
+        Hashes the release script once; sends nothing, the script is loaded by its first call.
+        """
+        if cls._release is None:
+            cls._release = connection.register_script(RELEASE_SCRIPT)
+        return cls._release
+
+    def release(self):
+        RedisLock.load_script(self.connection)(keys=[self.name], args=[self.token], client=self.connection)
+
+
+def fetch_or_compute(connection, key, fetch, compute, lock_timeout=10000, lock_wait=5, poll_interval=0.05):
+    """
+    Makes sure only one process recomputes `key` at a time.
+    :param connection: redis client holding the lock
+    :param key: cache key being recomputed, the lock lives under `key:lock`
+    :param fetch: callable returning the cached value or MISSING
+    :param compute: callable computing and storing the value
+    :param lock_timeout: milliseconds after which an abandoned lock frees itself
+    :param lock_wait: seconds to wait for another process before computing anyway
+    :param poll_interval: seconds between cache polls while waiting
+    :return: cached or freshly computed value
+    """
+    lock = RedisLock(connection, key + LOCK_SUFFIX, lock_timeout)
+    deadline = time.time() + lock_wait
+    while True:
+        try:
+            acquired = lock.acquire()
+        except redis.RedisError:
+            return compute()
+
+        if acquired:
+            try:
+                # The previous holder may have stored the value just before we got in.
+                value = fetch()
+                if value is not MISSING:
+                    return value
+                return compute()
+            finally:
+                try:
+                    lock.release()
+                except redis.RedisError:
+                    pass  # it expires on its own after lock_timeout
+
+        if time.time() >= deadline:
+            return compute()
+
+        time.sleep(poll_interval)
+        value = fetch()
+        if value is not MISSING:
+            return value
@@ -0,0 +1,112 @@
+"""
+Tag-based invalidation of cache entries.
+
+An entry written with tags is recorded as a member of one set per tag, in the
+same transaction as the write, so an entry is never visible without its tags.
+invalidate_tags() then deletes the members of the tag sets with a server-side
+script popping and unlinking at most `batch` keys per call: every call is
+atomic, and a tag with 100k keys blocks Redis for one batch at a time instead
+of for the whole set. Sets left empty are removed by Redis itself.
+
+Tag sets expire with the longest lived entry recorded in them (EXPIRE NX/GT,
+Redis >= 7.0), so tags which are never invalidated do not accumulate members
+for expired entries forever.
+"""
+from keyspace import DEFAULT_DELETE_BATCH
+from sharding import ShardedRedis
+
+# Pops up to ARGV[1] members of the tag sets and unlinks them, atomically.
+# KEYS = tag sets
+# Returns the number of members left, followed by the unlinked keys.
+INVALIDATE_TAGS_SCRIPT = """
+local budget = tonumber(ARGV[1])
+local left = 0
+local removed = {}
+for _, tag in ipairs(KEYS) do
+    if budget > 0 then
+        local members = redis.call('SPOP', tag, budget)
+        if #members > 0 then
+            redis.call('UNLINK', unpack(members))
+            budget = budget - #members
+            for _, member in ipairs(members) do
+                removed[#removed + 1] = member
+            end
+        end
+    end
+    left = left + redis.call('SCARD', tag)
+end
+table.insert(removed, 1, left)
+return removed
+"""
+
+
+def tag_key(tag):
+    return 'tag:{0}'.format(tag)
+
+
+def record_tags(pipe, key, tags, expire=None):
+    """
+    Queues the commands adding key to the set of every tag on pipe, to be sent with the write of key.
+    :param expire: ttl of the entry; tag sets live at least as long as their members
+    """
+    for tag in tags:
+        pipe.sadd(tag_key(tag), key)
+        if expire:
+            pipe.expire(tag_key(tag), expire, nx=True)
+            pipe.expire(tag_key(tag), expire, gt=True)
+
+
+class TagInvalidator(object):
+    """
+    :param connection: callable returning the redis client the tag sets and entries live on
+    :param batch: max number of keys unlinked per script call
+    """
+    _script = None
+
+    def __init__(self, connection, batch=DEFAULT_DELETE_BATCH):
+        self.connection = connection
+        self.batch = batch
+
+    @classmethod
+    def load_script(cls, connection):
+        """
+        Hashes the invalidation script once; sends nothing, the script is loaded by its first call.
+        """
+        if cls._script is None:
+            cls._script = connection.register_script(INVALIDATE_TAGS_SCRIPT)
+        return cls._script
+
+    def invalidate(self, tags, removed=None):
+        """
+        Deletes every key recorded under tags, and the tag sets.
+        :param removed: optional callable receiving every batch of unlinked keys
+        :return: number of tag set members unlinked
+        """
+        keys = [tag_key(tag) for tag in tags]
+        connection = self.connection()
+        if isinstance(connection, ShardedRedis):
+            # Entries of a tag are spread over the nodes, out of reach of a script running on one of them.
+            return self.invalidate_sharded(connection, keys, removed)
+        script = TagInvalidator.load_script(connection)
+        count = 0
+        while keys:
+            reply = script(keys=keys, args=[self.batch], client=connection)
+            count += len(reply) - 1
+            if removed is not None and len(reply) > 1:
+                removed(reply[1:])
+            if not reply[0]:
+                break
+        return count
+
+    def invalidate_sharded(self, connection, keys, removed=None):
+        count = 0
+        for key in keys:
+            while True:
+                members = connection.spop(key, self.batch)
+                if not members:
+                    break
+                connection.unlink(*members)
+                count += len(members)
+                if removed is not None:
+                    removed(members)
+        return count
@@ -0,0 +1,82 @@
+"""
+AsyncMyCache against the in-process fake server of the benchmarks.
+"""
+import asyncio
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+
+import redis
+from fake_redis import FakeRedisServer
+from async_cache import AsyncMyCache
+from client import DoNotCache
+from generic_cache import MyCache, cache_it
+from large_values import chunking_supported
+
+
+class AsyncMyCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeRedisServer().start()
+        cls.client = redis.StrictRedis('127.0.0.1', cls.server.port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.client.flushdb()
+
+    def test_survives_event_loops(self):
+        cache = AsyncMyCache(host='127.0.0.1', port=self.server.port, prefix='test')
+
+        async def round_trip(value):
+            await cache.set('k', value)
+            return await cache.get('k')
+
+        for value in range(3):
+            self.assertEqual(asyncio.run(round_trip(value)), value)
+
+
+    def test_sync_cache_is_rejected(self):
+        cache = MyCache(host='127.0.0.1', port=self.server.port, health_check_interval=None)
+
+        async def load(value):
+            return value
+
+        self.assertRaises(TypeError, cache_it(cache=cache), load)
+
+    def test_do_not_cache(self):
+        cache = AsyncMyCache(host='127.0.0.1', port=self.server.port, hashkeys=False)
+        calls = []
+
+        @cache_it(cache=cache, namespace='results')
+        async def load(value):
+            calls.append(value)
+            if value < 0:
+                raise DoNotCache(None)
+            return value
+
+        async def run():
+            return [await load(1), await load(1), await load(-1), await load(-1)]
+
+        self.assertEqual(asyncio.run(run()), [1, 1, None, None])
+        self.assertEqual(calls, [1, -1, -1])
+        self.assertEqual(len(self.client.keys('results:load:*')), 1)
+
+    @unittest.skipUnless(chunking_supported(), 'pickle protocol 5 is not available')
+    def test_reads_large_values(self):
+        writer = MyCache(host='127.0.0.1', port=self.server.port, health_check_interval=None,
+                         large_value_threshold=1024, chunk_size=512, compression=None)
+        value = bytearray(os.urandom(5000))
+        writer.store_pickle('big', value)
+        cache = AsyncMyCache(host='127.0.0.1', port=self.server.port)
+        self.assertEqual(asyncio.run(cache.get_pickle('big')), value)
+
+
+if __name__ == '__main__':
+    unittest.main()
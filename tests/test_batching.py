@@ -0,0 +1,80 @@
+"""
+Micro-batching of concurrent get() calls into MGET.
+"""
+import os
+import sys
+import threading
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+
+from fake_redis import FakeRedisServer
+from batching import GetBatcher
+from generic_cache import MyCache
+
+
+def run_threads(count, target):
+    start = threading.Barrier(count)
+    results = [None] * count
+
+    def run(index):
+        start.wait()
+        results[index] = target(index)
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class GetBatcherTest(unittest.TestCase):
+    def test_concurrent_gets_share_mgets(self):
+        calls = []
+
+        def mget(keys):
+            calls.append(keys)
+            return [key.upper() for key in keys]
+        batcher = GetBatcher(mget, window=0.05, max_batch=4)
+        results = run_threads(8, lambda index: batcher.get('k%d' % (index % 6)))
+        self.assertEqual(results, ['K%d' % (index % 6) for index in range(8)])
+        self.assertLess(len(calls), 8)
+        self.assertEqual(batcher.stats()['keys'], 8)
+
+    def test_errors_reach_every_caller(self):
+        def mget(keys):
+            raise IOError('down')
+        batcher = GetBatcher(mget, window=0.05)
+
+        def get(index):
+            try:
+                batcher.get('k')
+            except IOError as e:
+                return e
+        self.assertTrue(all(isinstance(result, IOError) for result in run_threads(4, get)))
+
+
+class BatchedCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeRedisServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def test_get_returns_the_value_of_its_key(self):
+        cache = MyCache(host='127.0.0.1', port=self.server.port, prefix='test', health_check_interval=None,
+                        batch_window=0.01)
+        for i in range(10):
+            cache.set('k%d' % i, i)
+        self.assertEqual(run_threads(20, lambda index: cache.get('k%d' % (index % 10))),
+                         [index % 10 for index in range(20)])
+        self.assertIsNone(cache.get('missing'))
+        self.assertLess(cache.batcher.stats()['batches'], 21)
+
+
+if __name__ == '__main__':
+    unittest.main()
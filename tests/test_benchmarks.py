@@ -0,0 +1,59 @@
+"""
+Runs benchmark groups against the in-process fake server, with few iterations,
+so that code paths only the benchmarks exercise keep working.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+
+import bench_cache
+
+
+class BenchmarkTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_groups(self, groups):
+        output = os.path.join(self.dir, 'results.json')
+        status = bench_cache.main(['--fake', '--only', groups, '--iterations', '5', '--output', output])
+        self.assertEqual(status, 0)
+        with open(output) as f:
+            return json.load(f)['results']
+
+    def test_mio(self):
+        self.assertIsNotNone(bench_cache.MIOCache)
+        results = self.run_groups('mio')
+        self.assertEqual(sorted(results), ['mio.set.get', 'mio.set.set'])
+
+
+    def test_every_group_runs(self):
+        output = os.path.join(self.dir, 'results.json')
+        status = bench_cache.main(['--fake', '--iterations', '3', '--sizes', '100', '--mget-keys', '5',
+                                   '--bulk-sizes', '100', '--large-size', str(2 * 1024 * 1024),
+                                   '--output', output])
+        self.assertEqual(status, 0)
+        with open(output) as f:
+            results = json.load(f)['results']
+        groups = set(name.split('.')[0] for name in results)
+        self.assertEqual(groups, set(bench_cache.ALL_GROUPS))
+
+    def test_unknown_group(self):
+        self.assertEqual(bench_cache.main(['--fake', '--only', 'nope']), 2)
+
+    def test_compare_reports_slowdowns(self):
+        baseline = {'get.100': {'p50_us': 10.0}, 'delete_namespace.100': {'seconds': 1.0}}
+        results = {'get.100': {'p50_us': 13.0}, 'delete_namespace.100': {'seconds': 1.1}, 'new': {'p50_us': 1.0}}
+        self.assertEqual(bench_cache.compare(results, baseline, 0.2), [('get.100', 'p50_us', 10.0, 13.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
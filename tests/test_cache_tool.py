@@ -0,0 +1,113 @@
+"""
+Dump, restore and warm-up with cache_tool, against fakeredis served over TCP
+for DUMP and RESTORE.
+"""
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+try:
+    from fakeredis import TcpFakeServer
+except ImportError:  # fakeredis missing, or older than its TCP server
+    TcpFakeServer = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+
+import redis
+from fake_redis import FakeRedisServer
+import cache_tool
+from generic_cache import MyCache, cache_it
+
+calls = []  # arguments load() was called with
+
+
+def load(value, power=1):
+    calls.append(value)
+    return value ** power
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_rate_is_capped(self):
+        limiter = cache_tool.RateLimiter(200)
+        start = time.time()
+        for _ in range(5):
+            limiter.wait(50)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_bad_dump_files_are_rejected(self):
+        self.assertRaises(ValueError, list, cache_tool.read_records(io.BytesIO(b'nope')))
+        out = io.BytesIO()
+        out.write(cache_tool.MAGIC)
+        cache_tool.write_record(out, b'k', 0, b'value')
+        self.assertRaises(ValueError, list, cache_tool.read_records(io.BytesIO(out.getvalue()[:-1])))
+
+
+@unittest.skipIf(TcpFakeServer is None, 'needs fakeredis with TcpFakeServer')
+class DumpRestoreTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+        thread = threading.Thread(target=self.fake.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.port = self.fake.server_address[1]
+        self.client = redis.StrictRedis('127.0.0.1', self.port)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.fake.shutdown()
+        self.fake.server_close()
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        cache = MyCache(host='127.0.0.1', port=self.port, prefix='users', health_check_interval=None)
+        for i in range(25):
+            cache.set('k%d' % i, {'id': i}, expire=600)
+        self.client.set('users:forever', b'x')
+        self.client.set('other:k', b'x')
+        path = os.path.join(self.dir, 'users.dump.gz')
+        common = ['--host', '127.0.0.1', '--port', str(self.port), '--batch', '10', '--progress', '1000']
+        self.assertEqual(cache_tool.main(['dump', 'users', '--output', path] + common), 0)
+
+        self.client.flushdb()
+        self.assertEqual(cache_tool.main(['restore', path, '--workers', '2'] + common), 0)
+        self.assertEqual(sorted(self.client.keys('*')),
+                         sorted([b'users:forever'] + [('users:k%d' % i).encode('ascii') for i in range(25)]))
+        self.assertEqual(cache.get('k3'), {'id': 3})
+        self.assertGreater(self.client.ttl('users:k3'), 500)
+        self.assertEqual(self.client.ttl('users:forever'), -1)
+
+
+class WarmTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeRedisServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def test_calls_are_replayed_and_cached(self):
+        cache = MyCache(host='127.0.0.1', port=self.server.port, prefix='test', health_check_interval=None)
+        cached = cache_it(cache=cache, namespace='warm')(load)
+        module = sys.modules[__name__]
+        module.cached_load = cached
+        self.addCleanup(delattr, module, 'cached_load')
+        del calls[:]
+
+        lines = io.StringIO(u'{"args": [2]}\n\n[3]\n{"args": [2], "kwargs": {"power": 2}}\n'
+                            u'{"function": "%s:load", "args": ["x"]}\n' % __name__)
+        called, failed = cache_tool.warm(cache_tool.read_calls(lines, '%s:cached_load' % __name__), workers=2)
+        self.assertEqual((called, failed), (4, 1))  # 'x' ** 1 raises
+        del calls[:]
+        self.assertEqual([cached(2), cached(3), cached(2, power=2)], [2, 3, 4])
+        self.assertEqual(calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
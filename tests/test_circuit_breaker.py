@@ -0,0 +1,93 @@
+"""
+Circuit breaker states, and caches riding out a server going away and coming
+back, with the in-process fake server of the benchmarks.
+"""
+import os
+import sys
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+
+from fake_redis import FakeRedisServer
+from circuit_breaker import CircuitBreaker, jittered_backoff, CLOSED, OPEN, HALF_OPEN
+from generic_cache import MyCache, cache_it
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_threshold_and_probes_once(self):
+        breaker = CircuitBreaker(failure_threshold=2, backoff=0.02, max_backoff=0.02)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.rejected, 1)
+
+        time.sleep(0.03)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertFalse(breaker.allow())  # one probe at a time
+        breaker.record_success()
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_failed_probe_reopens_with_longer_delay(self):
+        breaker = CircuitBreaker(failure_threshold=1, backoff=0.01, max_backoff=10)
+        breaker.trip()
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(breaker.attempt, 2)
+        self.assertEqual(breaker.opened, 2)
+
+    def test_jittered_backoff_bounds(self):
+        for attempt in range(10):
+            delay = jittered_backoff(attempt, 0.5, 4)
+            self.assertGreaterEqual(delay, min(4, 0.5 * 2 ** attempt) / 2)
+            self.assertLessEqual(delay, min(4, 0.5 * 2 ** attempt))
+
+
+class ServerDownTest(unittest.TestCase):
+    def test_cache_it_skips_redis_until_it_is_back(self):
+        server = FakeRedisServer().start()
+        port = server.port
+        server.stop()
+
+        cache = MyCache(host='127.0.0.1', port=port, prefix='test', retry_backoff=0.5, max_sleep=0.5,
+                        health_check_interval=0.05)
+        self.addCleanup(cache.breaker.stop_health_check)
+        calls = []
+
+        @cache_it(cache=cache, namespace='down')
+        def load(value):
+            calls.append(value)
+            return value
+
+        start = time.time()
+        self.assertEqual([load(1), load(1)], [1, 1])
+        self.assertEqual(calls, [1, 1])
+        self.assertFalse(cache.available())
+        self.assertLess(time.time() - start, 1)
+
+        server = FakeRedisServer(port=port).start()
+        self.addCleanup(server.stop)
+        self.assertTrue(wait_for(lambda: cache.breaker.state == CLOSED, timeout=3))
+        self.assertEqual([load(2), load(2)], [2, 2])
+        self.assertEqual(calls, [1, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
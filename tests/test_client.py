@@ -0,0 +1,111 @@
+"""
+MIOCache against the in-process fake server of the benchmarks, and against
+fakeredis served over TCP for the Lua script of the lru mode.
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+try:
+    from fakeredis import TcpFakeServer
+except ImportError:  # fakeredis missing, or older than its TCP server
+    TcpFakeServer = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+
+import redis
+from fake_redis import FakeRedisServer
+from client import MIOCache, CacheMissException, LRU_SET_SCRIPT
+
+
+class MIOCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeRedisServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.cache = MIOCache(limit=10, host='127.0.0.1', port=self.server.port, namespace='test')
+        self.cache.connection.flushdb()
+
+    def test_set_many_evicts_overflow(self):
+        values = dict(('k%d' % i, i) for i in range(25))
+        self.cache.set_many(values)
+        kept = self.cache.keys()
+        self.assertEqual(len(kept), 10)
+        self.assertEqual(self.cache.mget(list(values)), dict((key, values[key]) for key in kept))
+        for key in set(values) - set(kept):
+            self.assertIsNone(self.cache.connection.get(self.cache.make_key(key)))
+
+    def test_delete_namespace(self):
+        for i in range(5):
+            self.cache.set('k%d' % i, i)
+        self.cache.connection.set('other:k0', b'kept')
+        self.assertEqual(self.cache.delete_namespace('test'), 5)
+        self.assertEqual(self.cache.keys(), [])
+        self.assertEqual(self.cache.connection.get('other:k0'), b'kept')
+
+    def test_set_evicts_overflow(self):
+        for i in range(12):
+            self.cache.set('k%d' % i, i)
+        self.assertEqual(len(self.cache.keys()), 10)
+        self.assertEqual(len(self.cache.mget(['k%d' % i for i in range(12)])), 10)
+
+    def test_versioned_expire_namespace(self):
+        cache = MIOCache(limit=10, host='127.0.0.1', port=self.server.port, namespace='test', versioned=True)
+        cache.set('k', 1)
+        cache.connection.set('other:k', b'dropped')
+        cache.expire_namespace('test')
+        self.assertRaises(CacheMissException, cache.get, 'k')
+        cache.expire_namespace('other')
+        self.assertIsNone(cache.connection.get('other:k'))
+
+
+
+@unittest.skipIf(TcpFakeServer is None, 'needs fakeredis with TcpFakeServer')
+class LRUTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+        cls.thread = threading.Thread(target=cls.fake.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        # fakeredis drops the connection after an error reply such as NOSCRIPT, so load the script up front.
+        cls.fake_client = redis.StrictRedis('127.0.0.1', cls.fake.server_address[1])
+        cls.fake_client.script_load(LRU_SET_SCRIPT)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.shutdown()
+        cls.fake.server_close()
+
+    def setUp(self):
+        self.cache = MIOCache(limit=3, lru=True, host='127.0.0.1', port=self.fake.server_address[1],
+                              namespace='test')
+        self.fake_client.flushdb()
+
+    def test_least_recently_used_is_evicted(self):
+        for i in range(3):
+            self.cache.set('k%d' % i, i)
+            time.sleep(0.002)  # recency is kept in milliseconds
+        self.assertEqual(self.cache.get('k0'), 0)
+        time.sleep(0.002)
+        self.cache.set('k3', 3)
+        self.assertEqual(sorted(self.cache.keys()), ['k0', 'k2', 'k3'])
+        self.assertRaises(CacheMissException, self.cache.get, 'k1')
+        self.assertIsNone(self.cache.connection.get(self.cache.make_key('k1')))
+
+    def test_set_many_stays_within_limit(self):
+        self.cache.set_many(dict(('k%d' % i, i) for i in range(10)))
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(len(self.cache.mget(['k%d' % i for i in range(10)])), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
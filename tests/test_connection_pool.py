@@ -0,0 +1,64 @@
+"""
+Shared connection pools against the in-process fake server of the benchmarks.
+"""
+import os
+import sys
+import threading
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+
+import redis
+from fake_redis import FakeRedisServer
+from client import MIOCache, RedisConnect
+from connection_pool import get_pool, get_connection
+from generic_cache import MyCache
+
+
+class SharedPoolTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeRedisServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def test_caches_share_one_pool_per_server(self):
+        port = self.server.port
+        pool = get_pool('127.0.0.1', port)
+        caches = [MyCache(host='127.0.0.1', port=port, health_check_interval=None),
+                  MyCache(host='127.0.0.1', port=port, prefix='other', health_check_interval=None),
+                  MIOCache(host='127.0.0.1', port=port)]
+        for cache in caches:
+            self.assertIs(cache.connection.connection_pool, pool)
+        self.assertIs(RedisConnect('127.0.0.1', port).connect().connection_pool, pool)
+        self.assertIsNot(get_pool('127.0.0.1', port, db=1), pool)
+
+    def test_threads_are_bounded_by_the_pool(self):
+        client = get_connection('127.0.0.1', self.server.port, db=2, max_connections=2)
+        errors = []
+
+        def work():
+            try:
+                for i in range(20):
+                    client.set('k', i)
+                    client.get('k')
+            except redis.RedisError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = client.connection_pool.stats()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(stats['created'], 2)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['acquired'], 8 * 20 * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
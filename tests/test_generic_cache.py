@@ -0,0 +1,358 @@
+"""
+MyCache against the in-process fake server of the benchmarks, and against
+fakeredis served over TCP for what needs Lua scripts or pub/sub.
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+try:
+    from fakeredis import TcpFakeServer
+except ImportError:  # fakeredis missing, or older than its TCP server
+    TcpFakeServer = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+
+import redis
+from fake_redis import FakeRedisServer
+from client import DoNotCache
+from generic_cache import MyCache, cache_it, cache_it_many
+from local_cache import LocalCache, MISSING
+from single_flight import SingleFlight, RedisLock, fetch_or_compute, RELEASE_SCRIPT
+from refresh import should_refresh
+from tags import INVALIDATE_TAGS_SCRIPT, tag_key
+
+
+class MyCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeRedisServer().start()
+        cls.client = redis.StrictRedis('127.0.0.1', cls.server.port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.client.flushdb()
+
+    def make_cache(self, **options):
+        options.update(host='127.0.0.1', port=self.server.port, health_check_interval=None)
+        return MyCache(**options)
+
+
+@unittest.skipIf(TcpFakeServer is None, 'needs fakeredis with TcpFakeServer')
+class FakeRedisCacheTest(MyCacheTest):
+    """
+    Same as MyCacheTest over fakeredis, which runs Lua scripts and sends keyspace notifications.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+        cls.thread = threading.Thread(target=cls.fake.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.client = redis.StrictRedis('127.0.0.1', cls.fake.server_address[1])
+        # fakeredis drops the connection after an error reply such as NOSCRIPT, so load the scripts up front.
+        for script in (RELEASE_SCRIPT, INVALIDATE_TAGS_SCRIPT):
+            cls.client.script_load(script)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.shutdown()
+        cls.fake.server_close()
+
+    def make_cache(self, **options):
+        options.update(host='127.0.0.1', port=self.fake.server_address[1], health_check_interval=None)
+        return MyCache(**options)
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class LocalCacheTest(unittest.TestCase):
+    def test_entries_expire_and_are_bounded(self):
+        local = LocalCache(maxsize=2, ttl=0.05)
+        for key in 'abc':
+            local.set(key, key)
+        self.assertIs(local.get('a'), MISSING)
+        self.assertEqual(local.get('c'), 'c')
+        time.sleep(0.06)
+        self.assertIs(local.get('c'), MISSING)
+
+    def test_invalidate_prefix(self):
+        local = LocalCache()
+        local.set('users:1', 1)
+        local.set('orders:1', 1)
+        local.invalidate_prefix('users:')
+        self.assertIs(local.get('users:1'), MISSING)
+        self.assertEqual(local.get('orders:1'), 1)
+
+
+class L1Test(FakeRedisCacheTest):
+    def test_reads_are_served_locally(self):
+        cache = self.make_cache(prefix='test', local_cache=100, local_ttl=60, invalidation=None)
+        cache.set('k', 1)
+        self.assertEqual(cache.get('k'), 1)
+        self.client.delete('test:k')  # not seen without invalidation
+        self.assertEqual(cache.get('k'), 1)
+        self.assertEqual(cache.mget(['k', 'missing']), {'k': 1})
+        cache.delete('k')
+        self.assertIsNone(cache.get('k'))
+
+    def test_writes_elsewhere_invalidate(self):
+        cache = self.make_cache(prefix='test', local_cache=100, local_ttl=60)
+        cache.set('k', 1)
+        self.assertEqual(cache.get('k'), 1)
+        # The listener subscribes in the background; until then writes are not seen.
+        self.assertTrue(wait_for(lambda: self.client.pubsub_numpat() > 0))
+        self.client.delete('test:k')
+        self.assertTrue(wait_for(lambda: cache.get('k') is None))
+
+
+class VersionedNamespaceTest(MyCacheTest):
+    def test_cache_it_namespace_is_invalidated_with_one_incr(self):
+        cache = self.make_cache(versioned=True, generation_refresh=0)
+        calls = []
+
+        @cache_it(cache=cache, namespace='users')
+        def load(user_id):
+            calls.append(user_id)
+            return {'id': user_id}
+
+        self.assertEqual(load(1), {'id': 1})
+        self.assertEqual(load(1), {'id': 1})
+        self.assertEqual(calls, [1])
+
+        self.assertEqual(cache.delete_namespace('users'), 0)
+        self.assertEqual(self.client.get('generation:users'), b'1')
+        self.assertEqual(load(1), {'id': 1})
+        self.assertEqual(calls, [1, 1])
+
+    def test_other_namespaces_are_deleted(self):
+        cache = self.make_cache(versioned=True)
+        for i in range(3):
+            self.client.set('other:%d' % i, i)
+        self.client.set('kept', 1)
+        self.assertEqual(cache.delete_namespace('other'), 3)
+        self.assertEqual(self.client.keys('*'), [b'kept'])
+
+
+
+class ComputeTest(MyCacheTest):
+    def test_do_not_cache_returns_its_result_uncached(self):
+        cache = self.make_cache(prefix='test')
+        calls = []
+
+        @cache_it(cache=cache, namespace='results')
+        def load(value):
+            calls.append(value)
+            raise DoNotCache(value)
+
+        self.assertEqual(load(1), 1)
+        self.assertEqual(load(1), 1)
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(self.client.keys('*'), [])
+
+    def test_errors_are_raised(self):
+        cache = self.make_cache(prefix='test')
+
+        @cache_it(cache=cache, namespace='results')
+        def load(value):
+            raise KeyError(value)
+
+        self.assertRaises(KeyError, load, 1)
+
+
+
+class SingleFlightTest(FakeRedisCacheTest):
+    def test_concurrent_callers_share_one_call(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(2)
+            return 'value'
+
+        threads = [threading.Thread(target=lambda: results.append(flight.do('k', compute))) for _ in range(5)]
+        threads[0].start()
+        started.wait(2)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['value'] * 5)
+
+    def test_lock_is_released_by_its_holder_only(self):
+        lock = RedisLock(self.client, 'k:lock')
+        other = RedisLock(self.client, 'k:lock')
+        self.assertTrue(lock.acquire())
+        self.assertFalse(other.acquire())
+        other.release()
+        self.assertIsNotNone(self.client.get('k:lock'))
+        lock.release()
+        self.assertTrue(other.acquire())
+
+    def test_waiters_read_the_value_of_the_holder(self):
+        holder = RedisLock(self.client, 'k:lock')
+        self.assertTrue(holder.acquire())
+        self.client.set('k', b'fresh')
+
+        def fetch():
+            value = self.client.get('k')
+            return MISSING if value is None else value
+
+        def compute():
+            raise AssertionError('computed while the lock was held')
+        self.assertEqual(fetch_or_compute(self.client, 'k', fetch, compute, lock_wait=1, poll_interval=0.01),
+                         b'fresh')
+
+    def test_cache_it_computes_once(self):
+        cache = self.make_cache(prefix='test')
+        calls = []
+
+        @cache_it(cache=cache, namespace='slow', single_flight=True)
+        def load(value):
+            calls.append(value)
+            time.sleep(0.1)
+            return value
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(load(1))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [1] * 5)
+
+
+
+class StaleWhileRevalidateTest(FakeRedisCacheTest):
+    def test_xfetch_refreshes_expensive_values_earlier(self):
+        now = time.time()
+        self.assertFalse(should_refresh(0, now + 10, now=now))
+        self.assertTrue(should_refresh(0, now, now=now))
+        self.assertTrue(should_refresh(1e9, now + 10, now=now))
+
+    def test_stale_value_is_served_while_refreshed(self):
+        cache = self.make_cache(prefix='test')
+        version = [1]
+
+        @cache_it(cache=cache, namespace='swr', expire=1, stale_ttl=60)
+        def load():
+            return version[0]
+
+        self.assertEqual(load(), 1)
+        version[0] = 2
+        self.assertEqual(load(), 1)
+        time.sleep(1.05)
+        self.assertEqual(load(), 1)  # stale, refreshed in the background
+        self.assertTrue(wait_for(lambda: load() == 2))
+
+
+
+class CacheItManyTest(MyCacheTest):
+    def test_only_missing_ids_are_loaded(self):
+        cache = self.make_cache(prefix='test')
+        calls = []
+
+        @cache_it_many(cache=cache, namespace='users')
+        def load(ids):
+            calls.append(list(ids))
+            return dict((id_, {'id': id_}) for id_ in ids if id_ != 404)
+
+        self.assertEqual(load([1, 2, 1]), [{'id': 1}, {'id': 2}, {'id': 1}])
+        self.assertEqual(load([3, 2, 404, 1]), [{'id': 3}, {'id': 2}, None, {'id': 1}])
+        self.assertEqual(calls, [[1, 2], [3, 404]])
+        self.assertEqual(len(self.client.keys('users:load:*')), 3)
+
+    def test_list_results_and_dict_output(self):
+        cache = self.make_cache(prefix='test')
+
+        @cache_it_many(cache=cache, namespace='squares', as_dict=True)
+        def load(ids, power=2):
+            return [id_ ** power for id_ in ids]
+
+        self.assertEqual(list(load([3, 2]).items()), [(3, 9), (2, 4)])
+        self.assertEqual(list(load([2, 3], power=3).items()), [(2, 8), (3, 27)])
+        self.assertEqual(list(load([2]).items()), [(2, 4)])
+
+
+
+class TagsTest(FakeRedisCacheTest):
+    def test_invalidate_tags_drops_tagged_entries_only(self):
+        cache = self.make_cache(prefix='test', delete_batch=3)
+        calls = []
+
+        @cache_it(cache=cache, namespace='orders', tags=lambda user_id, page: ['user:%d' % user_id])
+        def orders(user_id, page):
+            calls.append((user_id, page))
+            return [user_id, page]
+
+        for page in range(5):
+            orders(1, page)
+            orders(2, page)
+        self.assertEqual(self.client.scard(tag_key('user:1')), 5)
+        self.assertGreater(self.client.ttl(tag_key('user:1')), 0)
+
+        progress = []
+        self.assertEqual(cache.invalidate_tags(['user:1'], progress.append), 5)
+        self.assertEqual(progress[-1], 5)
+        self.assertEqual(self.client.exists(tag_key('user:1')), 0)
+        del calls[:]
+        orders(1, 0)
+        orders(2, 0)
+        self.assertEqual(calls, [(1, 0)])
+
+    def test_several_tags(self):
+        cache = self.make_cache(prefix='test')
+        cache.store_value('a', 1, 60, tags=['x'])
+        cache.store_value('b', 2, 60, tags=['x', 'y'])
+        cache.store_value('c', 3, 60, tags=['z'])
+        self.assertEqual(cache.invalidate_tags(['x', 'y']), 3)  # b is counted in both sets
+        self.assertEqual(sorted(self.client.keys('*')), [b'c', tag_key('z').encode('ascii')])
+
+
+class IterItemsTest(MyCacheTest):
+    def test_namespace_items_skip_locks_and_other_namespaces(self):
+        cache = self.make_cache(prefix='users')
+        for i in range(12):
+            cache.set('k%d' % i, {'id': i}, expire=600)
+        self.client.set('users:forever', cache.serializer.dumps('x'))
+        self.client.set('users:k0:lock', b'token')
+        self.client.set('other:k0', cache.serializer.dumps('y'))
+
+        items = sorted(cache.iter_items('users', batch=5), key=lambda item: item[0])
+        self.assertEqual([key for key, _, _ in items],
+                         sorted(['users:forever'] + ['users:k%d' % i for i in range(12)]))
+        self.assertEqual(dict((key, value) for key, value, _ in items)['users:k3'], {'id': 3})
+        ttls = dict((key, ttl) for key, _, ttl in items)
+        self.assertIsNone(ttls['users:forever'])
+        self.assertTrue(500 < ttls['users:k3'] <= 600)
+
+    def test_versioned_namespace_reads_current_generation(self):
+        cache = self.make_cache(prefix='users', versioned=True, generation_refresh=0)
+        cache.set('old', 1)
+        cache.delete_namespace('users')
+        cache.set('new', 2)
+        self.assertEqual([value for _, value, _ in cache.iter_items('users')], [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+Canonical argument encoding and cache_it keys.
+"""
+import os
+import sys
+import unittest
+from collections import OrderedDict, namedtuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from key_builder import KeyBuilder, encode_args, encode_value, set_hash, hash_name
+
+Point = namedtuple('Point', 'x y')
+
+
+class User(object):
+    def __init__(self, id_):
+        self.id = id_
+
+    def __cache_key__(self):
+        return str(self.id)
+
+
+class EncodingTest(unittest.TestCase):
+    def test_distinct_arguments_get_distinct_encodings(self):
+        calls = [((1, 23), {}), ((12, 3), {}), ((1,), {}), (('1',), {}), ((b'1',), {}), (([1],), {}),
+                 (((1,),), {}), ((1.0,), {}), ((True,), {}), ((None,), {}), (('a:b',), {}), (('a', 'b'), {}),
+                 ((), {'a': 1}), ((1,), {'a': None})]
+        encodings = [encode_args(args, kwargs) for args, kwargs in calls]
+        self.assertEqual(len(set(encodings)), len(calls))
+
+    def test_ordering_does_not_matter(self):
+        self.assertEqual(encode_args((), {'a': 1, 'b': 2}), encode_args((), OrderedDict([('b', 2), ('a', 1)])))
+        self.assertEqual(encode_value({'a': 1, 'b': 2}), encode_value(OrderedDict([('b', 2), ('a', 1)])))
+        self.assertEqual(encode_value(set([3, 1, 2])), encode_value(frozenset([2, 3, 1])))
+        self.assertEqual(encode_value(-0.0), encode_value(0.0))
+
+    def test_subclasses_and_objects(self):
+        self.assertEqual(encode_value(Point(1, 2)), encode_value((1, 2)))
+        self.assertEqual(encode_value(User(1)), encode_value(User(1)))
+        self.assertNotEqual(encode_value(User(1)), encode_value(User(2)))
+        self.assertNotEqual(encode_value(User(1)), encode_value('1'))
+
+
+class KeyBuilderTest(unittest.TestCase):
+    def test_key_layout(self):
+        keys = KeyBuilder('users', 'load')
+        key = keys.key((1,), {'full': True})
+        self.assertTrue(key.startswith('users:load:'))
+        self.assertEqual(key, keys.key((1,), {'full': True}))
+        self.assertNotEqual(key, keys.key((1,), {'full': False}))
+        self.assertEqual(keys.key((1,), {'full': True}, namespace='users:g2'), 'users:g2:load:' + key.split(':')[-1])
+
+    def test_memo_keeps_types_apart(self):
+        keys = KeyBuilder('users', 'load')
+        self.assertEqual(len(set(keys.key((value,), {}) for value in (1, 1.0, True, 1, 1.0, True))), 3)
+
+    def test_version_ignore_args_and_readable_keys(self):
+        self.assertNotEqual(KeyBuilder('n', 'f').key((1,), {}), KeyBuilder('n', 'f', version=2).key((1,), {}))
+        keys = KeyBuilder('n', 'f', ignore_args=True)
+        self.assertEqual(keys.key((1, 2), {'a': 1}), keys.key((1, 3), {}))
+        self.assertIn('abc', KeyBuilder('n', 'f', hashed=False).key(('abc',), {}))
+        self.assertNotEqual(KeyBuilder(None, 'f').key((1,), {}), KeyBuilder(None, 'g').key((1,), {}))
+
+    def test_changing_the_hash_changes_keys(self):
+        keys = KeyBuilder('n', 'f')
+        before, name = keys.key((1,), {}), hash_name()
+        set_hash('md5')
+        try:
+            self.assertNotEqual(keys.key((1,), {}), before)
+        finally:
+            set_hash(name)
+        self.assertEqual(keys.key((1,), {}), before)
+        self.assertRaises(ValueError, set_hash, 'crc32')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+"""
+Large values split in chunks, on one server and sharded over two, against the
+in-process fake servers of the benchmarks.
+"""
+import os
+import pickle
+import sys
+import unittest
+try:
+    from unittest import mock
+except ImportError:  # Python 2
+    mock = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+
+import redis
+from fake_redis import FakeRedisServer
+from generic_cache import MyCache
+from large_values import chunking_supported, is_chunk_key
+
+
+@unittest.skipUnless(chunking_supported(), 'pickle protocol 5 is not available')
+class LargeValuesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.servers = [FakeRedisServer().start() for _ in range(2)]
+        cls.clients = [redis.StrictRedis('127.0.0.1', server.port) for server in cls.servers]
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.stop()
+
+    def setUp(self):
+        for client in self.clients:
+            client.flushdb()
+
+    def make_cache(self, sharded, **options):
+        options.update(health_check_interval=None, large_value_threshold=1024, chunk_size=512, compression=None)
+        if sharded:
+            options['nodes'] = ['127.0.0.1:%d' % server.port for server in self.servers]
+        else:
+            options.update(host='127.0.0.1', port=self.servers[0].port)
+        return MyCache(**options)
+
+    def stored_keys(self):
+        return sorted(key for client in self.clients for key in client.keys('*'))
+
+    def check_round_trip(self, sharded):
+        cache = self.make_cache(sharded)
+        value = bytearray(os.urandom(5000))
+        cache.store_pickle('big', value)
+        self.assertEqual(cache.get_pickle('big'), value)
+        self.assertTrue(any(is_chunk_key(key) for key in self.stored_keys()))
+
+        cache.delete('big')
+        self.assertIsNone(cache.get_pickle('big'))
+        self.assertEqual(self.stored_keys(), [])
+
+    def test_round_trip(self):
+        self.check_round_trip(sharded=False)
+
+    def test_round_trip_sharded(self):
+        self.check_round_trip(sharded=True)
+
+    def test_small_value_is_not_chunked(self):
+        cache = self.make_cache(sharded=True)
+        cache.store_pickle('small', {'a': 1})
+        self.assertEqual(cache.get_pickle('small'), {'a': 1})
+        self.assertEqual(self.stored_keys(), [b'small'])
+
+    @unittest.skipIf(mock is None, 'needs unittest.mock')
+    def test_small_value_is_pickled_once(self):
+        cache = self.make_cache(sharded=False)
+        with mock.patch.object(pickle, 'dumps', wraps=pickle.dumps) as dumps:
+            cache.store_pickle('small', {'a': 1})
+        self.assertEqual(dumps.call_count, 1)
+        self.assertEqual(cache.get_pickle('small'), {'a': 1})
+
+    def check_overwrite(self, cache):
+        cache.store_pickle('k', bytearray(5000))
+        cache.flush()
+        cache.store_pickle('k', {'a': 1})
+        cache.flush()
+        self.assertEqual(cache.get_pickle('k'), {'a': 1})
+        self.assertEqual(self.stored_keys(), [b'k'])
+
+    def test_small_value_drops_chunks_it_replaces(self):
+        self.check_overwrite(self.make_cache(sharded=True))
+
+    def test_small_value_drops_chunks_it_replaces_write_behind(self):
+        self.check_overwrite(self.make_cache(sharded=False, write_behind=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+"""
+Importing the cache modules reads no settings and opens no socket.
+"""
+import os
+import subprocess
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# Run in a fresh interpreter, since other tests already loaded settings and connected.
+CHECK = """
+import socket, sys
+connects = []
+connect = socket.socket.connect
+def record(self, *args):
+    connects.append(args)
+    return connect(self, *args)
+socket.socket.connect = record
+sys.path.insert(0, %r)
+import settings
+import generic_cache, client, cache_tool
+assert settings.settings_dict == {}, settings.settings_dict
+assert connects == [], connects
+cache = generic_cache.MyCache(host='127.0.0.1', port=1, health_check_interval=None)
+assert connects == [], connects
+print('ok')
+"""
+
+
+class LazyImportTest(unittest.TestCase):
+    def test_import_does_no_io(self):
+        output = subprocess.check_output([sys.executable, '-c', CHECK % ROOT], cwd=ROOT,
+                                         stderr=subprocess.STDOUT)
+        self.assertEqual(output.decode('utf-8').strip().splitlines()[-1], 'ok')
+
+
+if __name__ == '__main__':
+    unittest.main()
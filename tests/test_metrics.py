@@ -0,0 +1,82 @@
+"""
+Metrics registry, and what caches record to it against the in-process fake
+server of the benchmarks.
+"""
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+
+from fake_redis import FakeRedisServer
+from generic_cache import MyCache, cache_it
+from metrics import Metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def test_series_counts_and_histograms(self):
+        metrics = Metrics()
+        series = metrics.series('users', 'load')
+        self.assertIs(metrics.series('users', 'load'), series)
+        series.read(1, 0, 0.0002, 0.00001, 100)
+        series.read(0, 1, 0.0002)
+        series.write(0.0003, 0.00002, 5000)
+        series.error()
+        snapshot = metrics.stats()[0]
+        self.assertEqual((snapshot['hits'], snapshot['misses'], snapshot['writes'], snapshot['errors']),
+                         (1, 1, 1, 1))
+        self.assertEqual(snapshot['hit_ratio'], 0.5)
+        network = snapshot['histograms']['network_seconds:get']
+        self.assertEqual(network['count'], 2)
+        self.assertEqual(network['buckets'][:2], [(0.0001, 0), (0.00025, 2)])
+        self.assertEqual(snapshot['histograms']['payload_bytes:set']['buckets'][3:5], [(4096, 0), (16384, 1)])
+
+    def test_disabled_registry_records_nothing(self):
+        metrics = Metrics(enabled=False)
+        series = metrics.series()
+        series.read()
+        series.write()
+        series.error()
+        self.assertEqual((series.hits, series.writes, series.errors), (0, 0, 0))
+
+    def test_prometheus_exposition(self):
+        metrics = Metrics(prefix='cache')
+        metrics.series('a"b', 'f').read(2, 1)
+        text = metrics.prometheus()
+        self.assertIn('# TYPE cache_requests_total counter', text)
+        self.assertIn('cache_requests_total{namespace="a\\"b",function="f",result="hit"} 2', text)
+        self.assertIn('cache_network_seconds_bucket{namespace="a\\"b",function="f",op="get",le="+Inf"} 0', text)
+        self.assertTrue(text.endswith('\n'))
+
+
+class CacheMetricsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeRedisServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def test_cache_it_records_per_function(self):
+        metrics = Metrics()
+        cache = MyCache(host='127.0.0.1', port=self.server.port, prefix='test', health_check_interval=None,
+                        metrics=metrics)
+        cache.connection.flushdb()
+
+        @cache_it(cache=cache, namespace='metrics')
+        def load(value):
+            return value
+
+        load(1)
+        load(1)
+        load(2)
+        series = metrics.series('metrics', 'load')
+        self.assertEqual((series.hits, series.misses, series.writes), (1, 2, 2))
+        self.assertEqual(series.snapshot()['histograms']['payload_bytes:get']['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Caches created before a fork keep working in the child, on connections of
+its own, against the in-process fake server of the benchmarks.
+"""
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+
+from fake_redis import FakeRedisServer
+from connection_pool import get_pool
+from generic_cache import MyCache
+from client import MIOCache
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'needs os.fork')
+class ForkTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeRedisServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def run_in_child(self, function):
+        """
+        :return: exit status of function() run in a forked child, 0 if it returned True
+        """
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                status = 0 if function() else 3
+            finally:
+                os._exit(status)
+        return os.WEXITSTATUS(os.waitpid(pid, 0)[1])
+
+    def test_child_gets_its_own_connections(self):
+        cache = MyCache(host='127.0.0.1', port=self.server.port, prefix='test', health_check_interval=None,
+                        write_behind=True)
+        mio = MIOCache(host='127.0.0.1', port=self.server.port, namespace='fork')
+        cache.set('k', 'parent')
+        cache.flush()
+        mio.set('k', 'parent')
+        parent_pool = get_pool('127.0.0.1', self.server.port)
+
+        def child():
+            cache.set('k', 'child')
+            cache.flush()
+            mio.set('k', 'child')
+            return cache.get('k') == 'child' and mio.get('k') == 'child' \
+                and cache.connection.connection_pool is not parent_pool
+        self.assertEqual(self.run_in_child(child), 0)
+        self.assertEqual(cache.get('k'), 'child')
+        self.assertEqual(mio.get('k'), 'child')
+        self.assertIs(cache.connection.connection_pool, parent_pool)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""
+Read routing to replicas, with in-process fake servers of the benchmarks
+standing in for a primary and its replicas.
+"""
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+
+import redis
+from fake_redis import FakeRedisServer
+from generic_cache import MyCache
+from replicas import ReplicaSet, LEAST_LATENCY
+
+
+class ReplicaSetTest(unittest.TestCase):
+    def connect(self, host, port):
+        return '%s:%d' % (host, port)
+
+    def test_round_robin_skips_failed_replicas(self):
+        replicas = ReplicaSet(['a:1', 'b:2'], self.connect)
+        a, b = [replica.client for replica in replicas.replicas]
+        self.assertEqual(set(replicas.client() for _ in range(4)), set([a, b]))
+        self.assertTrue(replicas.failed(a))
+        self.assertFalse(replicas.failed('primary:0'))
+        self.assertEqual(set(replicas.client() for _ in range(4)), set([b]))
+        replicas.failed(b)
+        self.assertIsNone(replicas.client())
+
+    def test_least_latency_and_update(self):
+        replicas = ReplicaSet(['a:1', 'b:2'], self.connect, LEAST_LATENCY)
+        replicas.replicas[0].latency, replicas.replicas[1].latency = 0.002, 0.001
+        self.assertEqual(replicas.client(), 'b:2')
+        replicas.update(['b:2', 'c:3'])
+        self.assertEqual([replica.name for replica in replicas.replicas], ['b:2', 'c:3'])
+        self.assertEqual(replicas.replicas[0].latency, 0.001)
+        self.assertRaises(ValueError, ReplicaSet, [], self.connect, 'random')
+
+
+class ReplicaReadsTest(unittest.TestCase):
+    def setUp(self):
+        self.primary = FakeRedisServer().start()
+        self.replica = FakeRedisServer().start()
+        self.addCleanup(self.primary.stop)
+        self.replica_client = redis.StrictRedis('127.0.0.1', self.replica.port)
+        self.cache = MyCache(host='127.0.0.1', port=self.primary.port, prefix='test', health_check_interval=None,
+                             replicas=['127.0.0.1:%d' % self.replica.port])
+
+    def test_reads_go_to_replicas_and_writes_to_the_primary(self):
+        self.cache.set('k', 'primary')
+        self.assertIsNone(self.cache.get('k'))  # not replicated by the fake server
+        self.replica_client.set('test:k', self.cache.serializer.dumps('replica'))
+        self.assertEqual(self.cache.get('k'), 'replica')
+        self.assertEqual(self.cache.mget(['k']), {'k': 'replica'})
+
+    def test_reads_fall_back_to_the_primary(self):
+        self.cache.set('k', 'primary')
+        self.replica.stop()
+        self.cache.get('k')  # fails on the replica, which is then left out
+        self.assertEqual(self.cache.get('k'), 'primary')
+        self.assertEqual(self.cache.replica_stats()['127.0.0.1:%d' % self.replica.port]['reads_failed'], 1)
+        self.assertEqual(self.cache.breaker.state, 'closed')
+
+
+if __name__ == '__main__':
+    unittest.main()
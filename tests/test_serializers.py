@@ -0,0 +1,57 @@
+"""
+Codec registry and value headers.
+"""
+import json
+import os
+import pickle
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from serializers import Serializer, available_codecs, codec_of, is_encoded, HEADER_SIZE
+
+VALUE = {'id': 1, 'name': u'caf\xe9', 'tags': ['a', 'b'], 'score': 1.5, 'parent': None}
+
+
+class SerializerTest(unittest.TestCase):
+    def test_every_codec_round_trips(self):
+        for codec in available_codecs():
+            serializer = Serializer(codec, compression=None)
+            data = serializer.dumps(VALUE)
+            self.assertTrue(is_encoded(data))
+            self.assertEqual(codec_of(data), (codec, None))
+            self.assertEqual(serializer.loads(data), VALUE)
+
+    def test_values_are_read_whatever_their_codec(self):
+        data = Serializer('json').dumps(VALUE)
+        self.assertEqual(Serializer('pickle').loads(data), VALUE)
+
+    def test_compression_above_threshold_only(self):
+        serializer = Serializer('json', compression='zlib', compress_threshold=100)
+        small = serializer.dumps('x')
+        large = serializer.dumps('x' * 1000)
+        self.assertEqual(codec_of(small), ('json', None))
+        self.assertEqual(codec_of(large), ('json', 'zlib'))
+        self.assertLess(len(large), 1000)
+        self.assertEqual(serializer.loads(large), 'x' * 1000)
+
+    def test_incompressible_values_are_stored_as_is(self):
+        serializer = Serializer('pickle', compression='zlib', compress_threshold=100)
+        data = serializer.dumps(os.urandom(1000))
+        self.assertEqual(codec_of(data), ('pickle', None))
+
+    def test_legacy_values_use_the_legacy_loader(self):
+        serializer = Serializer()
+        self.assertEqual(serializer.loads(pickle.dumps(VALUE)), VALUE)
+        self.assertEqual(serializer.loads(json.dumps(VALUE).encode('utf-8'), legacy=json.loads), VALUE)
+
+    def test_unknown_codec_is_rejected(self):
+        self.assertRaises(ValueError, Serializer, 'yaml')
+        self.assertRaises(ValueError, Serializer, 'json', 'rar')
+        self.assertRaises(ValueError, Serializer().loads, b'\x00\xe0' + b'x' * HEADER_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+Routing of ShardedRedis over a hash ring of fake servers and over a stubbed
+Redis Cluster.
+"""
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+
+import redis
+from redis.exceptions import MovedError
+from fake_redis import FakeRedisServer
+from sharding import ShardedRedis, HashRing, ClusterSlots, parse_node
+
+
+class ClusterNode(object):
+    """
+    Stub of a cluster node answering CLUSTER SLOTS from a shared map and MOVED for slots it lost.
+    """
+    def __init__(self, cluster, name):
+        self.cluster = cluster
+        self.name = name
+        self.data = {}
+
+    def execute_command(self, *args):
+        assert args == ('CLUSTER', 'SLOTS')
+        self.cluster.loads += 1
+        host, port = parse_node(self.cluster.owner)
+        return [[0, 16383, [host.encode('ascii'), port]]]
+
+    def get(self, key):
+        if self.cluster.owner != self.name:
+            raise MovedError('3999 {0}'.format(self.cluster.owner))
+        return self.data.get(key)
+
+
+class Cluster(object):
+    def __init__(self, names):
+        self.nodes = dict((name, ClusterNode(self, name)) for name in names)
+        self.owner = names[0]
+        self.loads = 0
+
+    def connect(self, host, port):
+        return self.nodes['{0}:{1}'.format(host, port)]
+
+
+class ClusterRoutingTest(unittest.TestCase):
+    def test_moved_reloads_slots_and_retries(self):
+        cluster = Cluster(['127.0.0.1:7000', '127.0.0.1:7001'])
+        cluster.nodes['127.0.0.1:7001'].data['k'] = b'moved'
+        router = ShardedRedis(ClusterSlots(['127.0.0.1:7000'], cluster.connect), cluster.connect)
+        self.assertIsNone(router.get('k'))
+
+        cluster.owner = '127.0.0.1:7001'  # slots resharded to the other node
+        self.assertEqual(router.get('k'), b'moved')
+        self.assertEqual(cluster.loads, 2)
+        self.assertEqual(router.get('k'), b'moved')
+        self.assertEqual(cluster.loads, 2)
+
+    def test_other_errors_are_not_retried(self):
+        cluster = Cluster(['127.0.0.1:7000'])
+        router = ShardedRedis(ClusterSlots(['127.0.0.1:7000'], cluster.connect), cluster.connect)
+        self.assertFalse(router.moved(redis.ResponseError('WRONGTYPE')))
+
+
+class RingRoutingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.servers = [FakeRedisServer().start() for _ in range(3)]
+        cls.names = ['127.0.0.1:%d' % server.port for server in cls.servers]
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.stop()
+
+    def setUp(self):
+        self.router = ShardedRedis(HashRing(self.names), lambda host, port: redis.StrictRedis(host, port))
+        for client in self.router.clients():
+            client.flushdb()
+
+    def test_keys_spread_and_mget_in_order(self):
+        keys = ['k%d' % i for i in range(60)]
+        pipe = self.router.pipeline(transaction=False)
+        for key in keys:
+            pipe.set(key, key)
+        pipe.execute()
+        counts = [client.dbsize() for client in self.router.clients()]
+        self.assertEqual(sum(counts), len(keys))
+        self.assertTrue(all(counts))
+        self.assertEqual(self.router.mget(keys + ['missing']), [key.encode('ascii') for key in keys] + [None])
+        self.assertEqual(self.router.delete(*keys), len(keys))
+
+    def test_hash_tags_share_a_node(self):
+        for i in range(20):
+            self.router.set('{users}:%d' % i, i)
+        self.assertEqual(sorted(client.dbsize() for client in self.router.clients()), [0, 0, 20])
+        self.assertEqual(sorted(self.router.scan_iter(match='{users}:*')),
+                         sorted(('{users}:%d' % i).encode('ascii') for i in range(20)))
+
+
+if __name__ == '__main__':
+    unittest.main()
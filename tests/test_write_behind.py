@@ -0,0 +1,105 @@
+"""
+WriteBehindQueue against the in-process fake server of the benchmarks.
+"""
+import os
+import sys
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'benchmarks'))
+
+import redis
+from fake_redis import FakeRedisServer
+from generic_cache import MyCache
+from write_behind import WriteBehindQueue
+
+
+class SlowClient(object):
+    """
+    Client whose pipelines take delay seconds to execute, so the queue fills up.
+    """
+    def __init__(self, client, delay):
+        self.client = client
+        self.delay = delay
+
+    def pipeline(self, transaction=True):
+        pipe = self.client.pipeline(transaction=transaction)
+        execute = pipe.execute
+
+        def slow_execute(*args, **kwargs):
+            time.sleep(self.delay)
+            return execute(*args, **kwargs)
+        pipe.execute = slow_execute
+        return pipe
+
+
+class WriteBehindQueueTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeRedisServer().start()
+        cls.client = redis.StrictRedis('127.0.0.1', cls.server.port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.client.flushdb()
+
+    def make_queue(self, delay=0.0, maxsize=1):
+        slow = SlowClient(self.client, delay)
+        queue = WriteBehindQueue(lambda: slow, maxsize=maxsize, batch_size=1, put_timeout=0)
+        self.addCleanup(queue.close)
+        return queue
+
+    def test_writes_are_sent_and_counted(self):
+        queue = self.make_queue(maxsize=100)
+        for i in range(10):
+            queue.set('k%d' % i, b'v', 60)
+        queue.delete('k0')
+        self.assertTrue(queue.flush(5))
+        self.assertEqual(self.client.dbsize(), 9)
+        self.assertEqual(queue.stats()['written'], 11)
+
+    def test_overflow_keeps_order(self):
+        queue = self.make_queue(delay=0.05)
+        queue.set('k', b'1')
+        time.sleep(0.01)  # taken by the worker, which is now busy
+        queue.set('k', b'2')  # queued
+        queue.set('k', b'3')  # queue full, written by this thread
+        self.assertGreater(queue.stats()['overflows'], 0)
+        self.assertTrue(queue.flush(5))
+        self.assertEqual(self.client.get('k'), b'3')
+
+    def test_overflowing_delete_keeps_order(self):
+        queue = self.make_queue(delay=0.05)
+        queue.set('k', b'1')
+        time.sleep(0.01)
+        queue.set('k', b'2')
+        queue.delete('k')
+        self.assertTrue(queue.flush(5))
+        self.assertIsNone(self.client.get('k'))
+
+    def test_writes_after_close_are_synchronous(self):
+        queue = self.make_queue(maxsize=100)
+        queue.close()
+        queue.set('k', b'1')
+        self.assertEqual(self.client.get('k'), b'1')
+
+
+    def test_cache_writes_behind(self):
+        cache = MyCache(host='127.0.0.1', port=self.server.port, prefix='test', health_check_interval=None,
+                        write_behind=True)
+        self.addCleanup(cache.close)
+        cache.set_many({'a': 1, 'b': 2})
+        cache.set('c', 3)
+        cache.delete('a')
+        self.assertTrue(cache.flush(5))
+        self.assertEqual(cache.write_queue.stats()['written'], 4)
+        self.assertEqual(cache.mget(['a', 'b', 'c']), {'b': 2, 'c': 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
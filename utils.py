@@ -1,3 +1,10 @@
+import getpass
+import logging
+import os
+import tempfile
+import time
+
+
 def init_log(log_name, root = None):
     '''creates handlers for loging to file and console
         log_name: name of the log create.  this name can be used to retrieve the singleton log
@@ -0,0 +1,179 @@
+"""
+Write-behind buffering for MyCache writes.
+
+Writes are put on a bounded in-memory queue and a background thread sends them
+to Redis in pipelined batches, so request threads do not wait on cache writes.
+When the queue is full writers block for up to `put_timeout` seconds, then wait
+for the queued writes to be sent and write synchronously themselves, so
+back-pressure slows producers down instead of dropping data, and a write never
+overtakes an older one. flush() waits for everything queued so far to be written.
+Queues still alive at exit are drained by one handler for the whole process; an
+idle queue has no thread, so a cache which is dropped takes its queue with it.
+"""
+import atexit
+import logging
+import threading
+import time
+import weakref
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:  # Python 3
+    from queue import Queue, Empty, Full
+import redis
+from tags import record_tags
+
+SET = 'set'
+DELETE = 'delete'
+
+# Seconds the background thread waits for a write before it stops.
+IDLE_TIMEOUT = 1.0
+
+_queues = weakref.WeakSet()
+
+
+class WriteBehindQueue(object):
+    """
+    :param connection: callable returning the redis client to write with
+    :param maxsize: max number of queued writes
+    :param batch_size: max number of writes per pipeline
+    :param put_timeout: seconds a writer blocks on a full queue before writing synchronously
+    """
+    def __init__(self, connection, maxsize=10000, batch_size=500, put_timeout=1.0, log=None):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self._log = log or logging.getLogger(__name__)
+        self.maxsize = maxsize
+        self._queue = Queue(maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self.written = 0
+        self.failed = 0
+        self.overflows = 0
+        _queues.add(self)
+
+    def set(self, key, value, expire=None, tags=None):
+        """
+        :param tags: tags to record key under, in the pipeline of the write, see tags.record_tags
+        """
+        self._put((SET, key, value, expire, tags))
+
+    def delete(self, key):
+        # Deletes are queued too, so they cannot overtake a pending write of the same key.
+        self._put((DELETE, key, None, None, None))
+
+    def _put(self, op):
+        if self._closed:
+            self.write_now([op])
+            return
+        self._start()
+        try:
+            self._queue.put(op, True, self.put_timeout)
+        except Full:
+            self.overflows += 1
+            self.write_now([op])
+        else:
+            self._start()  # the thread may have gone idle meanwhile
+
+    def write_now(self, ops):
+        """
+        Sends ops from the calling thread once every write queued before them is sent, so that
+        they are applied in order.
+        """
+        self.flush()
+        self._write(ops)
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='redis-write-behind')
+                    self._thread.daemon = True
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                op = self._queue.get(True, IDLE_TIMEOUT)
+            except Empty:
+                with self._lock:
+                    # Checked under the lock _start takes, so a write queued meanwhile starts a new thread.
+                    if self._queue.empty():
+                        self._thread = None
+                        return
+                continue
+            batch = [op]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        try:
+            pipe = self.connection().pipeline(transaction=False)
+            for action, key, value, expire, tags in batch:
+                if action == SET:
+                    if tags:
+                        record_tags(pipe, key, tags, expire)
+                    pipe.set(key, value, ex=expire)
+                else:
+                    pipe.delete(key)
+            pipe.execute()
+            self.written += len(batch)
+        except (redis.RedisError, AttributeError) as e:
+            self.failed += len(batch)
+            self._log.error('Write-behind flush of {} writes failed. \nERROR: {}'.format(len(batch), str(e)))
+
+    def flush(self, timeout=None):
+        """
+        Blocks until every write queued so far has been sent.
+        :param timeout: max seconds to wait, None waits for as long as it takes
+        :return: True if the queue was drained
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self._queue.unfinished_tasks:
+            if self._thread is None or not self._thread.is_alive():
+                self._start()
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def close(self, timeout=None):
+        """
+        Drains the queue and stops the background thread; later writes are synchronous.
+        """
+        drained = self.flush(timeout)
+        self._closed = True
+        return drained
+
+    def after_fork(self):
+        """
+        Starts over with an empty queue in a forked child: writes queued in the parent are flushed by it.
+        """
+        self._queue = Queue(self.maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.written = self.failed = self.overflows = 0
+
+    def stats(self):
+        return {'queued': self._queue.qsize(),
+                'written': self.written,
+                'failed': self.failed,
+                'overflows': self.overflows}
+
+
+@atexit.register
+def close_queues():
+    """
+    Drains the write-behind queues still alive at exit, waiting at most 5 seconds for each.
+    """
+    for queue in list(_queues):
+        queue.close(5)